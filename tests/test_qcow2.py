@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+"""Read back the qcow2 files of the streaming writer with a reader of
+its own, checking the data, the L1/L2 tables and the refcounts.
+
+    python -m pytest tests
+"""
+
+import io
+import os
+import random
+import shutil
+import struct
+import tempfile
+import unittest
+
+from v2os.disk import qcow2
+
+CLUSTER_KB = 1
+CLUSTER = CLUSTER_KB * 1024
+OFFSET_MASK = 0x00fffffffffffe00
+
+
+class Image(object):
+    """A minimal qcow2 reader: the header, the L1/L2 tables and the
+    refcounts, nothing the writer does not produce.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.raw = f.read()
+        (magic, version, backing, _, self.cluster_bits, self.size,
+         crypt, self.l1_size, self.l1_offset, self.refcount_offset,
+         self.refcount_clusters, snapshots, _, incompatible, _, _,
+         self.refcount_order, self.header_length) = qcow2.HEADER.unpack(
+            self.raw[:qcow2.HEADER.size])
+        assert magic == qcow2.QCOW_MAGIC
+        assert (version, backing, crypt, snapshots, incompatible) == \
+            (3, 0, 0, 0, 0)
+        self.cluster = 1 << self.cluster_bits
+        self.l2_entries = self.cluster // 8
+
+    def table(self, offset, count):
+        return struct.unpack('>%dQ' % count,
+                             self.raw[offset:offset + count * 8])
+
+    def l1(self):
+        return self.table(self.l1_offset, self.l1_size)
+
+    def l2(self, entry):
+        return self.table(entry & OFFSET_MASK, self.l2_entries)
+
+    def mapping(self):
+        """Return {virtual cluster index: L2 entry} of allocated clusters.
+        """
+        result = {}
+        for l2_index, entry in enumerate(self.l1()):
+            if not entry:
+                continue
+            for index, cluster in enumerate(self.l2(entry)):
+                if cluster:
+                    result[l2_index * self.l2_entries + index] = cluster
+        return result
+
+    def read(self):
+        data = bytearray(self.size)
+        for index, entry in self.mapping().items():
+            start = index * self.cluster
+            length = min(self.cluster, self.size - start)
+            offset = entry & OFFSET_MASK
+            data[start:start + length] = self.raw[offset:offset + length]
+        return bytes(data)
+
+    def refcounts(self):
+        """Return the refcount of each host cluster the blocks cover.
+        """
+        bits = 1 << self.refcount_order
+        per_block = self.cluster * 8 // bits
+        result = []
+        for entry in self.table(self.refcount_offset,
+                                self.refcount_clusters * self.cluster // 8):
+            if not entry:
+                continue
+            result.extend(struct.unpack(
+                '>%dH' % per_block, self.raw[entry:entry + self.cluster]))
+        return result
+
+
+def extent_stream(size, extents):
+    out = io.BytesIO()
+    out.write(qcow2.EXTENT_HEADER.pack(qcow2.EXTENT_MAGIC, size))
+    for offset, data in extents:
+        out.write(qcow2.EXTENT.pack(offset, len(data)))
+        out.write(data)
+    out.seek(0)
+    return out
+
+
+class Qcow2WriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='v2os-test-')
+        self.rand = random.Random(47)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, True)
+
+    def convert(self, size, extents):
+        src = os.path.join(self.tmpdir, 'disk.ext')
+        dst = os.path.join(self.tmpdir, 'disk.qcow2')
+        with open(src, 'wb') as f:
+            f.write(extent_stream(size, extents).read())
+        result = qcow2.convert(src, dst, CLUSTER_KB)
+        self.assertFalse(os.path.exists('%s.part' % dst))
+        self.assertEqual(result['file_size'], os.path.getsize(dst))
+        return result, Image(dst)
+
+    def expected(self, size, extents):
+        data = bytearray(size)
+        for offset, chunk in extents:
+            data[offset:offset + len(chunk)] = chunk
+        return bytes(data)
+
+    def check_refcounts(self, image):
+        # NOTE(文件里的每个cluster引用计数为1, 之后的都为0.)
+        used = len(image.raw) // image.cluster
+        self.assertEqual(len(image.raw) % image.cluster, 0)
+        refcounts = image.refcounts()
+        self.assertGreaterEqual(len(refcounts), used)
+        self.assertEqual(refcounts[:used], [1] * used)
+        self.assertFalse(any(refcounts[used:]))
+
+    def check_tables(self, image):
+        # NOTE(L1/L2项都带COPIED标记, 指向文件内cluster对齐的位置, 且
+        #      不会有两个项指向同一个cluster.)
+        seen = set([0, image.l1_offset // image.cluster])
+        entries = [entry for entry in image.l1() if entry]
+        entries.extend(image.mapping().values())
+        for entry in entries:
+            self.assertTrue(entry & qcow2.COPIED)
+            offset = entry & OFFSET_MASK
+            self.assertEqual(offset % image.cluster, 0)
+            self.assertLess(offset, image.refcount_offset)
+            self.assertNotIn(offset // image.cluster, seen)
+            seen.add(offset // image.cluster)
+
+    def test_read_back(self):
+        l2_span = CLUSTER * (CLUSTER // 8)
+        # NOTE(3个多L2表, 末尾不足一个cluster; 中间有整段的零数据和
+        #      空洞, 以及跨cluster的非对齐extent.)
+        size = 3 * l2_span + 5 * CLUSTER + 123
+        extents = [
+            (0, self.rand_bytes(3 * CLUSTER + 100)),
+            (5 * CLUSTER, b'\0' * (4 * CLUSTER)),
+            (9 * CLUSTER + 17, self.rand_bytes(2 * CLUSTER)),
+            (l2_span - CLUSTER // 2, self.rand_bytes(CLUSTER)),
+            (2 * l2_span + 7, b'\0' * 200 + self.rand_bytes(300)),
+            (size - 2 * CLUSTER - 50, self.rand_bytes(2 * CLUSTER + 50)),
+        ]
+        result, image = self.convert(size, extents)
+
+        self.assertEqual(image.size, size)
+        self.assertEqual(image.cluster, CLUSTER)
+        self.assertEqual(image.l1_size, 4)
+        self.assertEqual(image.read(), self.expected(size, extents))
+
+        mapping = image.mapping()
+        self.assertEqual(len(mapping), result['written'])
+        for index in range(5, 9):
+            self.assertNotIn(index, mapping)
+        self.assertNotIn(l2_span // CLUSTER + 5, mapping)
+        self.assertEqual(len([entry for entry in image.l1() if entry]), 4)
+        self.assertIn(size // CLUSTER, mapping)
+        self.check_tables(image)
+        self.check_refcounts(image)
+
+    def test_all_zero(self):
+        size = 2 * CLUSTER * (CLUSTER // 8) + 1
+        extents = [(0, b'\0' * (3 * CLUSTER)), (size - 1, b'\0')]
+        result, image = self.convert(size, extents)
+
+        self.assertEqual(result['written'], 0)
+        self.assertEqual(result['skipped'], 4)
+        self.assertFalse(any(image.l1()))
+        self.assertEqual(image.read(), b'\0' * size)
+        self.check_refcounts(image)
+
+    def test_raw_read_back(self):
+        src = os.path.join(self.tmpdir, 'disk-flat.vmdk')
+        dst = os.path.join(self.tmpdir, 'disk.qcow2')
+        size = 2 * CLUSTER * (CLUSTER // 8) + 7 * CLUSTER + 300
+        extents = [(CLUSTER + 5, self.rand_bytes(3 * CLUSTER)),
+                   (40 * CLUSTER, b'\0' * (2 * CLUSTER)),
+                   (size - 200, self.rand_bytes(200))]
+        with open(src, 'wb') as f:
+            f.truncate(size)
+            for offset, data in extents:
+                f.seek(offset)
+                f.write(data)
+        result = qcow2.convert(src, dst, CLUSTER_KB, raw=True)
+        image = Image(dst)
+
+        self.assertEqual(image.size, size)
+        self.assertEqual(image.read(), self.expected(size, extents))
+        self.assertEqual(len(image.mapping()), result['written'])
+        self.assertNotIn(40, image.mapping())
+        self.check_tables(image)
+        self.check_refcounts(image)
+
+    def test_out_of_order(self):
+        extents = [(4 * CLUSTER, b'x'), (CLUSTER, b'y')]
+        with self.assertRaises(IOError):
+            self.convert(8 * CLUSTER, extents)
+
+    def rand_bytes(self, length):
+        return bytes(bytearray(self.rand.getrandbits(8)
+                               for _ in range(length)))
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+"""Statement budgets of the database plan, so a per-vm query explosion
+fails here instead of in production.
+
+    python -m pytest tests
+"""
+
+import shutil
+import logging
+import datetime
+import tempfile
+import threading
+import unittest
+
+from oslo_config import cfg
+from oslo_db import options
+import sqlalchemy
+
+from v2os import objects
+from v2os.migrate import cache
+from v2os.db.profiler import QueryCounter
+from v2os.migrate.builder import KVMInstance, Nova
+from v2os.migrate.spec import MigrationSpec
+
+CONF = cfg.CONF
+
+HYPERVISOR = 'dx-tkvm00.dx'
+VLAN = 1220
+
+# NOTE(与plan和daemon一样启用引用数据缓存, 批量时flavor、网络等只在第一台
+#      读一次; 之后每台vm的语句数是固定的(分配ip、插入实例及其关联记录),
+#      增加的逐行查询会让每台的斜率超过预算.)
+SINGLE_BUDGET = 32
+PER_VM_BUDGET = 10
+BATCH_SIZE = 100
+
+TMPDIR = None
+
+
+def setUpModule():
+    global TMPDIR
+    TMPDIR = tempfile.mkdtemp(prefix='v2os-test-')
+    CONF([], project='v2os', default_config_files=[])
+    options.set_defaults(CONF, connection='sqlite:///%s/nova.db' % TMPDIR)
+    CONF.set_override('reference_cache_ttl', 3600)
+
+    from osmo.db import get_engine, get_session
+    objects.BASE.metadata.create_all(get_engine())
+    seed(get_session())
+
+
+def tearDownModule():
+    CONF.clear_override('reference_cache_ttl')
+    shutil.rmtree(TMPDIR, True)
+
+
+def seed(session):
+    """The reference rows the plan reads: flavor, zone, network, fixed ips,
+    compute node, key pair and security group.
+    """
+    now = datetime.datetime.now()
+    with session.begin():
+        session.add(objects.KeyPair(name='admin', user_id='u1',
+                                    fingerprint='f', public_key='ssh-rsa x',
+                                    deleted=0))
+        session.add(objects.InstanceTypes(
+            id=1, name='centos-6.9_4_4_150', memory_mb=4096, vcpus=4,
+            root_gb=150, ephemeral_gb=0, flavorid='f1', swap=0,
+            rxtx_factor=1.0, disabled=False, is_public=True, created_at=now,
+            deleted=0))
+        session.add(objects.Aggregate(id=1, name='zone1', deleted=0))
+        session.add(objects.AggregateHost(aggregate_id=1, host=HYPERVISOR,
+                                          deleted=0))
+        session.add(objects.SecurityGroup(id=1, name='default', deleted=0))
+        session.add(objects.Network(
+            id=1, vlan=VLAN, bridge='br%d' % VLAN, label='net',
+            cidr='10.12.28.0/22', netmask='255.255.252.0',
+            gateway='10.12.28.1', dhcp_server='10.12.28.2',
+            dhcp_start='10.12.28.4', multi_host=False, uuid='n1', deleted=0))
+        for i in range(4, 4 + BATCH_SIZE * 2 + 2):
+            session.add(objects.FixedIp(
+                address='10.12.%d.%d' % (28 + i // 256, i % 256),
+                network_id=1, reserved=False, allocated=False, leased=False,
+                deleted=0, updated_at=now))
+        session.add(objects.ComputeNode(
+            id=1, host=HYPERVISOR, hypervisor_hostname=HYPERVISOR,
+            vcpus=4000, memory_mb=4096000, local_gb=400000, vcpus_used=0,
+            memory_mb_used=0, local_gb_used=0, free_ram_mb=4096000,
+            free_disk_gb=400000, running_vms=0, hypervisor_type='QEMU',
+            hypervisor_version=1, cpu_info='{}', host_ip='127.0.0.1',
+            deleted=0, updated_at=now))
+
+
+def builders(prefix, count):
+    return [KVMInstance(MigrationSpec(
+        hostname='%s%03d.yy' % (prefix, i), hypervisor=HYPERVISOR,
+        vlan=VLAN, user_id='u1', tenant_id='p1', image_ref='img1'),
+        journal='') for i in range(count)]
+
+
+class QueryBudgetTest(unittest.TestCase):
+
+    def plan(self, batch):
+        from osmo.db import get_engine, get_session
+
+        cache.clear()
+        with QueryCounter(get_engine()) as counter:
+            Nova().plan(get_session(), batch)
+        return counter
+
+    def test_single_vm(self):
+        counter = self.plan(builders('single', 1))
+        counter.check_budget(statements=SINGLE_BUDGET)
+
+    def test_statements_per_vm(self):
+        single = self.plan(builders('first', 1)).total.statements
+        batch = self.plan(builders('batch', BATCH_SIZE)).total.statements
+        self.assertLessEqual(float(batch - single) / (BATCH_SIZE - 1),
+                             PER_VM_BUDGET)
+
+
+class QueryCounterTest(unittest.TestCase):
+
+    def test_steps_counted_per_thread(self):
+        engine = sqlalchemy.create_engine('sqlite://')
+        logger = logging.getLogger('v2os.tests')
+        started = threading.Event()
+        logged = threading.Event()
+
+        def execute(count):
+            for _ in range(count):
+                engine.execute('SELECT 1')
+
+        def first():
+            started.wait()
+            execute(11)
+            logger.info('step1 done')
+            logged.set()
+
+        def second():
+            # NOTE(另一个线程打印step1时这里已有未归属的语句.)
+            execute(5)
+            started.set()
+            logged.wait()
+            execute(17)
+            logger.info('step2 done')
+
+        with QueryCounter(engine) as counter:
+            threads = [threading.Thread(target=first),
+                       threading.Thread(target=second)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(counter.steps['step1'].statements, 11)
+        self.assertEqual(counter.steps['step2'].statements, 22)
+        self.assertNotIn('tail', counter.steps)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+"""Distribute an image to a swarm of local peers: each peer is a fetch.py
+process of this machine(l2.LocalRPC) with a port and dst of its own, the
+origin a fetch.PeerServer of the test.
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+import socket
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+
+from v2os.disk import fetch
+from v2os.migrate.l2 import LocalRPC
+from v2os.migrate.spec import MigrationSpec
+from v2os.migrate.swarm import Swarm
+
+PEERS = 6
+CHUNK_MB = 1
+
+
+def free_port():
+    sock = socket.socket()
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def sha1(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class SwarmTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='v2os-test-')
+        self.image = os.path.join(self.tmpdir, 'origin.img')
+        # NOTE(最后一块不足chunk大小, 中间有全0的块.)
+        with open(self.image, 'wb') as f:
+            f.write(os.urandom(3 << 20) + b'\0' * (2 << 20) +
+                    os.urandom((1 << 20) + 4321))
+        handler = type('Handler', (fetch.PeerHandler,), {'dst': self.image})
+        self.origin = fetch.PeerServer(('127.0.0.1', 0), handler)
+        thread = threading.Thread(target=self.origin.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d/' % self.origin.server_address[1]
+
+    def tearDown(self):
+        self.origin.shutdown()
+        self.origin.server_close()
+        shutil.rmtree(self.tmpdir, True)
+
+    def test_distribute(self):
+        peers = []
+        for i in range(PEERS):
+            dst = os.path.join(self.tmpdir, 'peer%d' % i, 'base')
+            os.makedirs(os.path.dirname(dst))
+            peers.append({'host': 'peer%d' % i, 'ip': '127.0.0.1',
+                          'port': free_port(), 'dst': dst})
+        rpc = LocalRPC(MigrationSpec(remote_python=sys.executable))
+        result = Swarm(rpc, self.url, peers, chunk_mb=CHUNK_MB).run()
+
+        chunk = CHUNK_MB << 20
+        chunks = (os.path.getsize(self.image) + chunk - 1) // chunk
+        self.assertEqual(result['failed'], {})
+        self.assertEqual(result['chunks'], chunks)
+        self.assertEqual(result['origin_pulls'], chunks)
+        self.assertEqual(result['peer_pulls'], chunks * (PEERS - 1))
+        expected = sha1(self.image)
+        for peer in peers:
+            self.assertEqual(sha1(peer['dst']), expected)
+            self.assertFalse(os.path.exists('%s.part' % peer['dst']))
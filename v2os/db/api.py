@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+import time
+import logging
+
+from oslo_config import cfg
+from oslo_db import options
+from osmo.db import get_engine, get_session
+
+LOG = logging.getLogger(__name__)
+
+CONF = cfg.CONF
+
+database_opts = [
+    cfg.IntOpt('slave_max_lag', default=30,
+               help='max replication lag(seconds) of the slave database, '
+                    'reference reads fall back to the master beyond it.'),
+    cfg.IntOpt('slave_check_interval', default=60,
+               help='interval(seconds) between slave lag checks.'),
+]
+
+# NOTE(slave_connection由oslo_db提供, 这里提前注册以便读取和在-h中展示.)
+CONF.register_opts(options.database_opts, 'database')
+CONF.register_opts(database_opts, 'database')
+
+_SLAVE_STATE = {'checked_at': 0, 'usable': False}
+
+
+def get_slave_lag():
+    """Return the replication lag(seconds) of the slave database.
+
+    Only mysql reports it, other backends(such as sqlite in tests) are
+    considered in sync. None means replication is broken.
+    """
+    engine = get_engine(use_slave=True)
+    if engine.dialect.name != 'mysql':
+        return 0
+    row = engine.execute('SHOW SLAVE STATUS').first()
+    if row is None:
+        return 0
+    return row['Seconds_Behind_Master']
+
+
+def slave_usable():
+    """Check(at most once per interval) whether the slave can serve reads.
+    """
+    now = time.time()
+    if now - _SLAVE_STATE['checked_at'] < CONF.database.slave_check_interval:
+        return _SLAVE_STATE['usable']
+
+    try:
+        lag = get_slave_lag()
+    except Exception as _ex:
+        LOG.warning('Check slave database lag failed: %s' % str(_ex))
+        lag = None
+
+    usable = lag is not None and lag <= CONF.database.slave_max_lag
+    if not usable:
+        LOG.warning('Slave database lag: %s exceeds %ss, read from master.'
+                    % (lag, CONF.database.slave_max_lag))
+    _SLAVE_STATE.update(checked_at=now, usable=usable)
+    return usable
+
+
+def get_reader_session(session=None):
+    """Return a session for reference data reads.
+
+    The reads(flavor, aggregate, keypair, network, compute node...) go to
+    the slave database if `slave_connection` is configured and it is not
+    lagging, otherwise to `session`, the caller's master session, so they
+    run in its transaction on its connection; a new master session only
+    when the caller has none. Allocation and write paths must keep using
+    the master session.
+    """
+    if CONF.database.slave_connection and slave_usable():
+        return get_session(use_slave=True)
+    if session is not None:
+        return session
+    return get_session()
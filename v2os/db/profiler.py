@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+import re
+import time
+import logging
+import threading
+import collections
+
+from osmo.db import get_engine
+from sqlalchemy import event
+
+LOG = logging.getLogger(__name__)
+
+# NOTE(InstanceManager/L3Manager/LibvirtManager在每步完成后打印
+#      `stepN ...`日志, 同一线程两条step日志之间执行的sql都算到后一步上.)
+STEP_PATTERN = re.compile(r'^step(\d+) ')
+
+
+class QueryStats:
+
+    def __init__(self):
+        self.statements = 0
+        self.rows = 0
+        self.elapsed = 0.0
+
+    def add(self, other):
+        self.statements += other.statements
+        self.rows += other.rows
+        self.elapsed += other.elapsed
+
+    def clear(self):
+        self.statements = 0
+        self.rows = 0
+        self.elapsed = 0.0
+
+    def __repr__(self):
+        return '%d statements, %d rows, %.3fs' % (
+            self.statements, self.rows, self.elapsed)
+
+
+class QueryCounter(logging.Handler):
+    """Count the sql statements, rows and time spent in each pipeline step.
+
+    usage:
+
+        with QueryCounter() as counter:
+            nova.constuct(KVMInstance(spec))
+        counter.check_budget(statements=40)
+        counter.steps['step3'].statements
+
+    Rows are the rowcount reported by the DBAPI cursor, sqlite3 does not
+    report it for SELECT statements. Statements are pending per thread
+    until that thread logs a step, so the steps of vms built by parallel
+    workers(--batch_file) are counted apart. Statements issued after the
+    last step log are accounted to `tail`.
+    """
+
+    def __init__(self, engine=None, logger='v2os'):
+        super(QueryCounter, self).__init__(level=logging.INFO)
+        self.engine = engine
+        self.logger = logging.getLogger(logger)
+        self.logger_level = None
+        self.stats_lock = threading.Lock()
+        self.local = threading.local()
+        self.steps = collections.OrderedDict()
+        self.pendings = []
+
+    def __enter__(self):
+        if self.engine is None:
+            self.engine = get_engine()
+        event.listen(self.engine, 'before_cursor_execute', self.before)
+        event.listen(self.engine, 'after_cursor_execute', self.after)
+
+        # NOTE(低于INFO级别时step日志不会产生, 需临时调低日志级别.)
+        if self.logger.getEffectiveLevel() > logging.INFO:
+            self.logger_level = self.logger.level
+            self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        event.remove(self.engine, 'before_cursor_execute', self.before)
+        event.remove(self.engine, 'after_cursor_execute', self.after)
+
+        self.logger.removeHandler(self)
+        if self.logger_level is not None:
+            self.logger.setLevel(self.logger_level)
+            self.logger_level = None
+
+        with self.stats_lock:
+            for pending in self.pendings:
+                if pending.statements:
+                    self.steps.setdefault('tail', QueryStats()).add(pending)
+                    pending.clear()
+
+    @property
+    def pending(self):
+        """Statistics of the current thread since its last step log.
+        """
+        pending = getattr(self.local, 'pending', None)
+        if pending is None:
+            pending = self.local.pending = QueryStats()
+            with self.stats_lock:
+                self.pendings.append(pending)
+        return pending
+
+    def before(self, conn, cursor, statement, parameters, context,
+               executemany):
+        self.local.start = time.time()
+
+    def after(self, conn, cursor, statement, parameters, context,
+              executemany):
+        elapsed = time.time() - getattr(self.local, 'start', time.time())
+        pending = self.pending
+        with self.stats_lock:
+            pending.statements += 1
+            pending.rows += max(cursor.rowcount, 0)
+            pending.elapsed += elapsed
+
+    def emit(self, record):
+        match = STEP_PATTERN.match(record.getMessage())
+        if not match:
+            return
+        pending = self.pending
+        with self.stats_lock:
+            step = 'step%s' % match.group(1)
+            self.steps.setdefault(step, QueryStats()).add(pending)
+            pending.clear()
+
+    @property
+    def total(self):
+        total = QueryStats()
+        with self.stats_lock:
+            for stats in self.steps.values():
+                total.add(stats)
+            for pending in self.pendings:
+                total.add(pending)
+        return total
+
+    def report(self):
+        """Log the per step statistics.
+        """
+        for step, stats in self.steps.items():
+            LOG.info('Query stats %s: %s' % (step, stats))
+        LOG.info('Query stats total: %s' % self.total)
+
+    def check_budget(self, statements=None, rows=None, step=None):
+        """Raise AssertionError if the statements/rows exceed the budget.
+
+        The budget applies to the whole run, or to one step if given.
+        """
+        stats = self.total if step is None else self.steps.get(
+            step, QueryStats())
+        name = step or 'total'
+        if statements is not None and stats.statements > statements:
+            raise AssertionError('%s issued %d statements, budget is %d: %s'
+                                 % (name, stats.statements, statements,
+                                    dict(self.steps)))
+        if rows is not None and stats.rows > rows:
+            raise AssertionError('%s touched %d rows, budget is %d: %s'
+                                 % (name, stats.rows, rows, dict(self.steps)))
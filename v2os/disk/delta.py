@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+"""Block level delta sync of a disk file between two hosts.
+
+It runs on the source host and the hypervisor(RPC.delta_sync sends this
+file to the remote python), so it uses the standard library only and
+runs on python 2.7/3.
+
+    hash  <path> --block-kb 4096 --workers 4
+          print {"exists": .., "size": .., "block": .., "hashes": [sha1
+          of each block]},
+          the blocks are hashed by `workers` threads, blocks in holes are
+          not read and all-zero blocks are not hashed. A missing file has
+          no blocks.
+
+    read  <path> --block-kb 4096 --ranges 0-3,7
+          write the blocks of the ranges to stdout, in order.
+
+    write <path> --block-kb 4096 --ranges 0-3,7 --size <bytes>
+          [--zeros 8-9]
+          write the blocks read from stdin at their offsets, their zero
+          ranges and the blocks of --zeros are punched as holes, then set
+          the file size and sync it. The file and its directory are
+          created when missing.
+
+With --encoding zlib/lzma(same on both ends) each block is sent as a
+frame: codec, raw length, payload length, crc32 of the raw data, then
+the payload. Blocks are compressed by a pool of --procs processes on the
+sender and decompressed by a pool on the receiver, which checks the
+crc32. A block that does not compress below 90% is sent raw.
+"""
+
+import os
+import sys
+import json
+import zlib
+import errno
+import struct
+import hashlib
+import argparse
+import threading
+import multiprocessing
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    from v2os.disk import zero
+except ImportError:
+    import zero
+
+REQUIRES = (zero,)
+
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+BUFFER = 1024 * 1024
+
+RAW, ZLIB, LZMA = 0, 1, 2
+CODECS = {'none': RAW, 'zlib': ZLIB, 'lzma': LZMA}
+FRAME = struct.Struct('>BIII')
+RATIO = 0.9
+
+if hasattr(sys.stdout, 'buffer'):
+    STDIN, STDOUT = sys.stdin.buffer, sys.stdout.buffer
+else:
+    STDIN, STDOUT = sys.stdin, sys.stdout
+
+
+def parse_ranges(text):
+    """'0-3,7' -> [0, 1, 2, 3, 7]
+    """
+    blocks = []
+    for item in text.split(','):
+        if not item:
+            continue
+        if '-' in item:
+            start, end = item.split('-')
+            blocks.extend(range(int(start), int(end) + 1))
+        else:
+            blocks.append(int(item))
+    return blocks
+
+
+def format_ranges(blocks):
+    """[0, 1, 2, 3, 7] -> '0-3,7'
+    """
+    runs = []
+    for index in blocks:
+        if runs and index == runs[-1][1] + 1:
+            runs[-1][1] = index
+        else:
+            runs.append([index, index])
+    return ','.join(str(start) if start == end else '%d-%d' % (start, end)
+                    for start, end in runs)
+
+
+def data_blocks(fd, size, block):
+    """Return the indexes of the blocks holding allocated data.
+    """
+    blocks = set()
+    pos = 0
+    while pos < size:
+        try:
+            start = os.lseek(fd, pos, SEEK_DATA)
+        except OSError as _ex:
+            if _ex.errno == errno.ENXIO:
+                break
+            if _ex.errno == errno.EINVAL and pos == 0:
+                return set(range((size + block - 1) // block))
+            raise
+        end = min(os.lseek(fd, start, SEEK_HOLE), size)
+        blocks.update(range(start // block, (end - 1) // block + 1))
+        pos = end
+    return blocks
+
+
+def read_block(fd, index, block):
+    os.lseek(fd, index * block, os.SEEK_SET)
+    chunks = []
+    left = block
+    while left > 0:
+        data = os.read(fd, min(BUFFER, left))
+        if not data:
+            break
+        chunks.append(data)
+        left -= len(data)
+    return b''.join(chunks)
+
+
+def hash_file(path, block, workers):
+    if not os.path.exists(path):
+        return {'exists': False, 'size': 0, 'block': block, 'hashes': []}
+
+    size = os.path.getsize(path)
+    count = (size + block - 1) // block
+    hashes = [None] * count
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        allocated = data_blocks(fd, size, block)
+    finally:
+        os.close(fd)
+
+    # NOTE(空洞里的块不读盘, 直接用全0块的hash; 最后一块可能不满.)
+    full = hashlib.sha1(b'\0' * block).hexdigest()
+    last = size - (count - 1) * block if count else 0
+    tail = hashlib.sha1(b'\0' * last).hexdigest()
+
+    def zero_hash(index):
+        return full if index < count - 1 or last == block else tail
+
+    for index in range(count):
+        if index not in allocated:
+            hashes[index] = zero_hash(index)
+
+    pending = [i for i in range(count) if i in allocated]
+    lock = threading.Lock()
+    errors = []
+
+    def worker():
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            while True:
+                with lock:
+                    if not pending or errors:
+                        return
+                    index = pending.pop()
+                data = read_block(fd, index, block)
+                # NOTE(厚置备磁盘已分配的全0块比较即可, 不算sha1.)
+                if zero.is_zero(data):
+                    hashes[index] = zero_hash(index)
+                else:
+                    hashes[index] = hashlib.sha1(data).hexdigest()
+        except Exception as _ex:
+            errors.append(_ex)
+        finally:
+            os.close(fd)
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(max(1, workers))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return {'exists': True, 'size': size, 'block': block, 'hashes': hashes}
+
+
+def encode(args):
+    """Return the frame of a block, raw when it does not compress.
+    """
+    codec, data = args
+    crc = zlib.crc32(data) & 0xffffffff
+    payload = data
+    if codec == ZLIB:
+        payload = zlib.compress(data, 1)
+    elif codec == LZMA:
+        payload = lzma.compress(data, preset=0)
+    if len(payload) >= len(data) * RATIO:
+        codec, payload = RAW, data
+    return FRAME.pack(codec, len(data), len(payload), crc) + payload
+
+
+def decode(args):
+    codec, length, crc, payload = args
+    data = payload
+    if codec == ZLIB:
+        data = zlib.decompress(payload)
+    elif codec == LZMA:
+        data = lzma.decompress(payload)
+    if len(data) != length or zlib.crc32(data) & 0xffffffff != crc:
+        raise IOError('frame checksum mismatch')
+    return data
+
+
+def start_pool(codec, procs):
+    if codec == LZMA and lzma is None:
+        raise IOError('lzma is not available')
+    if codec == RAW or procs <= 1:
+        return None
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork').Pool(procs)
+    return multiprocessing.Pool(procs)
+
+
+def batches(blocks, size):
+    for i in range(0, len(blocks), size):
+        yield blocks[i:i + size]
+
+
+def read_exact(length):
+    chunks = []
+    while length > 0:
+        data = STDIN.read(min(BUFFER, length))
+        if not data:
+            raise IOError('unexpected end of stream')
+        chunks.append(data)
+        length -= len(data)
+    return b''.join(chunks)
+
+
+def read_blocks(path, block, blocks, codec=RAW, procs=1):
+    pool = start_pool(codec, procs)
+    mapper = pool.map if pool is not None else map
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        # NOTE(按批读取和压缩, 内存中最多2*procs个块.)
+        for batch in batches(blocks, max(1, procs) * 2):
+            datas = [read_block(fd, index, block) for index in batch]
+            if codec != RAW:
+                datas = mapper(encode, [(codec, data) for data in datas])
+            for data in datas:
+                STDOUT.write(data)
+        STDOUT.flush()
+    finally:
+        os.close(fd)
+        if pool is not None:
+            pool.close()
+
+
+def punch_blocks(fd, block, blocks, size):
+    """Make the blocks holes, zeros written where punching is not
+    supported, return the zero bytes.
+    """
+    zeros = 0
+    for index in blocks:
+        offset = index * block
+        length = min(block, size - offset)
+        if not zero.punch_hole(fd, offset, length):
+            os.lseek(fd, offset, os.SEEK_SET)
+            os.write(fd, b'\0' * length)
+        zeros += length
+    return zeros
+
+
+def write_blocks(path, block, blocks, size, codec=RAW, procs=1, zeros=()):
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    pool = start_pool(codec, procs)
+    mapper = pool.map if pool is not None else map
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+    written = wire = 0
+    try:
+        empty = punch_blocks(fd, block, zeros, size)
+        for batch in batches(blocks, max(1, procs) * 2):
+            lengths = [min(block, size - index * block) for index in batch]
+            if codec == RAW:
+                datas = [read_exact(length) for length in lengths]
+                wire += sum(lengths)
+            else:
+                frames = []
+                for length in lengths:
+                    kind, raw, count, crc = FRAME.unpack(
+                        read_exact(FRAME.size))
+                    if raw != length:
+                        raise IOError('frame length %d, expect %d'
+                                      % (raw, length))
+                    frames.append((kind, raw, crc, read_exact(count)))
+                    wire += FRAME.size + count
+                datas = mapper(decode, frames)
+            for index, data in zip(batch, datas):
+                count = zero.write_sparse(fd, index * block, data)
+                written += len(data) - count
+                empty += count
+        os.ftruncate(fd, size)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+        if pool is not None:
+            pool.close()
+    return {'path': path, 'size': size, 'blocks': len(blocks),
+            'written': written, 'wire': wire, 'zero': empty}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='delta.py')
+    parser.add_argument('mode', choices=['hash', 'read', 'write'])
+    parser.add_argument('path')
+    parser.add_argument('--block-kb', type=int, default=4096)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--ranges', default='')
+    parser.add_argument('--size', type=int, default=0)
+    parser.add_argument('--zeros', default='')
+    parser.add_argument('--encoding', choices=sorted(CODECS), default='none')
+    parser.add_argument('--procs', type=int, default=4)
+    args = parser.parse_args(argv[1:])
+    block = args.block_kb * 1024
+    codec = CODECS[args.encoding]
+
+    if args.mode == 'hash':
+        print(json.dumps(hash_file(args.path, block, args.workers)))
+    elif args.mode == 'read':
+        read_blocks(args.path, block, parse_ranges(args.ranges), codec,
+                    args.procs)
+    else:
+        result = write_blocks(args.path, block, parse_ranges(args.ranges),
+                              args.size, codec, args.procs,
+                              parse_ranges(args.zeros))
+        print(json.dumps(result, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
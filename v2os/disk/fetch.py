@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+"""Pull a disk over http(s) into a file on the hypervisor, with parallel
+range requests, such as from the vcenter datastore:
+
+    https://<vcenter>/folder/<vm>/<vm>-flat.vmdk?dcPath=<dc>&dsName=<ds>
+
+The -flat.vmdk is raw data: a vm migrated from it has source_format=raw,
+the pulled file is converted to qcow2(qcow2.py --raw) afterwards.
+
+It runs on the hypervisor(RPC.run_script sends this file to the remote
+python), so it uses the standard library only and runs on python 2.7/3.
+
+    python - <url> <dst> --connections 8 --chunk-mb 64 < fetch.py
+
+The disk is split in fixed size chunks, fetched by `connections` threads
+into a preallocated sparse <dst>.part file. Every chunk synced to disk is
+appended to the <dst>.manifest, an interrupted pull started again with
+the same url resumes with the chunks missing from the manifest. The part
+file is renamed to <dst> when complete.
+
+Basic auth is read from the V2OS_FETCH_AUTH environment(user:password),
+so it does not show in the process list. Zero ranges of the data(thick
+disks) are punched instead of written. Prints the size, chunks, resumed
+chunks, zero bytes and throughput as json.
+
+The peer to peer distribution(v2os.migrate.swarm) runs it with:
+
+    --probe          print the size, validator and range support of the url.
+    --serve <port>   print the chunks already held, then serve the file(or
+                     its part file) to the other peers with range requests
+                     until stdin is closed.
+    --chunks 3,7     pull only these chunks, from --peer <url> instead of
+                     the url when given; the part file is renamed to <dst>
+                     once every chunk is there.
+"""
+
+import os
+import sys
+import ssl
+import json
+import time
+import base64
+import argparse
+import threading
+
+try:
+    from urllib.request import Request, urlopen
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from urllib2 import Request, urlopen
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+try:
+    from v2os.disk import zero
+except ImportError:
+    import zero
+
+REQUIRES = (zero,)
+
+BUFFER = 1024 * 1024
+RETRIES = 3
+
+
+class Source(object):
+
+    def __init__(self, url, insecure=False, auth=None):
+        self.url = url
+        self.context = None
+        if insecure and hasattr(ssl, '_create_unverified_context'):
+            # NOTE(vcenter一般是自签名证书.)
+            self.context = ssl._create_unverified_context()
+        self.auth = None
+        if auth:
+            token = base64.b64encode(auth.encode('utf-8')).decode('ascii')
+            self.auth = 'Basic %s' % token
+
+    def open(self, start=None, end=None):
+        request = Request(self.url)
+        if self.auth:
+            request.add_header('Authorization', self.auth)
+        if start is not None:
+            request.add_header('Range', 'bytes=%d-%d' % (start, end - 1))
+        if self.context is not None:
+            return urlopen(request, timeout=60, context=self.context)
+        return urlopen(request, timeout=60)
+
+    def probe(self):
+        """Return (size, validator, whether range requests work).
+        """
+        response = self.open(0, 1)
+        try:
+            headers = response.info()
+            validator = headers.get('ETag') or headers.get('Last-Modified')
+            content_range = headers.get('Content-Range')
+            if response.getcode() == 206 and content_range:
+                return int(content_range.split('/')[-1]), validator, True
+            return int(headers.get('Content-Length')), validator, False
+        finally:
+            response.close()
+
+
+class Manifest(object):
+    """Chunks of the part file already synced to disk.
+
+    First line is the header(url, size, chunk, validator), then one line
+    per finished chunk index.
+    """
+
+    def __init__(self, path, header):
+        self.path = path
+        self.header = header
+        self.lock = threading.Lock()
+        self.done = self.load()
+        mode = 'a' if self.done is not None else 'w'
+        self.file = open(path, mode)
+        if self.done is None:
+            self.done = set()
+            self.file.write(json.dumps(header, sort_keys=True) + '\n')
+            self.sync()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            lines = f.read().splitlines()
+        try:
+            header = json.loads(lines[0])
+        except (IndexError, ValueError):
+            return None
+        if header != self.header:
+            return None
+        # NOTE(最后一行可能只写了一半, 只认完整的行.)
+        return set(int(line) for line in lines[1:] if line.isdigit())
+
+    def add(self, index):
+        with self.lock:
+            self.file.write('%d\n' % index)
+            self.sync()
+            self.done.add(index)
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+def fetch_chunk(source, path, index, start, end):
+    """Write [start, end) of the source at the same offset of the file,
+    return the zero bytes punched.
+    """
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        for retry in range(RETRIES):
+            try:
+                response = source.open(start, end)
+                if start is not None and response.getcode() != 206:
+                    raise IOError('range request not supported')
+                offset = start or 0
+                pos = offset
+                zeros = 0
+                while True:
+                    data = response.read(BUFFER)
+                    if not data:
+                        break
+                    zeros += zero.write_sparse(fd, pos, data)
+                    pos += len(data)
+                response.close()
+                if end is not None and pos != end:
+                    raise IOError('chunk %d short read: %d/%d'
+                                  % (index, pos - offset, end - offset))
+                os.fdatasync(fd)
+                return zeros
+            except (IOError, OSError):
+                if retry == RETRIES - 1:
+                    raise
+                time.sleep(2 ** retry)
+    finally:
+        os.close(fd)
+
+
+def fetch(url, dst, connections=8, chunk_mb=64, insecure=False, auth=None):
+    start_time = time.time()
+    source = Source(url, insecure, auth)
+    size, validator, ranged = source.probe()
+    chunk = chunk_mb * 1024 * 1024 if ranged else max(size, 1)
+    count = (size + chunk - 1) // chunk
+
+    part = '%s.part' % dst
+    header = {'url': url, 'size': size, 'chunk': chunk,
+              'validator': validator}
+    manifest_path = '%s.manifest' % dst
+    if not os.path.exists(part) and os.path.exists(manifest_path):
+        os.unlink(manifest_path)
+    manifest = Manifest(manifest_path, header)
+    resumed = len(manifest.done)
+
+    fd = os.open(part, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+    pending = [i for i in range(count) if i not in manifest.done]
+    lock = threading.Lock()
+    errors = []
+    zeros = []
+
+    def worker():
+        while True:
+            with lock:
+                if not pending or errors:
+                    return
+                index = pending.pop(0)
+            begin = index * chunk
+            end = min(begin + chunk, size) if ranged else None
+            try:
+                zeros.append(fetch_chunk(source, part, index,
+                                         begin if ranged else None, end))
+                manifest.add(index)
+            except Exception as _ex:
+                with lock:
+                    errors.append('chunk %d: %s' % (index, _ex))
+                return
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(max(1, min(connections, len(pending))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    manifest.close()
+    if errors:
+        raise IOError('fetch %s failed, rerun to resume: %s'
+                      % (url, '; '.join(errors)))
+
+    os.rename(part, dst)
+    os.unlink(manifest.path)
+    elapsed = time.time() - start_time
+    fetched = size - min(resumed * chunk, size)
+    return {'url': url, 'dst': dst, 'size': size, 'chunks': count,
+            'resumed': resumed, 'connections': len(threads),
+            'ranged': ranged, 'zero': sum(zeros),
+            'elapsed': round(elapsed, 3),
+            'throughput_mb': round(fetched / max(elapsed, 0.001) / 1048576,
+                                   1)}
+
+
+def chunk_header(url, size, chunk_mb, validator):
+    """Manifest header of the chunks pulled for the swarm, the same on
+    every peer whichever peer served them.
+    """
+    return {'url': url, 'size': size, 'chunk': chunk_mb * 1024 * 1024,
+            'validator': validator}
+
+
+def held_chunks(url, dst, size, chunk_mb, validator):
+    """Return the indexes of the chunks already in <dst> or its part.
+    """
+    chunk = chunk_mb * 1024 * 1024
+    count = (size + chunk - 1) // chunk
+    if os.path.exists(dst):
+        return list(range(count))
+    if not os.path.exists('%s.part' % dst):
+        return []
+    manifest = Manifest('%s.manifest' % dst,
+                        chunk_header(url, size, chunk_mb, validator))
+    manifest.close()
+    return sorted(manifest.done)
+
+
+def fetch_chunks(url, dst, chunks, size, chunk_mb=64, validator=None,
+                 peer=None, insecure=False, auth=None):
+    """Pull the chunks from the url, or from the peer serving it.
+    """
+    start_time = time.time()
+    chunk = chunk_mb * 1024 * 1024
+    count = (size + chunk - 1) // chunk
+    source = Source(peer, insecure) if peer else Source(url, insecure, auth)
+    part = '%s.part' % dst
+    if not os.path.exists(part):
+        fd = os.open(part, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+    manifest = Manifest('%s.manifest' % dst,
+                        chunk_header(url, size, chunk_mb, validator))
+    zeros = 0
+    try:
+        for index in chunks:
+            if index in manifest.done:
+                continue
+            begin = index * chunk
+            zeros += fetch_chunk(source, part, index, begin,
+                                 min(begin + chunk, size))
+            manifest.add(index)
+    finally:
+        manifest.close()
+
+    complete = len(manifest.done) == count
+    if complete:
+        os.rename(part, dst)
+        os.unlink(manifest.path)
+    return {'dst': dst, 'chunks': len(chunks), 'held': len(manifest.done),
+            'complete': complete, 'zero': zeros,
+            'elapsed': round(time.time() - start_time, 3)}
+
+
+class PeerServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class PeerHandler(BaseHTTPRequestHandler):
+    """Serve byte ranges of <dst>, or of <dst>.part while pulling; only
+    chunks the coordinator knows are held are asked for.
+    """
+
+    dst = None
+
+    def do_GET(self):
+        path = self.dst if os.path.exists(self.dst) else '%s.part' % self.dst
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            self.send_error(404)
+            return
+        try:
+            size = os.fstat(f.fileno()).st_size
+            start, end = 0, size - 1
+            ranged = self.headers.get('Range', '').startswith('bytes=')
+            if ranged:
+                first, last = self.headers['Range'][6:].split('-')
+                start, end = int(first), min(int(last), size - 1)
+            self.send_response(206 if ranged else 200)
+            if ranged:
+                self.send_header('Content-Range',
+                                 'bytes %d-%d/%d' % (start, end, size))
+            self.send_header('Content-Length', str(end - start + 1))
+            self.end_headers()
+            f.seek(start)
+            left = end - start + 1
+            while left > 0:
+                data = f.read(min(BUFFER, left))
+                if not data:
+                    break
+                self.wfile.write(data)
+                left -= len(data)
+        finally:
+            f.close()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(url, dst, port, size, chunk_mb=64, validator=None):
+    held = held_chunks(url, dst, size, chunk_mb, validator)
+    handler = type('Handler', (PeerHandler,), {'dst': dst})
+    server = PeerServer(('', port), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    sys.stdout.write(json.dumps({'dst': dst, 'held': held}) + '\n')
+    sys.stdout.flush()
+    # NOTE(协调方关闭stdin(或ssh连接断开)时退出.)
+    while sys.stdin.read(1):
+        pass
+    server.shutdown()
+    server.server_close()
+    return {'dst': dst}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='fetch.py')
+    parser.add_argument('url')
+    parser.add_argument('dst')
+    parser.add_argument('--connections', type=int, default=8)
+    parser.add_argument('--chunk-mb', type=int, default=64)
+    parser.add_argument('--insecure', action='store_true')
+    parser.add_argument('--probe', action='store_true')
+    parser.add_argument('--serve', type=int, default=0)
+    parser.add_argument('--chunks', default=None)
+    parser.add_argument('--peer', default=None)
+    parser.add_argument('--size', type=int, default=0)
+    parser.add_argument('--validator', default=None)
+    args = parser.parse_args(argv[1:])
+    auth = os.environ.get('V2OS_FETCH_AUTH')
+    if args.probe:
+        size, validator, ranged = Source(args.url, args.insecure,
+                                         auth).probe()
+        result = {'size': size, 'validator': validator, 'ranged': ranged}
+    elif args.serve:
+        result = serve(args.url, args.dst, args.serve, args.size,
+                       args.chunk_mb, args.validator)
+    elif args.chunks is not None:
+        chunks = [int(i) for i in args.chunks.split(',') if i]
+        result = fetch_chunks(args.url, args.dst, chunks, args.size,
+                              args.chunk_mb, args.validator, args.peer,
+                              args.insecure, auth)
+    else:
+        result = fetch(args.url, args.dst, args.connections, args.chunk_mb,
+                       args.insecure, auth)
+    print(json.dumps(result, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
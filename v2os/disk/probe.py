@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+"""Read the headers of disk images, without reading their data.
+
+It runs on the hypervisor or the source host(RPC.run_script sends this
+file to the remote python), so it uses the standard library only and
+runs on python 2.7/3.
+
+    python - <path|url> [<path|url> ..] [--insecure]
+
+Each image(a file, or an http(s) url read with range requests and the
+auth of V2OS_FETCH_AUTH) is read for its first 64K only, plus the
+backing file name when it lies beyond. Prints a json list, one item per
+image:
+
+    {"path": .., "exists": .., "format": "qcow2"/"vmdk"/"raw",
+     "file_size": .., "virtual_size": .., "cluster_size": .., "l1_size": ..,
+     "backing_file": .., "backing_format": .., "backing_chain": [{"path",
+     "exists", "format", "virtual_size"}, ..], "dangling": ..,
+     "errors": [..]}
+
+The backing chain of a file is followed on this host, a backing file
+name relative to the image directory as qemu does. Errors are header
+problems qemu would refuse or choke on: corrupt or encrypted images, an
+external data file, an L1 table too small for the virtual size or beyond
+the end of the file.
+"""
+
+import os
+import re
+import ssl
+import sys
+import json
+import base64
+import struct
+
+try:
+    from urllib.request import Request, urlopen
+except ImportError:
+    from urllib2 import Request, urlopen
+
+HEAD = 64 * 1024
+CHAIN = 16
+QCOW_MAGIC = b'QFI\xfb'
+QCOW_V2 = struct.Struct('>4sIQIIQIIQQIIQ')
+QCOW_V3 = struct.Struct('>QQQII')
+EXTENSION = struct.Struct('>II')
+EXT_BACKING_FORMAT = 0xE2792ACA
+INCOMPAT_CORRUPT = 1 << 1
+INCOMPAT_DATA_FILE = 1 << 2
+VMDK_MAGIC = b'KDMV'
+VMDK = struct.Struct('<4sIIQQ')
+VMDK_STREAM = (1 << 16) | (1 << 17)
+SECTOR = 512
+
+
+class Source(object):
+    """Ranged reads of a file or an url.
+    """
+
+    def __init__(self, src, insecure=False):
+        self.src = src
+        self.insecure = insecure
+        self.url = src.startswith(('http://', 'https://'))
+        self.size = None
+
+    def read(self, offset, length):
+        if not self.url:
+            with open(self.src, 'rb') as f:
+                self.size = os.fstat(f.fileno()).st_size
+                f.seek(offset)
+                return f.read(length)
+
+        request = Request(self.src)
+        request.add_header('Range', 'bytes=%d-%d'
+                           % (offset, offset + length - 1))
+        auth = os.environ.get('V2OS_FETCH_AUTH')
+        if auth:
+            token = base64.b64encode(auth.encode('utf-8')).decode('ascii')
+            request.add_header('Authorization', 'Basic %s' % token)
+        kwargs = {'timeout': 30}
+        if self.insecure and hasattr(ssl, '_create_unverified_context'):
+            kwargs['context'] = ssl._create_unverified_context()
+        try:
+            response = urlopen(request, **kwargs)
+        except Exception as _ex:
+            raise IOError('request %s failed: %s' % (self.src, _ex))
+        try:
+            found = re.match(r'bytes \d+-\d+/(\d+)',
+                             response.headers.get('Content-Range') or '')
+            if response.getcode() == 206 and found:
+                self.size = int(found.group(1))
+                return response.read(length)
+            # NOTE(不支持range时只读需要的部分, 之后的数据不下载.)
+            self.size = int(response.headers.get('Content-Length') or 0)
+            response.read(offset)
+            return response.read(length)
+        finally:
+            response.close()
+
+
+def parse_qcow2(source, head, info):
+    (_, version, backing_offset, backing_size, cluster_bits, size,
+     crypt_method, l1_size, l1_offset, _, _, _,
+     _) = QCOW_V2.unpack(head[:QCOW_V2.size])
+    info.update({'format': 'qcow2', 'version': version,
+                 'virtual_size': size, 'l1_size': l1_size})
+    errors = info['errors']
+    if version not in (2, 3):
+        errors.append('unsupported qcow2 version: %d' % version)
+        return
+    if not 9 <= cluster_bits <= 21:
+        errors.append('invalid cluster bits: %d' % cluster_bits)
+        return
+    cluster = 1 << cluster_bits
+    info['cluster_size'] = cluster
+
+    header_length = QCOW_V2.size
+    if version == 3:
+        incompatible, _, _, _, header_length = QCOW_V3.unpack(
+            head[QCOW_V2.size:QCOW_V2.size + QCOW_V3.size])
+        info['dirty'] = bool(incompatible & 1)
+        if incompatible & INCOMPAT_CORRUPT:
+            errors.append('image is marked corrupt')
+        if incompatible & INCOMPAT_DATA_FILE:
+            errors.append('image has an external data file')
+    if crypt_method:
+        errors.append('image is encrypted, method: %d' % crypt_method)
+
+    # NOTE(每个L2表映射cluster/8个cluster.)
+    need = -(-size // (cluster * (cluster // 8)))
+    if l1_size < need:
+        errors.append('l1 table of %d entries, %d needed for the size'
+                      % (l1_size, need))
+    if source.size is not None and l1_offset + l1_size * 8 > source.size:
+        errors.append('l1 table beyond the end of the file')
+
+    pos = header_length
+    while pos + EXTENSION.size <= min(len(head), cluster):
+        kind, length = EXTENSION.unpack(head[pos:pos + EXTENSION.size])
+        if kind == 0:
+            break
+        if kind == EXT_BACKING_FORMAT:
+            info['backing_format'] = head[pos + EXTENSION.size:
+                                          pos + EXTENSION.size + length]\
+                .decode('utf-8', 'replace')
+        pos += EXTENSION.size + (length + 7) // 8 * 8
+
+    if backing_offset:
+        if backing_offset + backing_size <= len(head):
+            name = head[backing_offset:backing_offset + backing_size]
+        else:
+            name = source.read(backing_offset, backing_size)
+        info['backing_file'] = name.decode('utf-8', 'replace')
+
+
+def parse_vmdk(head, info):
+    _, _, flags, capacity, grain = VMDK.unpack(head[:VMDK.size])
+    info.update({'format': 'vmdk', 'virtual_size': capacity * SECTOR,
+                 'cluster_size': grain * SECTOR,
+                 'stream_optimized': flags & VMDK_STREAM == VMDK_STREAM})
+
+
+def probe(src, insecure=False):
+    source = Source(src, insecure)
+    info = {'path': src, 'exists': False, 'format': None, 'file_size': None,
+            'virtual_size': None, 'cluster_size': None, 'l1_size': None,
+            'backing_file': None, 'backing_format': None,
+            'backing_chain': [], 'dangling': False, 'errors': []}
+    try:
+        head = source.read(0, HEAD)
+    except (IOError, OSError) as _ex:
+        if source.url:
+            info['errors'].append(str(_ex))
+        return info
+    info['exists'] = True
+    info['file_size'] = source.size
+    if head[:4] == QCOW_MAGIC and len(head) >= QCOW_V2.size + QCOW_V3.size:
+        parse_qcow2(source, head, info)
+    elif head[:4] == VMDK_MAGIC and len(head) >= VMDK.size:
+        parse_vmdk(head, info)
+    else:
+        info.update({'format': 'raw', 'virtual_size': source.size})
+    return info
+
+
+def backing_chain(info):
+    """Follow the backing files of a local image, return the chain and
+    whether it ends in a missing file.
+    """
+    chain = []
+    seen = set([os.path.realpath(info['path'])])
+    current = info
+    while current['backing_file'] and len(chain) < CHAIN:
+        path = os.path.join(os.path.dirname(current['path']),
+                            current['backing_file'])
+        if os.path.realpath(path) in seen:
+            info['errors'].append('backing chain loops at: %s' % path)
+            break
+        seen.add(os.path.realpath(path))
+        current = probe(path)
+        chain.append({'path': path, 'exists': current['exists'],
+                      'format': current['format'],
+                      'virtual_size': current['virtual_size']})
+        info['errors'].extend('%s: %s' % (path, error)
+                              for error in current['errors'])
+        if not current['exists']:
+            return chain, True
+    return chain, False
+
+
+def main(argv):
+    insecure = '--insecure' in argv
+    srcs = [arg for arg in argv[1:] if arg != '--insecure']
+    if not srcs:
+        sys.stderr.write('usage: probe.py <path|url> .. [--insecure]\n')
+        return 2
+    results = []
+    for src in srcs:
+        info = probe(src, insecure)
+        if info['backing_file'] and not src.startswith(('http://',
+                                                        'https://')):
+            info['backing_chain'], info['dangling'] = backing_chain(info)
+        results.append(info)
+    print(json.dumps(results, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+"""Streaming qcow2 writer, the instance disk made in one sequential pass.
+
+It runs on the hypervisor(RPC.run_script sends this file to the remote
+python), so it uses the standard library only and runs on python 2.7/3.
+
+    python vmdk.py <vmdk> | python qcow2.py - <dst> --cluster-kb 64
+
+It reads an extent stream(see vmdk.py: magic and virtual size, then
+offset, length and data of each extent, in offset order) and writes a
+qcow2(version 3, 16 bit refcounts) into <dst>.part, renamed to <dst>
+when complete:
+
+    cluster 0        header, written last
+    cluster 1..      L1 table, reserved first and written last
+    ...              data clusters, appended as the extents arrive; the
+                     L2 table of every 8192 clusters(512M) appended once
+                     the extents pass it
+    end              refcount blocks and refcount table
+
+All-zero clusters are never written, they stay unallocated and read as
+zero. Prints the size, clusters written and skipped, zero bytes and
+throughput as json.
+
+With --raw the src is a raw disk file instead(such as the -flat.vmdk of a
+vcenter or esxi vm), only its allocated extents are read:
+
+    python - <raw disk> <dst> --raw < qcow2.py
+"""
+
+import os
+import sys
+import json
+import time
+import struct
+import argparse
+
+try:
+    from v2os.disk import verify
+except ImportError:
+    import verify
+
+REQUIRES = (verify,)
+
+BUFFER = 1024 * 1024
+EXTENT_MAGIC = b'V2OSEXT1'
+EXTENT_HEADER = struct.Struct('>8sQ')
+EXTENT = struct.Struct('>QI')
+
+QCOW_MAGIC = b'QFI\xfb'
+HEADER = struct.Struct('>4sIQIIQIIQQIIQQQQII')
+COPIED = 1 << 63
+REFCOUNT_ORDER = 4
+
+if hasattr(sys.stdout, 'buffer'):
+    STDIN = sys.stdin.buffer
+else:
+    STDIN = sys.stdin
+
+
+def read_exact(stream, length):
+    chunks = []
+    while length > 0:
+        data = stream.read(length)
+        if not data:
+            raise IOError('unexpected end of extent stream')
+        chunks.append(data)
+        length -= len(data)
+    return b''.join(chunks)
+
+
+def read_extents(stream):
+    """Return the virtual size and an iterator of (offset, data).
+    """
+    head = read_exact(stream, EXTENT_HEADER.size)
+    magic, size = EXTENT_HEADER.unpack(head)
+    if magic != EXTENT_MAGIC:
+        raise IOError('not an extent stream')
+
+    def extents():
+        while True:
+            head = stream.read(EXTENT.size)
+            if not head:
+                return
+            if len(head) != EXTENT.size:
+                head += read_exact(stream, EXTENT.size - len(head))
+            offset, length = EXTENT.unpack(head)
+            yield offset, read_exact(stream, length)
+
+    return size, extents()
+
+
+def read_raw(path):
+    """Return the size of a raw disk file and an iterator of (offset, data)
+    of its allocated extents, holes are not read.
+    """
+    size = os.path.getsize(path)
+    ranges = verify.data_extents(path, size)
+
+    def extents():
+        with open(path, 'rb') as f:
+            for start, end in ranges:
+                f.seek(start)
+                pos = start
+                while pos < end:
+                    data = f.read(min(BUFFER, end - pos))
+                    if not data:
+                        raise IOError('raw disk truncated at: %d' % pos)
+                    yield pos, data
+                    pos += len(data)
+
+    return size, extents()
+
+
+class Writer(object):
+    """Append the clusters of the extents to a qcow2 file.
+
+    usage:
+
+        writer = Writer(f, size)
+        for offset, data in extents:
+            writer.write(offset, data)
+        writer.close()
+    """
+
+    def __init__(self, f, size, cluster_bits=16):
+        self.f = f
+        self.size = size
+        self.cluster_bits = cluster_bits
+        self.cluster = 1 << cluster_bits
+        self.zero = b'\0' * self.cluster
+        self.l2_entries = self.cluster // 8
+        self.l1_size = max(1, -(-size // (self.cluster * self.l2_entries)))
+        self.l1 = [0] * self.l1_size
+        self.l1_clusters = -(-self.l1_size * 8 // self.cluster)
+        self.next = (1 + self.l1_clusters) * self.cluster
+        self.l2_index = None
+        self.l2 = None
+        self.index = None
+        self.buffer = None
+        self.written = 0
+        self.skipped = 0
+        self.f.seek(self.next)
+
+    def write(self, offset, data):
+        """Write data at the virtual offset, after any earlier write.
+        """
+        if offset + len(data) > self.size:
+            raise IOError('extent at: %d beyond the size' % offset)
+        view = memoryview(data)
+        pos = 0
+        while pos < len(data):
+            index, skip = divmod(offset + pos, self.cluster)
+            if index != self.index:
+                if self.index is not None and index < self.index:
+                    raise IOError('extent at: %d out of order' % offset)
+                self.flush_cluster()
+                self.index = index
+                self.buffer = bytearray(self.cluster)
+            length = min(self.cluster - skip, len(data) - pos)
+            self.buffer[skip:skip + length] = view[pos:pos + length]
+            pos += length
+
+    def flush_cluster(self):
+        if self.index is None:
+            return
+        if self.buffer == self.zero:
+            self.skipped += 1
+        else:
+            l2_index, entry = divmod(self.index, self.l2_entries)
+            if l2_index != self.l2_index:
+                self.flush_l2()
+                self.l2_index = l2_index
+                self.l2 = [0] * self.l2_entries
+            self.l2[entry] = self.append(self.buffer) | COPIED
+            self.written += 1
+        self.index = None
+        self.buffer = None
+
+    def flush_l2(self):
+        if self.l2_index is None:
+            return
+        table = struct.pack('>%dQ' % self.l2_entries, *self.l2)
+        self.l1[self.l2_index] = self.append(table) | COPIED
+        self.l2_index = None
+        self.l2 = None
+
+    def append(self, data):
+        offset = self.next
+        self.f.write(data)
+        self.next += len(data)
+        return offset
+
+    def close(self):
+        """Write the last L2 table, the refcounts, the L1 table and the
+        header.
+        """
+        self.flush_cluster()
+        self.flush_l2()
+
+        # NOTE(所有cluster连续分配且引用计数都为1; 引用计数块和表本身
+        #      也要计数, 迭代到块数不再变化.)
+        used = self.next // self.cluster
+        per_block = self.cluster * 8 >> REFCOUNT_ORDER
+        blocks = table_clusters = 0
+        while True:
+            total = used + blocks + table_clusters
+            need_blocks = -(-total // per_block)
+            need_table = -(-need_blocks * 8 // self.cluster)
+            if (need_blocks, need_table) == (blocks, table_clusters):
+                break
+            blocks, table_clusters = need_blocks, need_table
+
+        table = []
+        for block in range(blocks):
+            first = block * per_block
+            count = max(0, min(per_block, total - first))
+            refcounts = struct.pack('>%dH' % count, *([1] * count))
+            table.append(self.append(refcounts + b'\0' * (
+                self.cluster - len(refcounts))))
+        table_offset = self.next
+        data = struct.pack('>%dQ' % len(table), *table)
+        self.append(data + b'\0' * (
+            table_clusters * self.cluster - len(data)))
+
+        header = HEADER.pack(QCOW_MAGIC, 3, 0, 0, self.cluster_bits,
+                             self.size, 0, self.l1_size, self.cluster,
+                             table_offset, table_clusters, 0, 0, 0, 0, 0,
+                             REFCOUNT_ORDER, HEADER.size)
+        self.f.seek(0)
+        # NOTE(header之后是header扩展的结束标记: type 0, length 0.)
+        self.f.write(header + b'\0' * 8)
+        self.f.seek(self.cluster)
+        self.f.write(struct.pack('>%dQ' % self.l1_size, *self.l1))
+        self.f.flush()
+        return {'size': self.size, 'cluster': self.cluster,
+                'written': self.written, 'skipped': self.skipped,
+                'file_size': self.next}
+
+
+def convert(src, dst, cluster_kb=64, raw=False):
+    start = time.time()
+    if cluster_kb & (cluster_kb - 1) or not 1 <= cluster_kb <= 2048:
+        raise IOError('cluster size must be a power of 2 from 1k to 2m')
+    if raw:
+        size, extents = read_raw(src)
+    else:
+        stream = STDIN if src == '-' else open(src, 'rb')
+        size, extents = read_extents(stream)
+    part = '%s.part' % dst
+    with open(part, 'wb') as f:
+        writer = Writer(f, size, (cluster_kb * 1024).bit_length() - 1)
+        for offset, data in extents:
+            writer.write(offset, data)
+        result = writer.close()
+        os.fsync(f.fileno())
+    os.rename(part, dst)
+    elapsed = time.time() - start
+    written = result['written'] * result['cluster']
+    result.update({'dst': dst, 'zero': result['skipped'] * result['cluster'],
+                   'elapsed': round(elapsed, 3),
+                   'throughput_mb': round(written / max(elapsed, 0.001) /
+                                          1048576, 1)})
+    return result
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='qcow2.py')
+    parser.add_argument('src')
+    parser.add_argument('dst')
+    parser.add_argument('--cluster-kb', type=int, default=64)
+    parser.add_argument('--raw', action='store_true')
+    args = parser.parse_args(argv[1:])
+    print(json.dumps(convert(args.src, args.dst, args.cluster_kb, args.raw),
+                     sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
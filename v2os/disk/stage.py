@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+"""Stage a disk file to another path on the hypervisor, such as the
+migrate source disk into the instance dir.
+
+It runs on the hypervisor(RPC.run_script sends this file to the remote
+python), so it uses the standard library only and runs on python 2.7/3.
+
+    python - /opt/migrate/disk /data/nova/instances/<uuid>/disk [--zeros]
+             [--verify --chunk-kb 65536 --workers 4]
+
+Strategies, the first one that works is used:
+
+    rename      same filesystem, only the metadata changes.
+    reflink     copy on write clone(FICLONE), btrfs or xfs(reflink=1).
+    sparse      copy only the allocated extents found with SEEK_DATA/
+                SEEK_HOLE, holes stay holes. The extents are copied in the
+                kernel with copy_file_range when it is available, with
+                read/write otherwise. With --zeros a fully allocated
+                source(eager zeroed thick disk) is read instead and its
+                zero ranges left as holes too, a thin one is still
+                copied with copy_file_range.
+
+The source is removed once the copy is synced, like mv. With --verify
+the sparse copy is compared chunk by chunk with the source first(see
+verify.py), on a mismatch the source is kept and the copy removed.
+Prints the strategy, size, bytes copied, zero bytes not written, the
+verification and throughput as json.
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import fcntl
+import argparse
+import ctypes
+import ctypes.util
+
+try:
+    from v2os.disk import verify, zero
+except ImportError:
+    import verify
+    import zero
+
+REQUIRES = (verify, zero)
+
+FICLONE = 0x40049409
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+CHUNK = 64 * 1024 * 1024
+BUFFER = 4 * 1024 * 1024
+
+# NOTE(这些错误表示文件系统或内核不支持, 换下一种方式.)
+UNSUPPORTED = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+               errno.ENOSYS, errno.EBADF)
+
+
+def try_rename(src, dst):
+    try:
+        os.rename(src, dst)
+        return True
+    except OSError as _ex:
+        if _ex.errno == errno.EXDEV:
+            return False
+        raise
+
+
+def try_reflink(src_fd, dst_fd):
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except (IOError, OSError) as _ex:
+        if _ex.errno in UNSUPPORTED:
+            return False
+        raise
+
+
+def extents(fd, size):
+    """Yield (start, end) of the allocated extents of the file.
+    """
+    pos = 0
+    while pos < size:
+        try:
+            start = os.lseek(fd, pos, SEEK_DATA)
+        except OSError as _ex:
+            if _ex.errno == errno.ENXIO:
+                return
+            if _ex.errno == errno.EINVAL and pos == 0:
+                # NOTE(文件系统不支持SEEK_DATA, 整个文件当作数据.)
+                yield 0, size
+                return
+            raise
+        end = min(os.lseek(fd, start, SEEK_HOLE), size)
+        yield start, end
+        pos = end
+
+
+def libc_copy_file_range():
+    """Return copy_file_range of glibc(2.27+) for python before 3.8.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = libc.copy_file_range
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_longlong),
+                     ctypes.c_int, ctypes.POINTER(ctypes.c_longlong),
+                     ctypes.c_size_t, ctypes.c_uint]
+    func.restype = ctypes.c_ssize_t
+
+    def copy_file_range(src_fd, dst_fd, count, offset_src, offset_dst):
+        off_in = ctypes.c_longlong(offset_src)
+        off_out = ctypes.c_longlong(offset_dst)
+        copied = func(src_fd, ctypes.byref(off_in), dst_fd,
+                      ctypes.byref(off_out), count, 0)
+        if copied < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+        return copied
+    return copy_file_range
+
+
+def copy_range(copy_file_range, src_fd, dst_fd, start, end):
+    """Copy [start, end) in the kernel, return the bytes copied.
+    """
+    pos = start
+    while pos < end:
+        copied = copy_file_range(src_fd, dst_fd, min(CHUNK, end - pos),
+                                 pos, pos)
+        if copied == 0:
+            break
+        pos += copied
+    return pos - start
+
+
+def read_write(src_fd, dst_fd, start, end):
+    """Copy [start, end) through a user space buffer, return the bytes
+    copied and the zero bytes left as holes.
+    """
+    pos = start
+    zeros = 0
+    os.lseek(src_fd, start, os.SEEK_SET)
+    while pos < end:
+        data = os.read(src_fd, min(BUFFER, end - pos))
+        if not data:
+            break
+        zeros += zero.write_sparse(dst_fd, pos, data, punch=False)
+        pos += len(data)
+    return pos - start, zeros
+
+
+def sparse_copy(src_fd, dst_fd, size, zeros=False):
+    """Copy the allocated extents, return the bytes copied and the zero
+    bytes left as holes.
+    """
+    os.ftruncate(dst_fd, size)
+    ranges = list(extents(src_fd, size))
+    # NOTE(只有全部分配的厚置备磁盘才读出来找全0区域, 精简磁盘的空洞
+    #      已经跳过, 用内核里的copy_file_range拷贝.)
+    thick = sum(end - start for start, end in ranges) >= size
+    copy_file_range = None
+    if not (zeros and thick):
+        copy_file_range = getattr(os, 'copy_file_range', None) or \
+            libc_copy_file_range()
+    copied = skipped = 0
+    for start, end in ranges:
+        if copy_file_range is not None:
+            try:
+                copied += copy_range(copy_file_range, src_fd, dst_fd,
+                                     start, end)
+                continue
+            except OSError as _ex:
+                # NOTE(3.x内核不支持跨文件系统的copy_file_range.)
+                if _ex.errno not in UNSUPPORTED:
+                    raise
+                copy_file_range = None
+                # NOTE(当前extent可能已拷贝一部分, 从头重拷这个extent.)
+        count, empty = read_write(src_fd, dst_fd, start, end)
+        copied += count - empty
+        skipped += empty
+    return copied, skipped
+
+
+def stage(src, dst, zeros=False, check=False, chunk=64 * 1024 * 1024,
+          workers=4):
+    start = time.time()
+    size = os.path.getsize(src)
+    result = {'src': src, 'dst': dst, 'size': size, 'copied': 0, 'zero': 0,
+              'verify': None}
+
+    if try_rename(src, dst):
+        result['strategy'] = 'rename'
+    else:
+        # NOTE(先写到临时文件, 同步后再改名, 中断时不会留下不完整的disk.)
+        part = '%s.part' % dst
+        src_fd = os.open(src, os.O_RDONLY)
+        dst_fd = os.open(part, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            if try_reflink(src_fd, dst_fd):
+                result['strategy'] = 'reflink'
+            else:
+                result['strategy'] = 'sparse'
+                result['copied'], result['zero'] = sparse_copy(
+                    src_fd, dst_fd, size, zeros)
+            os.fsync(dst_fd)
+        finally:
+            os.close(dst_fd)
+            os.close(src_fd)
+        # NOTE(rename和reflink不经过用户态拷贝, 只校验稀疏拷贝.)
+        if check and result['strategy'] == 'sparse':
+            result['verify'] = verify.compare(src, part, chunk, workers)
+            if not result['verify']['match']:
+                os.unlink(part)
+                raise IOError('staged disk differs from: %s at: %s'
+                              % (src, result['verify']['mismatches']))
+        os.rename(part, dst)
+        os.unlink(src)
+
+    elapsed = time.time() - start
+    result['elapsed'] = round(elapsed, 3)
+    result['throughput_mb'] = round(size / max(elapsed, 0.001) / 1048576, 1)
+    return result
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='stage.py')
+    parser.add_argument('src')
+    parser.add_argument('dst')
+    parser.add_argument('--zeros', action='store_true')
+    parser.add_argument('--verify', action='store_true')
+    parser.add_argument('--chunk-kb', type=int, default=65536)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args(argv[1:])
+    print(json.dumps(stage(args.src, args.dst, args.zeros, args.verify,
+                           args.chunk_kb * 1024, args.workers),
+                     sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+"""Chunked checksums of disk files, to verify a staged or synced disk
+where it is, without sending the data anywhere.
+
+It runs on the hypervisor(RPC.run_script sends this file to the remote
+python), so it uses the standard library only and runs on python 2.7/3.
+
+    digest  <path> --chunk-kb 65536 --workers 4
+            print {"exists": .., "size": .., "chunk": .., "digests": [sha1
+            of each chunk], "root": sha1 of the digests}.
+
+    compare <src> <dst> --chunk-kb 65536 --workers 4
+            digest both files at the same time, the chunks that differ are
+            digested again in 1M pieces; print {"match": .., "root": ..,
+            "mismatches": [[start, end], ..]}, root is of the src.
+
+The chunks are hashed by `workers` threads, each reading into its own
+reusable buffer; read and sha1 release the GIL, so the threads use
+several cores and the disk bandwidth is the limit. Chunks in holes are not
+read, and the page cache of the files is dropped first so the data is
+read back from the disk.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import errno
+import bisect
+import hashlib
+import argparse
+import threading
+
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+BUFFER = 1024 * 1024
+PIECE = 1024 * 1024
+NARROW = 16
+ZERO = b'\0' * BUFFER
+
+_zero_digests = {}
+
+
+def data_extents(path, size):
+    """Return the sorted (start, end) of the allocated extents.
+    """
+    result = []
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        pos = 0
+        while pos < size:
+            try:
+                start = os.lseek(fd, pos, SEEK_DATA)
+            except OSError as _ex:
+                if _ex.errno == errno.ENXIO:
+                    break
+                if _ex.errno == errno.EINVAL and pos == 0:
+                    return [(0, size)]
+                raise
+            end = min(os.lseek(fd, start, SEEK_HOLE), size)
+            result.append((start, end))
+            pos = end
+    finally:
+        os.close(fd)
+    return result
+
+
+def has_data(extents, start, end):
+    index = bisect.bisect_right(extents, (start, float('inf'))) - 1
+    if index >= 0 and extents[index][1] > start:
+        return True
+    return index + 1 < len(extents) and extents[index + 1][0] < end
+
+
+def zero_digest(length):
+    if length not in _zero_digests:
+        sha1 = hashlib.sha1()
+        left = length
+        while left > 0:
+            sha1.update(ZERO[:min(BUFFER, left)])
+            left -= BUFFER
+        _zero_digests[length] = sha1.hexdigest()
+    return _zero_digests[length]
+
+
+def drop_cache(path):
+    # NOTE(python3.3之前没有posix_fadvise, 读到的可能是page cache.)
+    fadvise = getattr(os, 'posix_fadvise', None)
+    if fadvise is None:
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def hash_ranges(jobs, workers):
+    """Return the sha1 of each (path, start, end), read by `workers`
+    threads.
+    """
+    extents = {}
+    for path in set(job[0] for job in jobs):
+        extents[path] = data_extents(path, os.path.getsize(path))
+    digests = [None] * len(jobs)
+    pending = list(range(len(jobs)))[::-1]
+    lock = threading.Lock()
+    errors = []
+
+    def worker():
+        view = memoryview(bytearray(BUFFER))
+        files = {}
+        try:
+            while True:
+                with lock:
+                    if not pending or errors:
+                        return
+                    index = pending.pop()
+                path, start, end = jobs[index]
+                if not has_data(extents[path], start, end):
+                    digests[index] = zero_digest(end - start)
+                    continue
+                if path not in files:
+                    files[path] = io.open(path, 'rb', buffering=0)
+                f = files[path]
+                f.seek(start)
+                sha1 = hashlib.sha1()
+                pos = start
+                while pos < end:
+                    count = f.readinto(view[:min(BUFFER, end - pos)])
+                    if not count:
+                        break
+                    sha1.update(view[:count])
+                    pos += count
+                digests[index] = sha1.hexdigest()
+        except Exception as _ex:
+            errors.append(_ex)
+        finally:
+            for f in files.values():
+                f.close()
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(max(1, workers))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return digests
+
+
+def chunk_ranges(start, end, chunk):
+    return [(pos, min(pos + chunk, end)) for pos in range(start, end, chunk)]
+
+
+def root_digest(digests):
+    return hashlib.sha1(''.join(digests).encode('ascii')).hexdigest()
+
+
+def digest(path, chunk, workers):
+    if not os.path.exists(path):
+        return {'exists': False, 'size': 0, 'chunk': chunk, 'digests': [],
+                'root': root_digest([])}
+    size = os.path.getsize(path)
+    drop_cache(path)
+    digests = hash_ranges([(path, start, end) for start, end in
+                           chunk_ranges(0, size, chunk)], workers)
+    return {'exists': True, 'size': size, 'chunk': chunk,
+            'digests': digests, 'root': root_digest(digests)}
+
+
+def merge(ranges):
+    result = []
+    for start, end in ranges:
+        if result and result[-1][1] == start:
+            result[-1][1] = end
+        else:
+            result.append([start, end])
+    return result
+
+
+def compare(src, dst, chunk, workers):
+    start_time = time.time()
+    size = os.path.getsize(src)
+    other = os.path.getsize(dst)
+    drop_cache(src)
+    drop_cache(dst)
+    ranges = chunk_ranges(0, min(size, other), chunk)
+    jobs = [(path, start, end) for start, end in ranges
+            for path in (src, dst)]
+    digests = hash_ranges(jobs, workers)
+    root = root_digest(digests[::2])
+    mismatches = [ranges[i] for i in range(len(ranges))
+                  if digests[2 * i] != digests[2 * i + 1]]
+
+    # NOTE(不一致的chunk再按1M比较, 定位到具体范围; 大面积不一致时
+    #      不再细分.)
+    if mismatches and len(mismatches) <= NARROW and chunk > PIECE:
+        pieces = []
+        for start, end in mismatches:
+            pieces.extend(chunk_ranges(start, end, PIECE))
+        jobs = [(path, start, end) for start, end in pieces
+                for path in (src, dst)]
+        digests = hash_ranges(jobs, workers)
+        mismatches = [pieces[i] for i in range(len(pieces))
+                      if digests[2 * i] != digests[2 * i + 1]]
+    if size != other:
+        mismatches.append((min(size, other), max(size, other)))
+
+    elapsed = time.time() - start_time
+    return {'src': src, 'dst': dst, 'size': size, 'chunk': chunk,
+            'chunks': len(ranges), 'match': not mismatches, 'root': root,
+            'mismatches': merge(mismatches), 'elapsed': round(elapsed, 3),
+            'throughput_mb': round(size / max(elapsed, 0.001) / 1048576, 1)}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='verify.py')
+    parser.add_argument('mode', choices=['digest', 'compare'])
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--chunk-kb', type=int, default=65536)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args(argv[1:])
+    chunk = args.chunk_kb * 1024
+    if args.mode == 'digest' and len(args.paths) == 1:
+        result = digest(args.paths[0], chunk, args.workers)
+    elif args.mode == 'compare' and len(args.paths) == 2:
+        result = compare(args.paths[0], args.paths[1], chunk, args.workers)
+    else:
+        parser.error('digest takes one path, compare two')
+    print(json.dumps(result, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+"""Streaming decoder of the streamOptimized vmdk exported by vcenter.
+
+It runs on the hypervisor(RPC.run_script sends this file to the remote
+python), so it uses the standard library only and runs on python 2.7/3.
+
+    python - <src> [--raw <dst>] --procs 4 < vmdk.py
+
+The vmdk(a file, - for stdin, or an http(s) url with the auth of
+V2OS_FETCH_AUTH) is read once from start to end without seeking, so it
+can be converted while still downloading. The sparse header gives the
+capacity and grain size, then every grain marker carries the lba and the
+deflated grain; the grains are inflated by `procs` processes in batches
+and emitted in lba order, grains never written(unallocated) are skipped.
+
+The extents are written to stdout as an extent stream(EXTENT_HEADER:
+magic, virtual size; then per extent EXTENT: offset, length, data), read
+by qcow2.py. With --raw they are written into a sparse raw file instead
+and the size, extents and throughput are printed as json.
+"""
+
+import os
+import sys
+import ssl
+import json
+import time
+import zlib
+import base64
+import struct
+import argparse
+import multiprocessing
+
+try:
+    from urllib.request import Request, urlopen
+except ImportError:
+    from urllib2 import Request, urlopen
+
+SECTOR = 512
+MAGIC = 0x564d444b
+HEADER = struct.Struct('<IIIQQQQIQQQB4sH')
+FLAG_COMPRESSED = 1 << 16
+FLAG_MARKERS = 1 << 17
+COMPRESS_DEFLATE = 1
+MARKER = struct.Struct('<QI')
+MARKER_EOS, MARKER_GT, MARKER_GD, MARKER_FOOTER = 0, 1, 2, 3
+
+EXTENT_MAGIC = b'V2OSEXT1'
+EXTENT_HEADER = struct.Struct('>8sQ')
+EXTENT = struct.Struct('>QI')
+
+if hasattr(sys.stdout, 'buffer'):
+    STDIN, STDOUT = sys.stdin.buffer, sys.stdout.buffer
+else:
+    STDIN, STDOUT = sys.stdin, sys.stdout
+
+
+def inflate(args):
+    data, length = args
+    grain = zlib.decompress(data)
+    return grain[:length]
+
+
+def open_source(src, insecure=False):
+    if src == '-':
+        return STDIN
+    if not src.startswith(('http://', 'https://')):
+        return open(src, 'rb')
+    request = Request(src)
+    auth = os.environ.get('V2OS_FETCH_AUTH')
+    if auth:
+        token = base64.b64encode(auth.encode('utf-8')).decode('ascii')
+        request.add_header('Authorization', 'Basic %s' % token)
+    if insecure and hasattr(ssl, '_create_unverified_context'):
+        return urlopen(request, timeout=60,
+                       context=ssl._create_unverified_context())
+    return urlopen(request, timeout=60)
+
+
+class StreamReader(object):
+    """Read the grains of a streamOptimized vmdk from a stream.
+
+    usage:
+
+        reader = StreamReader(open('disk.vmdk', 'rb'), procs=4)
+        for offset, data in reader.extents():
+            ...
+
+    `capacity` is the virtual size and `grain` the grain size in bytes.
+    """
+
+    def __init__(self, stream, procs=4):
+        self.stream = stream
+        self.procs = procs
+        self.pos = 0
+        (magic, self.version, flags, capacity, grain, descriptor_offset,
+         descriptor_size, _, _, _, overhead, _, _,
+         compress) = HEADER.unpack(self.read(SECTOR)[:HEADER.size])
+        if magic != MAGIC:
+            raise IOError('not a vmdk sparse extent')
+        if not flags & FLAG_COMPRESSED or not flags & FLAG_MARKERS or \
+           compress != COMPRESS_DEFLATE:
+            raise IOError('not a streamOptimized vmdk, flags: %#x' % flags)
+        self.capacity = capacity * SECTOR
+        self.grain = grain * SECTOR
+        self.descriptor = ''
+        if descriptor_offset:
+            self.skip_to(descriptor_offset * SECTOR)
+            self.descriptor = self.read(descriptor_size * SECTOR)\
+                .rstrip(b'\0').decode('utf-8', 'replace')
+        self.skip_to(overhead * SECTOR)
+
+    def read(self, length):
+        chunks = []
+        while length > 0:
+            data = self.stream.read(length)
+            if not data:
+                break
+            chunks.append(data)
+            length -= len(data)
+            self.pos += len(data)
+        return b''.join(chunks)
+
+    def read_exact(self, length):
+        data = self.read(length)
+        if len(data) != length:
+            raise IOError('vmdk truncated at: %d' % self.pos)
+        return data
+
+    def skip_to(self, offset):
+        if offset < self.pos:
+            raise IOError('vmdk offset: %d behind the stream: %d'
+                          % (offset, self.pos))
+        while self.pos < offset:
+            self.read_exact(min(1024 * 1024, offset - self.pos))
+
+    def align(self):
+        if self.pos % SECTOR:
+            self.read_exact(SECTOR - self.pos % SECTOR)
+
+    def grains(self):
+        """Yield (lba, deflated grain) of the grain markers until the end
+        of stream marker.
+        """
+        while True:
+            head = self.read(MARKER.size)
+            if not head:
+                # NOTE(没有end of stream标记的导出, 以文件结束为准.)
+                return
+            if len(head) != MARKER.size:
+                raise IOError('vmdk truncated at: %d' % self.pos)
+            value, size = MARKER.unpack(head)
+            if size:
+                yield value, self.read_exact(size)
+                self.align()
+                continue
+            kind = struct.unpack('<I', self.read_exact(4))[0]
+            self.align()
+            if kind == MARKER_EOS:
+                return
+            # NOTE(grain table、grain directory和footer不需要, 跳过.)
+            self.skip_to(self.pos + value * SECTOR)
+
+    def extents(self):
+        """Yield (offset, data) of the allocated grains, in order.
+        """
+        pool = None
+        if self.procs > 1:
+            if hasattr(multiprocessing, 'get_context'):
+                pool = multiprocessing.get_context('fork').Pool(self.procs)
+            else:
+                pool = multiprocessing.Pool(self.procs)
+        mapper = pool.map if pool is not None else map
+        end = 0
+        batch = []
+        try:
+            for item in self.grains():
+                batch.append(item)
+                if len(batch) >= max(1, self.procs) * 4:
+                    for extent in self.inflate_batch(mapper, batch, end):
+                        end = extent[0] + len(extent[1])
+                        yield extent
+                    batch = []
+            for extent in self.inflate_batch(mapper, batch, end):
+                yield extent
+        finally:
+            if pool is not None:
+                pool.close()
+
+    def inflate_batch(self, mapper, batch, end):
+        jobs = []
+        for lba, data in batch:
+            offset = lba * SECTOR
+            if offset < end:
+                raise IOError('grain at: %d out of order' % offset)
+            if offset >= self.capacity:
+                raise IOError('grain at: %d beyond capacity' % offset)
+            jobs.append((data, min(self.grain, self.capacity - offset)))
+            end = offset + self.grain
+        for (lba, _), data in zip(batch, mapper(inflate, jobs)):
+            yield lba * SECTOR, data
+
+
+def write_extents(reader, out):
+    out.write(EXTENT_HEADER.pack(EXTENT_MAGIC, reader.capacity))
+    for offset, data in reader.extents():
+        out.write(EXTENT.pack(offset, len(data)))
+        out.write(data)
+    out.flush()
+
+
+def write_raw(reader, dst):
+    start = time.time()
+    fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    extents = written = 0
+    try:
+        for offset, data in reader.extents():
+            os.lseek(fd, offset, os.SEEK_SET)
+            os.write(fd, data)
+            extents += 1
+            written += len(data)
+        os.ftruncate(fd, reader.capacity)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    elapsed = time.time() - start
+    return {'dst': dst, 'size': reader.capacity, 'extents': extents,
+            'written': written, 'read': reader.pos,
+            'elapsed': round(elapsed, 3),
+            'throughput_mb': round(written / max(elapsed, 0.001) / 1048576,
+                                   1)}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='vmdk.py')
+    parser.add_argument('src')
+    parser.add_argument('--raw', default=None)
+    parser.add_argument('--procs', type=int, default=4)
+    parser.add_argument('--insecure', action='store_true')
+    args = parser.parse_args(argv[1:])
+    reader = StreamReader(open_source(args.src, args.insecure), args.procs)
+    if args.raw:
+        print(json.dumps(write_raw(reader, args.raw), sort_keys=True))
+    else:
+        write_extents(reader, STDOUT)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
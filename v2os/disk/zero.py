@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+"""Zero detection of disk data, so the zeros of thick provisioned disks
+are neither written nor stored.
+
+The remote scripts using it list it in their REQUIRES and
+RPC.script_command sends it along, so it uses the standard library only
+and runs on python 2.7/3.
+
+A buffer is compared granule by granule with a shared zero page, the
+compare is a memcmp(several GB/s per core). Zero granules are skipped
+when the file range is known to be a hole, punched otherwise.
+"""
+
+import os
+import ctypes
+import ctypes.util
+
+GRANULE = 64 * 1024
+ZERO = b'\0' * GRANULE
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+_fallocate = []
+
+
+def is_zero(data):
+    if len(data) == GRANULE:
+        return data == ZERO
+    for start in range(0, len(data), GRANULE):
+        piece = data[start:start + GRANULE]
+        if piece != ZERO[:len(piece)]:
+            return False
+    return True
+
+
+def runs(data, granule=GRANULE):
+    """Split data into [(start, end, zero)] runs at granule boundaries.
+    """
+    zero = ZERO if granule == GRANULE else b'\0' * granule
+    result = []
+    for start in range(0, len(data), granule):
+        piece = data[start:start + granule]
+        end = start + len(piece)
+        empty = piece == zero if len(piece) == granule else \
+            piece == zero[:len(piece)]
+        if result and result[-1][2] == empty:
+            result[-1] = (result[-1][0], end, empty)
+        else:
+            result.append((start, end, empty))
+    return result
+
+
+def punch_hole(fd, offset, length):
+    """Deallocate the range of the file, return False when the kernel or
+    filesystem can not.
+    """
+    if not _fallocate:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            func = libc.fallocate
+            func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong,
+                             ctypes.c_longlong]
+            func.restype = ctypes.c_int
+        except (OSError, AttributeError):
+            func = None
+        _fallocate.append(func)
+    func = _fallocate[0]
+    if func is None or length <= 0:
+        return False
+    return func(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+                offset, length) == 0
+
+
+def write_sparse(fd, offset, data, punch=True):
+    """Write data at offset leaving its zero granules as holes, return
+    the zero bytes.
+
+    NOTE(目标范围原本就是空洞时(新建的文件)punch=False直接跳过,
+         否则打洞; 不支持打洞时写入0.)
+    """
+    zeros = 0
+    for start, end, empty in runs(data):
+        if empty:
+            zeros += end - start
+            if not punch or punch_hole(fd, offset + start, end - start):
+                continue
+        os.lseek(fd, offset + start, os.SEEK_SET)
+        view = data[start:end]
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+    return zeros
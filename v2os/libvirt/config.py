@@ -5,9 +5,6 @@
 # Author: Jinlong Yang
 #
 
-from lxml import etree
-
-
 NOVA_NS = "http://openstack.org/xmlns/libvirt/nova/1.0"
 
 
@@ -19,6 +16,8 @@ class LibvirtConfigObject:
         self.ns_uri = kwargs.get('ns_uri')
 
     def _new_node(self, tag, **kwargs):
+        from lxml import etree
+
         if self.ns_uri is None:
             return etree.Element(tag, **kwargs)
         else:
@@ -35,6 +34,8 @@ class LibvirtConfigObject:
         return self._new_node(self.root_name)
 
     def to_xml(self):
+        from lxml import etree
+
         root = self.format_dom()
         xml_str = etree.tostring(root, pretty_print=True).decode('utf-8')
         return xml_str
@@ -114,6 +115,8 @@ class LibvirtConfigDisk(LibvirtConfigObject):
         mount = kwargs.get('mount')
         self.disk = '%(mount)s/nova/instances/%(uuid)s/disk' % {
             'mount': mount, 'uuid': uuid}
+        self.backing_file = kwargs.get('backing_file')
+        self.backing_format = kwargs.get('backing_format')
 
     def format_dom(self):
         dev = super().format_dom()
@@ -123,6 +126,13 @@ class LibvirtConfigDisk(LibvirtConfigObject):
                                                'type': 'qcow2',
                                                'cache': 'none'}))
         dev.append(self._new_node('source', **{'file': self.disk}))
+        if self.backing_file:
+            backing = self._new_node('backingStore', **{'type': 'file'})
+            backing.append(self._new_node(
+                'format', **{'type': self.backing_format}))
+            backing.append(self._new_node(
+                'source', **{'file': self.backing_file}))
+            dev.append(backing)
         dev.append(self._new_node('target', **{'bus': 'virtio', 'dev': 'vda'}))
         return dev
 
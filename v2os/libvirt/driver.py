@@ -6,21 +6,38 @@
 #
 
 import logging
-
-import libvirt
+import threading
 
 LOG = logging.getLogger(__name__)
 
+# NOTE(按宿主机复用qemu+ssh连接, 避免每台虚拟机都重新建立.)
+_CONNECTIONS = {}
+_LOCK = threading.Lock()
+
 
 class LibvirtDriver:
 
     def connect(self, ip):
         """Get a connection to the hypervisor.
         """
+        import libvirt
+
         uri = 'qemu+ssh://root@%(ip)s/system' % {'ip': ip}
-        self.conn = libvirt.open(uri)
-        if self.conn is None:
-            raise Exception('Connnect to hypervisor: %s failed.' % ip)
+        with _LOCK:
+            conn = _CONNECTIONS.get(uri)
+            if conn is not None:
+                try:
+                    alive = conn.isAlive()
+                except libvirt.libvirtError:
+                    alive = 0
+                if alive != 1:
+                    conn = None
+            if conn is None:
+                conn = libvirt.open(uri)
+                if conn is None:
+                    raise Exception('Connnect to hypervisor: %s failed.' % ip)
+                _CONNECTIONS[uri] = conn
+        self.conn = conn
 
     def define(self, xml):
         """Define a domain, but does not start it.
@@ -61,7 +78,17 @@ class LibvirtDriver:
         The running instance is shutdown if not down already and all resources
         used by it are given back to the hypervisor.
         """
-        return domain.destory()
+        return domain.destroy()
+
+    def lookup(self, uuid):
+        """Return the domain of the uuid, None if it is not defined.
+        """
+        import libvirt
+
+        try:
+            return self.conn.lookupByUUIDString(uuid)
+        except libvirt.libvirtError:
+            return None
 
     def get_domain(self, uuid):
         """Return domain instance name.
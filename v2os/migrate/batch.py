@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+import json
+import time
+import queue
+import logging
+import threading
+import collections
+from concurrent import futures
+
+from osmo.db import get_session
+from oslo_config import cfg
+
+from v2os.migrate.builder import KVMInstance, Nova
+from v2os.migrate.l2 import RPC
+from v2os.migrate.manager import Manager
+from v2os.migrate.spec import MigrationSpec
+from v2os.migrate.swarm import Swarm
+
+LOG = logging.getLogger(__name__)
+
+CONF = cfg.CONF
+
+default_opts = [
+    cfg.StrOpt('batch_file', default='',
+               help='jsonl file, one vm per line with the spec fields to '
+                    'override, such as: {"hostname": "yy-jinlong00.yy", '
+                    '"hypervisor": "dx-tkvm00.dx", "vlan": 1220}'),
+    cfg.IntOpt('batch_size', default=50,
+               help='max vms whose database plans commit together.'),
+    cfg.IntOpt('batch_wait', default=200,
+               help='max milliseconds to wait for a group to fill up.'),
+    cfg.IntOpt('batch_workers', default=8,
+               help='vms built on the hypervisors at the same time.'),
+    cfg.BoolOpt('preflight_check', default=True,
+                help='read the headers of the source disks of a batch '
+                     'before migrating it, the vms whose disks would not '
+                     'boot are not migrated.'),
+]
+
+CONF.register_cli_opts(default_opts)
+
+
+def parse_spec(values):
+    """Return the spec of the configured options overridden by `values`.
+    """
+    if not isinstance(values, dict):
+        raise Exception('虚拟机参数必须是json对象!')
+    return MigrationSpec.from_conf(**values)
+
+
+def read_batch_file(path):
+    """Return the vm specs of a jsonl batch file.
+    """
+    specs = []
+    with open(path) as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                specs.append(parse_spec(json.loads(line)))
+            except Exception as _ex:
+                raise Exception('批量文件第%d行%s' % (lineno, _ex))
+    return specs
+
+
+def migrate(specs, size=50, wait=200, workers=8, journal=None, wave=None):
+    """Migrate the vms of the specs in this process.
+
+    Return a future of the instance uuid for each spec, in order. With a
+    `wave` id(reservation id, such as r-1a2b3c4d) all the instances share
+    it and can be torn down together.
+    """
+    pipeline = GroupCommit(Nova(), size=size, wait=wait, workers=workers)
+    pipeline.start()
+    results = [pipeline.submit(KVMInstance(spec, journal, wave))
+               for spec in specs]
+    pipeline.close()
+    return results
+
+
+def presync(specs, workers=8):
+    """Copy the disks of the specs to their staging path on the
+    hypervisors while the source vms are still running, so the cutover
+    only sends the blocks changed since.
+
+    Return a future of the sync result for each spec, in order.
+    """
+    def sync(spec):
+        if not spec.source_host:
+            raise Exception('%s 没有指定source_host!' % spec.name)
+        return RPC(spec).delta_sync(spec.source_host, spec.source_path,
+                                    spec.hypervisor, spec.staging_disk)
+
+    pool = futures.ThreadPoolExecutor(max_workers=workers)
+    results = [pool.submit(sync, spec) for spec in specs]
+    pool.shutdown(wait=False)
+    return results
+
+
+def check_disk(spec, info):
+    """Return the problems of the source disk of the spec, empty when
+    it can be migrated.
+    """
+    if not info['exists']:
+        return ['磁盘: %s 不存在%s' % (
+            info['path'], ': %s' % info['errors'][0] if info['errors']
+            else '')]
+    problems = ['磁盘头错误: %s' % error for error in info['errors']]
+    if info['format'] != spec.source_format:
+        problems.append('磁盘格式为%s, 要求为%s' % (info['format'],
+                                                spec.source_format))
+    if info['format'] == 'vmdk' and not info.get('stream_optimized'):
+        problems.append('vmdk不是streamOptimized格式')
+    # NOTE(指定base_url时backing指针改为宿主机上的base, 不要求原backing.)
+    if info['backing_file'] and not spec.base_url:
+        if spec.source_host or spec.source_url:
+            problems.append('磁盘引用了backing file: %s, 只传输磁盘本身'
+                            % info['backing_file'])
+        elif info['dangling']:
+            problems.append('磁盘的backing file: %s 不存在'
+                            % info['backing_chain'][-1]['path'])
+    limit = spec.disk * 1024 ** 3
+    if info['virtual_size'] and info['virtual_size'] > limit:
+        problems.append('磁盘虚拟大小%.1fG超过规格root_gb %dG'
+                        % (info['virtual_size'] / 1024.0 ** 3, spec.disk))
+    return problems
+
+
+def preflight(specs, workers=8):
+    """Read the headers of the source disks of the specs, the disks of
+    each host in one remote run and the hosts in parallel.
+
+    Return {'vm', 'host', 'path', 'disk', 'problems'} for each spec, in
+    order.
+    """
+    groups = collections.OrderedDict()
+    rpcs = {}
+    for index, spec in enumerate(specs):
+        host, path = spec.source_disk
+        groups.setdefault(host, []).append((index, path))
+        rpcs.setdefault(host, RPC(spec))
+
+    def inspect(host):
+        paths = sorted(set(path for _, path in groups[host]))
+        try:
+            return dict(zip(paths, rpcs[host].probe_disks(host, paths)))
+        except Exception as _ex:
+            LOG.error('Preflight disks on host: %s failed: %s'
+                      % (host, _ex))
+            return None
+
+    with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        infos = dict(zip(groups, pool.map(inspect, groups)))
+
+    results = []
+    for spec in specs:
+        host, path = spec.source_disk
+        info = (infos[host] or {}).get(path)
+        if info is None:
+            problems = ['读取宿主机: %s 上的磁盘头失败' % host]
+        else:
+            problems = check_disk(spec, info)
+        results.append({'vm': spec.name, 'host': host, 'path': path,
+                        'disk': info, 'problems': problems})
+    return results
+
+
+def distribute(specs):
+    """Distribute the base images of the specs to the nova _base of their
+    hypervisors before the migration, the hypervisors pulling the chunks
+    from each other, so the origin sends each image about once.
+
+    Return the swarm result of each base image.
+    """
+    groups = collections.OrderedDict()
+    for spec in specs:
+        if spec.base_url:
+            groups.setdefault((spec.base_url, spec.base_image),
+                              set()).add(spec.hypervisor)
+
+    rpc = RPC()
+    manager = Manager()
+    results = []
+    for (url, base), hosts in groups.items():
+        peers = [{'host': host, 'ip': manager.get_hypervisor_ip(host),
+                  'port': CONF.swarm_port, 'dst': base}
+                 for host in sorted(hosts)]
+        for peer in peers:
+            rpc.mkdir(peer['host'], base.rsplit('/', 1)[0])
+        result = Swarm(rpc, url, peers, chunk_mb=CONF.fetch_chunk_mb,
+                       uploads=CONF.swarm_uploads,
+                       origin_uploads=CONF.swarm_origin_uploads).run()
+        for peer in peers:
+            if peer['host'] not in result['failed']:
+                rpc.chmod(peer['host'], base, '644')
+                rpc.chown(peer['host'], base, 'qemu', 'qemu')
+        results.append(result)
+    return results
+
+
+class GroupCommit:
+    """Pipeline of a db writer stage and a hypervisor stage.
+
+    The db writer gathers the builders of up to `size` vms(or whatever
+    arrives within `wait` ms), commits their database plans in one
+    transaction with bulk inserts, then hands every committed builder to
+    a pool building them on the hypervisors, while the next group is
+    being written.
+
+    usage:
+
+        pipeline = GroupCommit(Nova())
+        pipeline.start()
+        results = [pipeline.submit(KVMInstance(spec)) for spec in specs]
+        pipeline.close()
+        for future in results:
+            future.result()
+    """
+
+    def __init__(self, nova, size=50, wait=200, workers=8):
+        self.nova = nova
+        self.size = size
+        self.wait = wait / 1000.0
+        self.queue = queue.Queue()
+        self.pool = futures.ThreadPoolExecutor(max_workers=workers)
+        self.writer = threading.Thread(target=self.write, name='db-writer')
+        self.writer.daemon = True
+
+    def start(self):
+        self.writer.start()
+
+    def submit(self, builder):
+        """Queue a vm, return a future of its instance uuid.
+        """
+        future = futures.Future()
+        self.queue.put((builder, future))
+        return future
+
+    def close(self):
+        """Wait for the queued vms to be written and built.
+        """
+        self.queue.put(None)
+        self.writer.join()
+        self.pool.shutdown(wait=True)
+
+    def write(self):
+        closed = False
+        while not closed:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            group = [item]
+            deadline = time.time() + self.wait
+            while len(group) < self.size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    closed = True
+                    break
+                group.append(item)
+
+            for builder, future in self.commit(group):
+                self.pool.submit(self.build, builder, future)
+
+    def commit(self, group):
+        """Commit the group, return the (builder, future) that committed.
+        """
+        try:
+            self.nova.plan(get_session(), [b for b, _ in group])
+            LOG.info('Group commit %d instances database plan success.'
+                     % len(group))
+            return group
+        except Exception as _ex:
+            if len(group) == 1:
+                LOG.exception('Write instance database plan failed.')
+                group[0][1].set_exception(_ex)
+                return []
+            LOG.error('Group commit %d instances failed: %s, retry one by '
+                      'one.' % (len(group), _ex))
+
+        # NOTE(整组失败时逐个重试, 避免一个vm的错误拖累同组的其它vm.)
+        committed = []
+        for item in group:
+            committed.extend(self.commit([item]))
+        return committed
+
+    def build(self, builder, future):
+        try:
+            self.nova.build(get_session(), builder)
+        except Exception as _ex:
+            future.set_exception(_ex)
+        else:
+            future.set_result(builder.instance_uuid)
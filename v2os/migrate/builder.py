@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+import time
+import logging
+
+from oslo_config import cfg
+from osmo.db import get_session
+
+from v2os.migrate.instance import InstanceManager
+from v2os.migrate.l3 import L3Manager
+from v2os.migrate.l2 import LibvirtManager
+from v2os.migrate.quota import QuotaManager
+from v2os.migrate.compute import ComputeManager
+from v2os.migrate.state import StateManager
+from v2os.migrate.journal import Journal
+from v2os.migrate.coordination import get_lease_manager
+
+LOG = logging.getLogger(__name__)
+
+CONF = cfg.CONF
+
+
+class Instance:
+
+    def __init__(self):
+        self.uuid = None
+
+
+class KVMInstance:
+    """Builder of one vm, everything about the vm comes from its spec.
+
+    Builders share no state, many of them can run in the same process at
+    the same time.
+    """
+
+    def __init__(self, spec, journal=None, wave=None):
+        self.instance = Instance()
+        self.instance_ref = None
+        self.instance_uuid = None
+        self.network = {}
+        self.pending = []
+        self.resumed = False
+        self.spec = spec
+        self.wave = wave
+        self.timings = {}
+        journal = CONF.journal if journal is None else journal
+        self.journal = Journal(journal, spec.name)
+
+    def build_instance(self, session):
+        self.pending = []
+        self.resumed = False
+        instance_manager = InstanceManager(session, self.spec, self.pending,
+                                           self.wave)
+        instance_manager.check()
+        LOG.info('Check instance migrate param passed.')
+
+        if self.resume(instance_manager):
+            return
+
+        self.instance_ref = instance_manager.write()
+        self.instance_uuid = self.instance_ref.uuid
+        self.instance.uuid = self.instance_ref.uuid
+        LOG.info('Write instance: %s for database info success.'
+                 % self.instance_uuid)
+
+    def resume(self, instance_manager):
+        """Reuse the database plan committed by a previous failed run.
+        """
+        plan = self.journal.get('plan')
+        if not plan:
+            return False
+
+        self.instance_ref = instance_manager.read(plan['uuid'])
+        if self.instance_ref is None or self.instance_ref.id != plan['id']:
+            LOG.warning('Journal instance: %s not found in database, start '
+                        'over.' % plan['uuid'])
+            self.journal.discard()
+            return False
+
+        self.resumed = True
+        self.network = {'ip': plan['ip'], 'mac': plan['mac']}
+        self.instance_uuid = self.instance_ref.uuid
+        self.instance.uuid = self.instance_ref.uuid
+        LOG.info('Resume instance: %s (ip: %s, mac: %s) from journal.'
+                 % (self.instance_uuid, plan['ip'], plan['mac']))
+        return True
+
+    def checkpoint(self):
+        self.journal.record('plan', uuid=self.instance_uuid,
+                            id=self.instance_ref.id, **self.network)
+
+    def build_l3(self, session):
+        if self.resumed:
+            return
+
+        l3_manager = L3Manager(session, self.spec, self.instance_ref,
+                               self.pending)
+        l3_manager.write()
+        self.network = {'ip': l3_manager.ip, 'mac': l3_manager.mac}
+        LOG.info('Write instance: %s for l3(network) info success.'
+                 % self.instance_uuid)
+
+    def build_l2(self, session):
+        l2_manager = LibvirtManager(session, self.spec, self.instance_ref,
+                                    self.journal, get_lease_manager())
+        try:
+            l2_manager.build()
+        finally:
+            self.timings.update(l2_manager.timings)
+        LOG.info('Build instance: %s for l2(vlan、bridge、directory) '
+                 'info success.' % self.instance_uuid)
+
+    def finalize(self, session):
+        state_manager = StateManager(session)
+        state_manager.activate([self.instance_uuid])
+        LOG.info('Finalize instance: %s state to active success.'
+                 % self.instance_uuid)
+
+    def compensate(self, session):
+        state_manager = StateManager(session)
+        state_manager.compensate([self.instance_uuid])
+        LOG.info('Compensate instance: %s database info success.'
+                 % self.instance_uuid)
+
+
+class Nova:
+
+    def __init__(self):
+        self.builder = None
+
+    def constuct(self, builder):
+        self.builder = builder
+        session = get_session()
+        self.plan(session, [builder])
+        self.build(session, builder)
+
+    def plan(self, session, builders):
+        """Commit the database plans of the builders in one transaction.
+
+        NOTE(阶段一: 数据库规划在短事务内提交, 实例处于building状态,
+             fixed_ips和instances的行锁只持有到这里, 不跨越远程操作.
+             不需要回填主键的子表记录, 按表批量插入.)
+        """
+        start = time.time()
+        with session.begin(subtransactions=True):
+            for builder in builders:
+                [step for step in (builder.build_instance(session),
+                                   builder.build_l3(session))]
+
+            pending = [m for b in builders for m in b.pending]
+            pending.sort(key=lambda m: m.__tablename__)
+            session.bulk_save_objects(pending)
+            self.account(session, [b for b in builders if not b.resumed],
+                         sign=1)
+        elapsed = round(time.time() - start, 3)
+        for builder in builders:
+            builder.timings['plan'] = elapsed
+            builder.checkpoint()
+
+    def build(self, session, builder):
+        """Build one planned instance on its hypervisor.
+        """
+        # NOTE(阶段二: 宿主机上的网络、目录、磁盘和虚拟机, 不持有事务.
+        #      启用journal时失败不回退, 保留规划以便重跑时从失败的步骤继续.)
+        start = time.time()
+        try:
+            builder.build_l2(session)
+        except Exception:
+            if builder.journal.enabled:
+                LOG.exception('Build instance: %s on hypervisor failed, '
+                              'rerun to resume.' % builder.instance_uuid)
+                raise
+            LOG.exception('Build instance: %s on hypervisor failed, '
+                          'compensate.' % builder.instance_uuid)
+            with session.begin(subtransactions=True):
+                builder.compensate(session)
+                self.account(session, [builder], sign=-1)
+            raise
+        finally:
+            builder.timings['build'] = round(time.time() - start, 3)
+
+        # NOTE(阶段三: 宿主机上创建成功, 置为active.)
+        with session.begin(subtransactions=True):
+            builder.finalize(session)
+
+    def account(self, session, builders, sign):
+        quota_manager = QuotaManager(session)
+        compute_manager = ComputeManager(session)
+        for builder in builders:
+            quota_manager.add(builder.instance_ref, sign=sign)
+            compute_manager.add(builder.instance_ref, sign=sign)
+        quota_manager.commit()
+        compute_manager.commit()
+
+    @property
+    def instance(self):
+        return self.builder.instance.uuid
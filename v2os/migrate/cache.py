@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+import copy
+import time
+import logging
+import functools
+import threading
+
+from oslo_config import cfg
+
+LOG = logging.getLogger(__name__)
+
+CONF = cfg.CONF
+
+default_opts = [
+    cfg.IntOpt('reference_cache_ttl', default=0,
+               help='seconds to cache reference data(flavor, key pair, '
+                    'zone, network, hypervisor ip). 0: disabled.'),
+]
+
+CONF.register_opts(default_opts)
+
+_CACHE = {}
+_LOCK = threading.Lock()
+
+
+def cached(key=None):
+    """Cache the result of a reference data read for reference_cache_ttl.
+
+    `key` returns what the result depends on besides the arguments, such
+    as the spec fields the read filters on.
+
+    usage:
+
+        @cached(lambda self: (self.spec.os, self.spec.cpu))
+        def read_instance_type(self):
+            ...
+
+    NOTE(返回的是缓存值的拷贝, 调用方修改不会影响缓存.)
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args):
+            ttl = CONF.reference_cache_ttl
+            if ttl <= 0:
+                return func(self, *args)
+
+            extra = key(self) if key is not None else None
+            cache_key = (func.__qualname__, args, extra)
+            now = time.time()
+            with _LOCK:
+                hit = _CACHE.get(cache_key)
+            if hit is not None and hit[0] > now:
+                return copy.deepcopy(hit[1])
+
+            value = func(self, *args)
+            if value is not None:
+                with _LOCK:
+                    _CACHE[cache_key] = (now + ttl, value)
+            return copy.deepcopy(value)
+        return wrapper
+    return decorator
+
+
+def clear():
+    with _LOCK:
+        _CACHE.clear()
+    LOG.info('Clear reference data cache.')
@@ -5,71 +5,58 @@
 # Author: Jinlong Yang
 #
 
+import sys
+import json
+import time
 import logging
 
-from osmo.base import Application
-from osmo.db import get_session
-
-from v2os.migrate.instance import InstanceManager
-from v2os.migrate.l3 import L3Manager
-from v2os.migrate.l2 import LibvirtManager
-
-LOG = logging.getLogger(__name__)
-
-
-class Instance:
-
-    def __init__(self):
-        self.uuid = None
-
-
-class KVMInstance:
-
-    def __init__(self):
-        self.instance = Instance()
-        self.instance_ref = None
-        self.instance_uuid = None
-
-    def build_instance(self, session):
-        instance_manager = InstanceManager(session)
-        instance_manager.check()
-        LOG.info('Check instance migrate param passed.')
-
-        self.instance_ref = instance_manager.write()
-        self.instance_uuid = self.instance_ref.uuid
-        self.instance.uuid = self.instance_ref.uuid
-        LOG.info('Write instance: %s for database info success.'
-                 % self.instance_uuid)
-
-    def build_l3(self, session):
-        l3_manager = L3Manager(session, self.instance_ref)
-        l3_manager.write()
-        LOG.info('Write instance: %s for l3(network) info success.'
-                 % self.instance_uuid)
-
-    def build_l2(self, session):
-        l2_manager = LibvirtManager(session, self.instance_ref)
-        l2_manager.build()
-        LOG.info('Build instance: %s for l2(vlan、bridge、directory) '
-                 'info success.' % self.instance_uuid)
-
+from v2os.migrate.startup import ImportProfiler
 
-class Nova:
+# NOTE(必须在其他模块import之前安装, 才能统计到启动阶段的import耗时.)
+PROFILER = ImportProfiler.from_argv(sys.argv)
 
-    def __init__(self):
-        self.builder = None
+from oslo_config import cfg
+from osmo.base import Application
+from osmo.db import get_engine, get_session
+
+from v2os.migrate.builder import KVMInstance, Nova
+from v2os.migrate.batch import (distribute, migrate, preflight, presync,
+                                read_batch_file)
+from v2os.migrate.spec import MigrationSpec
+from v2os.migrate.planner import Planner
+from v2os.migrate.teardown import Teardown
+from v2os.migrate.manager import Manager
+from v2os.migrate.coordination import get_lease_manager
+from v2os.db.profiler import QueryCounter
+from v2os.objects.coordination import create_tables
 
-    def constuct(self, builder):
-        self.builder = builder
-        session = get_session()
-        with session.begin(subtransactions=True):
-            [step for step in (builder.build_instance(session),
-                               builder.build_l3(session),
-                               builder.build_l2(session))]
+LOG = logging.getLogger(__name__)
 
-    @property
-    def instance(self):
-        return self.builder.instance.uuid
+CONF = cfg.CONF
+
+default_opts = [
+    cfg.BoolOpt('query_stats', default=False,
+                help='log sql statements, rows and time of each step.'),
+    cfg.BoolOpt('startup-profile', default=False,
+                help='print import timings of the startup.'),
+    cfg.StrOpt('plan', default='',
+               help='dry run: write what each vm would get(flavor, zone, '
+                    'ip, mac, dir, xml, remote commands) to this jsonl '
+                    'file, change nothing.'),
+    cfg.BoolOpt('presync', default=False,
+                help='copy the disks of the vms with a source_host to the '
+                     'hypervisors while the source vms are running, the '
+                     'migration after shutdown syncs only changed blocks.'),
+    cfg.BoolOpt('distribute', default=False,
+                help='pull the base images(base_url) of the vms to their '
+                     'hypervisors peer to peer before the migration.'),
+    cfg.BoolOpt('preflight', default=False,
+                help='read the headers of the source disks(format, virtual '
+                     'size, backing chain) and report the vms whose disks '
+                     'would not boot, change nothing.'),
+]
+
+CONF.register_cli_opts(default_opts)
 
 
 class Migrator(Application):
@@ -80,9 +67,155 @@ class Migrator(Application):
         super(Migrator, self).__init__()
 
     def run(self):
+        if PROFILER:
+            PROFILER.report()
+
+        if CONF.query_stats:
+            with QueryCounter() as counter:
+                self.migrate()
+            counter.report()
+        else:
+            self.migrate()
+
+    def migrate(self):
+        if CONF.plan:
+            return self.plan()
+        if CONF.presync:
+            return self.presync()
+        if CONF.distribute:
+            return self.distribute()
+        if CONF.preflight:
+            return self.preflight()
+        if CONF.coordination:
+            create_tables(get_engine())
+        if CONF.teardown_wave or CONF.teardown_uuids:
+            return self.teardown()
+        if CONF.batch_file:
+            return self.migrate_batch()
+
         nova = Nova()
-        nova.constuct(KVMInstance())
+        nova.constuct(KVMInstance(MigrationSpec.from_conf()))
         LOG.info('Build instance: %s on kvm platform success.' % nova.instance)
 
+    def migrate_batch(self):
+        specs = read_batch_file(CONF.batch_file)
+        total = len(specs)
+        failed = 0
+        if CONF.preflight_check:
+            # NOTE(磁盘头检查不通过的虚拟机不迁移, 避免跑完整个流程才
+            #      发现无法启动.)
+            checked = []
+            for spec, result in zip(specs, preflight(specs,
+                                                     CONF.batch_workers)):
+                if result['problems']:
+                    failed += 1
+                    LOG.error('Preflight disk of %s failed: %s'
+                              % (spec, '; '.join(result['problems'])))
+                else:
+                    checked.append(spec)
+            specs = checked
+
+        wave = Manager().generate_uid('r')
+        LOG.info('Batch migrate %d vms, wave: %s' % (len(specs), wave))
+        results = migrate(specs, size=CONF.batch_size, wait=CONF.batch_wait,
+                          workers=CONF.batch_workers, wave=wave)
+
+        for spec, future in zip(specs, results):
+            try:
+                uuid = future.result()
+                LOG.info('Build instance: %s for %s on kvm platform success.'
+                         % (uuid, spec))
+            except Exception as _ex:
+                failed += 1
+                LOG.error('Build instance for %s failed: %s' % (spec, _ex))
+        LOG.info('Batch migrate wave: %s finished, total: %d success: %d '
+                 'failed: %d' % (wave, total, total - failed, failed))
+        if failed:
+            raise Exception('批量迁移有%d台虚拟机失败!' % failed)
+
+    def plan(self):
+        if CONF.batch_file:
+            specs = read_batch_file(CONF.batch_file)
+        else:
+            specs = [MigrationSpec.from_conf()]
+
+        # NOTE(规划时引用数据只读一次, 未配置缓存时也启用.)
+        if CONF.reference_cache_ttl <= 0:
+            CONF.set_override('reference_cache_ttl', 3600)
+
+        start = time.time()
+        planner = Planner()
+        with open(CONF.plan, 'w') as f:
+            for spec in specs:
+                record = planner.plan(spec)
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+        summary = planner.summary()
+        summary['elapsed'] = round(time.time() - start, 3)
+        print(json.dumps(summary, indent=4, sort_keys=True))
+        LOG.info('Plan %d vms to: %s, failed: %d, elapsed: %.3fs'
+                 % (len(specs), CONF.plan, summary['failed'],
+                    summary['elapsed']))
+
+    def presync(self):
+        if CONF.batch_file:
+            specs = read_batch_file(CONF.batch_file)
+        else:
+            specs = [MigrationSpec.from_conf()]
+
+        failed = 0
+        for spec, future in zip(specs, presync(specs, CONF.batch_workers)):
+            try:
+                result = future.result()
+                LOG.info('Presync disk of %s success, dirty blocks: %d/%d '
+                         'elapsed: %.3fs' % (spec, result['dirty'],
+                                             result['blocks'],
+                                             result['elapsed']))
+            except Exception as _ex:
+                failed += 1
+                LOG.error('Presync disk of %s failed: %s' % (spec, _ex))
+        if failed:
+            raise Exception('预拷贝有%d台虚拟机失败!' % failed)
+
+    def preflight(self):
+        if CONF.batch_file:
+            specs = read_batch_file(CONF.batch_file)
+        else:
+            specs = [MigrationSpec.from_conf()]
+
+        start = time.time()
+        results = preflight(specs, CONF.batch_workers)
+        print(json.dumps(results, indent=4, sort_keys=True))
+        failed = [r for r in results if r['problems']]
+        for result in failed:
+            LOG.error('Preflight disk of %s failed: %s'
+                      % (result['vm'], '; '.join(result['problems'])))
+        LOG.info('Preflight %d disks, failed: %d, elapsed: %.3fs'
+                 % (len(results), len(failed), time.time() - start))
+        if failed:
+            raise Exception('预检有%d台虚拟机的磁盘不满足迁移条件!'
+                            % len(failed))
+
+    def distribute(self):
+        if CONF.batch_file:
+            specs = read_batch_file(CONF.batch_file)
+        else:
+            specs = [MigrationSpec.from_conf()]
+
+        results = distribute(specs)
+        print(json.dumps(results, indent=4, sort_keys=True))
+        failed = sum(len(result['failed']) for result in results)
+        if failed:
+            raise Exception('分发base镜像有%d台宿主机失败!' % failed)
+
+    def teardown(self):
+        teardown = Teardown(get_session(), MigrationSpec.from_conf(),
+                            workers=CONF.teardown_workers,
+                            leases=get_lease_manager())
+        result = teardown.run(wave=CONF.teardown_wave,
+                              uuids=CONF.teardown_uuids)
+        print(json.dumps(result, indent=4, sort_keys=True))
+        if result['failed']:
+            raise Exception('回退有%d台虚拟机失败!' % len(result['failed']))
+
 
 v2os_migrate = Migrator().entry_point()
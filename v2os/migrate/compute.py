@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+import logging
+import collections
+from datetime import datetime
+
+from v2os.migrate.manager import Manager
+from v2os import objects
+
+LOG = logging.getLogger(__name__)
+
+
+class ComputeManager(Manager):
+    """Keep per-hypervisor resource deltas of a migration batch in memory,
+    and apply them to `compute_nodes` once when the batch commits.
+    """
+
+    retries = 3
+
+    def __init__(self, session):
+        self.session = session
+        self.deltas = collections.defaultdict(collections.Counter)
+
+    def add(self, instance_ref, sign=1):
+        """Account the resources of an instance to its hypervisor.
+        """
+        disk = instance_ref.root_gb + instance_ref.ephemeral_gb
+        usage = self.deltas[instance_ref.host]
+        usage['vcpus_used'] += sign * instance_ref.vcpus
+        usage['memory_mb_used'] += sign * instance_ref.memory_mb
+        usage['local_gb_used'] += sign * disk
+        usage['running_vms'] += sign
+        usage['free_ram_mb'] -= sign * instance_ref.memory_mb
+        usage['free_disk_gb'] -= sign * disk
+
+    def commit(self):
+        """Apply the accumulated deltas, one update for each hypervisor,
+        inside the caller's transaction.
+        """
+        hosts = [host for host, usage in self.deltas.items() if any(
+            usage.values())]
+        if not hosts:
+            return
+
+        versions = self.read_versions(hosts)
+        for host in hosts:
+            if host not in versions:
+                raise Exception('计算节点: %s 不存在!' % host)
+            self.update_node(host, versions[host], self.deltas[host])
+            LOG.info('Update hypervisor: %s resource usage: %s success.'
+                     % (host, dict(self.deltas[host])))
+        self.deltas.clear()
+
+    def read_versions(self, hosts):
+        """Return {host: (compute node id, updated_at)} for the hosts.
+        """
+        # NOTE(加锁读(SELECT ... FOR UPDATE)在REPEATABLE READ下读的是最新
+        #      提交的版本而不是事务快照, 并锁住这些行直到计划事务提交,
+        #      重试时也能拿到nova-compute刚写入的updated_at.)
+        node_ref_list = self.session.query(objects.ComputeNode.id,
+                                           objects.ComputeNode.host,
+                                           objects.ComputeNode.updated_at)\
+                .filter(objects.ComputeNode.host.in_(hosts))\
+                .filter(objects.ComputeNode.deleted == 0)\
+                .with_for_update()\
+                .all()
+        return {m.host: (m.id, m.updated_at) for m in node_ref_list}
+
+    def update_node(self, host, version, usage):
+        # NOTE(乐观并发: 只有updated_at没被nova-compute的周期任务改过时才更新,
+        #      否则加锁重新读取版本后再试, 避免覆盖resource tracker刚写入的值.)
+        values = {getattr(objects.ComputeNode, k):
+                  getattr(objects.ComputeNode, k) + v
+                  for k, v in usage.items() if v}
+        for _ in range(self.retries):
+            node_id, updated_at = version
+            values[objects.ComputeNode.updated_at] = datetime.now()
+            count = self.session.query(objects.ComputeNode)\
+                    .filter(objects.ComputeNode.id == node_id)\
+                    .filter(objects.ComputeNode.updated_at == updated_at)\
+                    .update(values, synchronize_session=False)
+            if count:
+                return
+            LOG.warning('Hypervisor: %s compute node changed concurrently, '
+                        'retry.' % host)
+            version = self.read_versions([host]).get(host)
+            if version is None:
+                break
+        raise Exception('更新计算节点: %s 资源使用量失败!' % host)
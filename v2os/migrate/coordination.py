@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+import time
+import socket
+import logging
+import threading
+import contextlib
+
+from oslo_config import cfg
+from oslo_db import exception as db_exc
+from osmo.db import get_session
+from sqlalchemy import or_
+
+from v2os.objects.coordination import Lease
+
+LOG = logging.getLogger(__name__)
+
+CONF = cfg.CONF
+
+default_opts = [
+    cfg.BoolOpt('coordination', default=False,
+                help='share the job queue and hypervisor/bridge leases '
+                     'with other migrator nodes through the database.'),
+    cfg.StrOpt('node_name', default=socket.gethostname(),
+               help='name of this migrator node.'),
+    cfg.IntOpt('lease_ttl', default=60,
+               help='seconds a lease or running job stays valid without '
+                    'heartbeat.'),
+    cfg.IntOpt('lease_wait', default=1800,
+               help='max seconds to wait for a lease held by others.'),
+]
+
+CONF.register_cli_opts(default_opts)
+
+
+class LeaseManager:
+    """Leases on shared hosts so only one holder operates on them at once.
+
+    A lease is a row(name, owner, expires_at). It is taken when missing or
+    expired and renewed by a heartbeat thread every ttl/3 while held, so a
+    crashed node releases its leases after ttl seconds.
+
+    usage:
+
+        leases = LeaseManager()
+        holder = '%s/%s' % (leases.node, instance_uuid)
+        with leases.hold('bridge:dx-tkvm00.dx:br1220', holder):
+            ...restart dnsmasq
+    """
+
+    def __init__(self, ttl=None, wait=None, node=None):
+        self.node = node or CONF.node_name
+        self.ttl = ttl or CONF.lease_ttl
+        self.wait = wait or CONF.lease_wait
+        self.lock = threading.Lock()
+        self.held = {}
+        self.heartbeat = None
+
+    def acquire(self, name, holder):
+        """Take or renew the lease, return whether the holder owns it.
+        """
+        now = time.time()
+        session = get_session()
+        try:
+            with session.begin():
+                updated = session.query(Lease)\
+                        .filter(Lease.name == name)\
+                        .filter(or_(Lease.expires_at < now,
+                                    Lease.owner == holder))\
+                        .update({'owner': holder,
+                                 'expires_at': now + self.ttl},
+                                synchronize_session=False)
+                if updated:
+                    return True
+                if session.query(Lease.name)\
+                        .filter(Lease.name == name).first():
+                    return False
+                session.add(Lease(name=name, owner=holder,
+                                  expires_at=now + self.ttl))
+            return True
+        except db_exc.DBDuplicateEntry:
+            # NOTE(其它节点同时插入了这个lease.)
+            return False
+
+    def extend(self, name, holder):
+        """Renew a lease still owned by the holder.
+        """
+        session = get_session()
+        with session.begin():
+            return session.query(Lease)\
+                    .filter(Lease.name == name)\
+                    .filter(Lease.owner == holder)\
+                    .update({'expires_at': time.time() + self.ttl},
+                            synchronize_session=False)
+
+    def release(self, name, holder):
+        session = get_session()
+        with session.begin():
+            session.query(Lease)\
+                .filter(Lease.name == name)\
+                .filter(Lease.owner == holder)\
+                .delete(synchronize_session=False)
+
+    @contextlib.contextmanager
+    def hold(self, name, holder):
+        deadline = time.time() + self.wait
+        while not self.acquire(name, holder):
+            if time.time() > deadline:
+                raise Exception('等待: %s 的租约超时!' % name)
+            time.sleep(1)
+        LOG.info('Lease: %s acquired by %s.' % (name, holder))
+
+        with self.lock:
+            self.held[(name, holder)] = True
+            self.start_heartbeat()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.held.pop((name, holder), None)
+            self.release(name, holder)
+            LOG.info('Lease: %s released by %s.' % (name, holder))
+
+    def start_heartbeat(self):
+        if self.heartbeat is not None and self.heartbeat.is_alive():
+            return
+        self.heartbeat = threading.Thread(target=self.renew,
+                                          name='lease-heartbeat')
+        self.heartbeat.daemon = True
+        self.heartbeat.start()
+
+    def renew(self):
+        while True:
+            time.sleep(self.ttl / 3.0)
+            with self.lock:
+                held = list(self.held)
+            for name, holder in held:
+                try:
+                    if not self.extend(name, holder) and \
+                       (name, holder) in self.held:
+                        LOG.error('Lease: %s of %s lost!' % (name, holder))
+                except Exception:
+                    LOG.exception('Renew lease: %s failed.' % name)
+
+
+_LEASES = None
+
+
+def get_lease_manager():
+    """Return the process wide lease manager, None without coordination.
+    """
+    global _LEASES
+    if not CONF.coordination:
+        return None
+    if _LEASES is None:
+        _LEASES = LeaseManager()
+    return _LEASES
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+import json
+import logging
+import threading
+
+from flask import request
+from oslo_config import cfg
+from osmo.db import get_engine
+from osmo.util import context
+from osmo.wsgi import WSGIApplication
+from werkzeug.serving import run_simple
+
+from v2os.migrate import cache
+from v2os.migrate import jobs
+from v2os.migrate.batch import GroupCommit, parse_spec
+from v2os.migrate.builder import KVMInstance, Nova
+from v2os.objects.coordination import create_tables
+
+LOG = logging.getLogger(__name__)
+
+CONF = cfg.CONF
+
+default_opts = [
+    cfg.StrOpt('job_queue', default='/var/lib/v2os/jobs.db',
+               help='sqlite file of the migration job queue.'),
+    cfg.IntOpt('job_poll', default=2,
+               help='seconds between two scans of the job queue.'),
+]
+
+CONF.register_cli_opts(default_opts)
+
+# NOTE(只监听本机, 由迁移平台在跳板机上调用; 引用数据在常驻进程里缓存.)
+CONF.set_default('bind', '127.0.0.1', 'WEB')
+CONF.set_default('port', 7070, 'WEB')
+CONF.set_default('debug', False)
+CONF.set_default('reference_cache_ttl', 300)
+
+
+class Dispatcher:
+    """Feed the queued jobs to the group commit pipeline.
+
+    At most batch_size + batch_workers jobs are in flight, the rest stay in
+    the queue so a restart loses nothing.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.wakeup = threading.Event()
+        self.slots = threading.Semaphore(CONF.batch_size + CONF.batch_workers)
+        self.pipeline = GroupCommit(Nova(), size=CONF.batch_size,
+                                    wait=CONF.batch_wait,
+                                    workers=CONF.batch_workers)
+        self.thread = threading.Thread(target=self.loop, name='dispatcher')
+        self.thread.daemon = True
+
+    def start(self):
+        # NOTE(没有journal时中断的任务无法续跑, 重新规划会重复创建实例.)
+        self.queue.recover(requeue=bool(CONF.journal))
+        self.pipeline.start()
+        self.thread.start()
+
+    def notify(self):
+        self.wakeup.set()
+
+    def loop(self):
+        while True:
+            self.wakeup.wait(CONF.job_poll)
+            self.wakeup.clear()
+            try:
+                self.queue.heartbeat()
+                self.dispatch()
+            except Exception:
+                LOG.exception('Dispatch migration jobs failed.')
+
+    def dispatch(self):
+        while self.slots.acquire(blocking=False):
+            claimed = self.queue.claim(1)
+            if not claimed:
+                self.slots.release()
+                return
+            self.submit(claimed[0])
+
+    def submit(self, job):
+        try:
+            builder = KVMInstance(parse_spec(job['spec']))
+        except Exception as _ex:
+            LOG.exception('Create builder for job: %s failed.' % job['id'])
+            self.queue.fail(job['id'], str(_ex), {})
+            self.slots.release()
+            return
+
+        future = self.pipeline.submit(builder)
+        future.add_done_callback(
+            lambda f: self.done(job['id'], builder, f))
+
+    def done(self, job_id, builder, future):
+        try:
+            error = future.exception()
+            if error is None:
+                self.queue.finish(job_id, future.result(), builder.timings)
+            else:
+                self.queue.fail(job_id, str(error), builder.timings)
+        finally:
+            builder.journal.close()
+            self.slots.release()
+            self.notify()
+
+
+class Migrated(WSGIApplication):
+    name = 'migrated'
+    version = '0.1'
+
+    def __init__(self):
+        super(Migrated, self).__init__()
+
+    def init_flask(self):
+        super(Migrated, self).init_flask()
+        self.flask_app.add_url_rule('/jobs', 'submit', self.submit_job,
+                                    methods=['POST'])
+        self.flask_app.add_url_rule('/jobs', 'list', self.list_jobs,
+                                    methods=['GET'])
+        self.flask_app.add_url_rule('/jobs/<int:job_id>', 'show',
+                                    self.show_job, methods=['GET'])
+        self.flask_app.add_url_rule('/cache', 'clear', self.clear_cache,
+                                    methods=['DELETE'])
+
+    def submit_job(self):
+        """POST /jobs, body is one vm spec or a list of them.
+        """
+        try:
+            specs = json.loads(request.get_data(as_text=True) or 'null')
+            if not isinstance(specs, list):
+                specs = [specs]
+            for spec in specs:
+                parse_spec(spec)
+        except Exception as _ex:
+            return context(1, str(_ex))
+
+        job_ids = [self.queue.submit(spec) for spec in specs]
+        self.dispatcher.notify()
+        return context(0, data=job_ids)
+
+    def list_jobs(self):
+        status = request.args.get('status')
+        limit = request.args.get('limit', 100, type=int)
+        return context(0, data=self.queue.list(status, limit))
+
+    def show_job(self, job_id):
+        job = self.queue.get(job_id)
+        if job is None:
+            return context(1, '任务: %s 不存在!' % job_id)
+        return context(0, data=job)
+
+    def clear_cache(self):
+        cache.clear()
+        return context(0)
+
+    def run(self):
+        engine = get_engine()
+        if CONF.coordination:
+            # NOTE(多个迁移节点共用数据库中的任务队列.)
+            create_tables(engine)
+            self.queue = jobs.DBJobQueue(CONF.node_name, CONF.lease_ttl)
+        else:
+            self.queue = jobs.JobQueue(CONF.job_queue)
+        self.dispatcher = Dispatcher(self.queue)
+        self.dispatcher.start()
+        LOG.info('Migrate daemon: %s listen on %s:%s, coordination: %s'
+                 % (CONF.node_name, CONF.WEB.bind, CONF.WEB.port,
+                    CONF.coordination))
+
+        # NOTE(任务队列和连接池都在本进程内, 不能用gunicorn多进程或reloader.)
+        run_simple(CONF.WEB.bind, CONF.WEB.port, self.flask_app,
+                   threaded=True, use_reloader=False, use_debugger=False)
+
+
+v2os_migrated = Migrated().entry_point()
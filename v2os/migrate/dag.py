@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+import time
+import logging
+from concurrent import futures
+
+LOG = logging.getLogger(__name__)
+
+
+class Step:
+
+    def __init__(self, name, func, requires=(), provides=()):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+        self.provides = tuple(provides)
+
+
+class StepGraph:
+    """Run build steps as a dependency graph with maximal overlap.
+
+    Every step declares the names it requires and provides. A step is
+    started as soon as all its inputs are available, it is called with them
+    as keyword arguments and must return a dict with what it provides.
+
+    usage:
+
+        graph = StepGraph()
+        graph.add('mkdir', self.build_dir, provides=['instance_dir'])
+        graph.add('disk', self.stage_disk, requires=['instance_dir'])
+        outputs = graph.run()
+
+    If a step fails no new step is started, the running ones are waited for
+    and the first exception is raised. The elapsed seconds of every finished
+    step are kept in `timings`.
+    """
+
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.steps = []
+        self.timings = {}
+
+    def add(self, name, func, requires=(), provides=()):
+        self.steps.append(Step(name, func, requires, provides))
+
+    def check(self, inputs):
+        """Every input must be provided exactly once, and no cycle.
+        """
+        providers = {name: None for name in inputs}
+        for step in self.steps:
+            for name in step.provides:
+                if name in providers:
+                    raise Exception('步骤: %s 的输出: %s 重复!'
+                                    % (step.name, name))
+                providers[name] = step
+
+        available = set(inputs)
+        pending = list(self.steps)
+        while pending:
+            ready = [s for s in pending if available.issuperset(s.requires)]
+            if not ready:
+                missing = {s.name: sorted(set(s.requires) - available)
+                           for s in pending}
+                raise Exception('步骤依赖无法满足或存在环: %s' % missing)
+            for step in ready:
+                available.update(step.provides)
+                pending.remove(step)
+
+    def run(self, **inputs):
+        self.check(inputs)
+
+        context = dict(inputs)
+        pending = list(self.steps)
+        running = {}
+        error = None
+        with futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while pending or running:
+                if error is None:
+                    for step in [s for s in pending
+                                 if all(r in context for r in s.requires)]:
+                        kwargs = {r: context[r] for r in step.requires}
+                        running[pool.submit(self.timed, step, kwargs)] = step
+                        pending.remove(step)
+                if not running:
+                    break
+
+                done, _ = futures.wait(running,
+                                       return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    step = running.pop(future)
+                    try:
+                        outputs = future.result() or {}
+                    except Exception as _ex:
+                        LOG.error('Step: %s failed: %s' % (step.name, _ex))
+                        error = error or _ex
+                        continue
+                    missing = set(step.provides) - set(outputs)
+                    if missing:
+                        error = error or Exception(
+                            '步骤: %s 没有输出: %s' % (step.name,
+                                                   sorted(missing)))
+                        continue
+                    context.update(outputs)
+
+        if error is not None:
+            raise error
+        return context
+
+    def timed(self, step, kwargs):
+        start = time.time()
+        try:
+            return step.func(**kwargs)
+        finally:
+            self.timings[step.name] = round(time.time() - start, 3)
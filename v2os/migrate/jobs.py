@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+import os
+import json
+import time
+import logging
+import sqlite3
+import threading
+
+from osmo.db import get_session, model_query
+
+from v2os.objects.coordination import MigrationJob
+
+LOG = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCESS = 'success'
+FAILED = 'failed'
+
+INTERRUPTED = ('interrupted without a journal, the database plan may be '
+               'committed: check the instance and clean it up with '
+               '--teardown_uuids before submitting it again')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    spec TEXT NOT NULL,
+    status TEXT NOT NULL,
+    uuid TEXT,
+    error TEXT,
+    timings TEXT NOT NULL DEFAULT '{}',
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+)
+"""
+
+_COLUMNS = ('id', 'spec', 'status', 'uuid', 'error', 'timings',
+            'created_at', 'started_at', 'finished_at')
+
+
+class JobQueue:
+    """Durable queue of migration jobs, one vm spec per job.
+
+    usage:
+
+        jobs = JobQueue('/var/lib/v2os/jobs.db')
+        job_id = jobs.submit({'hostname': 'yy-jinlong00.yy'})
+        for job in jobs.claim(10):
+            ...
+            jobs.finish(job['id'], uuid=instance_uuid, timings=timings)
+
+    Jobs left running by a stopped daemon are queued again by `recover`
+    when the journal is enabled, which lets them resume from the failed
+    step; without it they are failed, planning them again would create a
+    second instance.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = self.connect(path)
+
+    def connect(self, path):
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        conn = sqlite3.connect(path, timeout=30, check_same_thread=False,
+                               isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(_SCHEMA)
+        return conn
+
+    def submit(self, spec):
+        with self.lock:
+            cursor = self.conn.execute(
+                'INSERT INTO jobs (spec, status, created_at) VALUES (?, ?, ?)',
+                (json.dumps(spec), QUEUED, time.time()))
+        LOG.info('Submit job: %s spec: %s' % (cursor.lastrowid, spec))
+        return cursor.lastrowid
+
+    def claim(self, limit):
+        """Mark up to `limit` queued jobs as running, oldest first.
+        """
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self.conn.execute(
+                    'SELECT %s FROM jobs WHERE status = ? ORDER BY id '
+                    'LIMIT ?' % ', '.join(_COLUMNS),
+                    (QUEUED, limit)).fetchall()
+                now = time.time()
+                self.conn.executemany(
+                    'UPDATE jobs SET status = ?, started_at = ? '
+                    'WHERE id = ?', [(RUNNING, now, r[0]) for r in rows])
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        jobs = [self.to_dict(row) for row in rows]
+        for job in jobs:
+            job['status'] = RUNNING
+        return jobs
+
+    def finish(self, job_id, uuid, timings):
+        self.update(job_id, SUCCESS, uuid=uuid, timings=timings)
+
+    def fail(self, job_id, error, timings):
+        self.update(job_id, FAILED, error=error, timings=timings)
+
+    def update(self, job_id, status, uuid=None, error=None, timings=None):
+        with self.lock:
+            self.conn.execute(
+                'UPDATE jobs SET status = ?, uuid = ?, error = ?, '
+                'timings = ?, finished_at = ? WHERE id = ?',
+                (status, uuid, error, json.dumps(timings or {}),
+                 time.time(), job_id))
+        LOG.info('Job: %s %s, instance: %s' % (job_id, status, uuid))
+
+    def recover(self, requeue=True):
+        """Queue again the jobs that were running when the daemon stopped,
+        fail them when they can not resume(`requeue` False).
+        """
+        with self.lock:
+            if requeue:
+                cursor = self.conn.execute(
+                    'UPDATE jobs SET status = ?, started_at = NULL '
+                    'WHERE status = ?', (QUEUED, RUNNING))
+            else:
+                cursor = self.conn.execute(
+                    'UPDATE jobs SET status = ?, error = ?, finished_at = ? '
+                    'WHERE status = ?',
+                    (FAILED, INTERRUPTED, time.time(), RUNNING))
+        if cursor.rowcount and requeue:
+            LOG.info('Recover %d running jobs to queue.' % cursor.rowcount)
+        elif cursor.rowcount:
+            LOG.warning('Fail %d running jobs interrupted without a journal.'
+                        % cursor.rowcount)
+        return cursor.rowcount
+
+    def get(self, job_id):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT %s FROM jobs WHERE id = ?' % ', '.join(_COLUMNS),
+                (job_id,)).fetchone()
+        return self.to_dict(row) if row else None
+
+    def list(self, status=None, limit=100):
+        sql = 'SELECT %s FROM jobs' % ', '.join(_COLUMNS)
+        args = []
+        if status:
+            sql += ' WHERE status = ?'
+            args.append(status)
+        sql += ' ORDER BY id DESC LIMIT ?'
+        args.append(limit)
+        with self.lock:
+            rows = self.conn.execute(sql, args).fetchall()
+        return [self.to_dict(row) for row in rows]
+
+    def heartbeat(self):
+        """Jobs of a single node need no heartbeat.
+        """
+
+    def to_dict(self, row):
+        job = dict(zip(_COLUMNS, row))
+        job['spec'] = json.loads(job['spec'])
+        job['timings'] = json.loads(job['timings'])
+        return job
+
+
+class DBJobQueue:
+    """Job queue in the nova database shared by several migrator nodes.
+
+    Every node claims queued jobs with SELECT ... FOR UPDATE SKIP LOCKED
+    (mysql 8.0+), so nodes never wait on or pick the same rows. A node
+    heartbeats its running jobs; running jobs of a node silent for more
+    than lease_ttl are marked failed, since their journal is on that node.
+    """
+
+    def __init__(self, node, ttl):
+        self.node = node
+        self.ttl = ttl
+        self.beaten_at = 0
+
+    def submit(self, spec):
+        job_ref = MigrationJob(spec=json.dumps(spec), status=QUEUED,
+                               created_at=time.time())
+        session = get_session()
+        with session.begin():
+            session.add(job_ref)
+        LOG.info('Submit job: %s spec: %s' % (job_ref.id, spec))
+        return job_ref.id
+
+    def claim(self, limit):
+        now = time.time()
+        session = get_session()
+        with session.begin():
+            job_refs = session.query(MigrationJob)\
+                    .filter(MigrationJob.status == QUEUED)\
+                    .order_by(MigrationJob.id)\
+                    .limit(limit)\
+                    .with_for_update(skip_locked=True)\
+                    .all()
+            for job_ref in job_refs:
+                job_ref.status = RUNNING
+                job_ref.owner = self.node
+                job_ref.started_at = now
+                job_ref.heartbeat_at = now
+        return [self.to_dict(job_ref) for job_ref in job_refs]
+
+    def finish(self, job_id, uuid, timings):
+        self.update(job_id, SUCCESS, uuid=uuid, timings=timings)
+
+    def fail(self, job_id, error, timings):
+        self.update(job_id, FAILED, error=error, timings=timings)
+
+    def update(self, job_id, status, uuid=None, error=None, timings=None):
+        session = get_session()
+        with session.begin():
+            session.query(MigrationJob)\
+                .filter(MigrationJob.id == job_id)\
+                .update({'status': status, 'uuid': uuid, 'error': error,
+                         'timings': json.dumps(timings or {}),
+                         'finished_at': time.time()},
+                        synchronize_session=False)
+        LOG.info('Job: %s %s, instance: %s' % (job_id, status, uuid))
+
+    def recover(self, requeue=True):
+        """Queue again the jobs this node was running when it stopped,
+        fail them when they can not resume(`requeue` False).
+        """
+        if requeue:
+            values = {'status': QUEUED, 'owner': None, 'started_at': None,
+                      'heartbeat_at': None}
+        else:
+            values = {'status': FAILED, 'error': INTERRUPTED,
+                      'finished_at': time.time()}
+        session = get_session()
+        with session.begin():
+            count = session.query(MigrationJob)\
+                    .filter(MigrationJob.status == RUNNING)\
+                    .filter(MigrationJob.owner == self.node)\
+                    .update(values, synchronize_session=False)
+        if count and requeue:
+            LOG.info('Recover %d running jobs to queue.' % count)
+        elif count:
+            LOG.warning('Fail %d running jobs interrupted without a journal.'
+                        % count)
+        return count
+
+    def heartbeat(self):
+        """Renew the running jobs of this node, fail those of dead nodes.
+        """
+        now = time.time()
+        if now - self.beaten_at < self.ttl / 3.0:
+            return
+        self.beaten_at = now
+        session = get_session()
+        with session.begin():
+            session.query(MigrationJob)\
+                .filter(MigrationJob.status == RUNNING)\
+                .filter(MigrationJob.owner == self.node)\
+                .update({'heartbeat_at': now}, synchronize_session=False)
+            expired = session.query(MigrationJob)\
+                    .filter(MigrationJob.status == RUNNING)\
+                    .filter(MigrationJob.heartbeat_at < now - self.ttl)\
+                    .update({'status': FAILED, 'finished_at': now,
+                             'error': 'node heartbeat timeout'},
+                            synchronize_session=False)
+        if expired:
+            LOG.warning('Fail %d jobs of dead migrator nodes.' % expired)
+
+    def get(self, job_id):
+        job_ref = model_query(MigrationJob)\
+                .filter(MigrationJob.id == job_id)\
+                .first()
+        return self.to_dict(job_ref) if job_ref else None
+
+    def list(self, status=None, limit=100):
+        query = model_query(MigrationJob)
+        if status:
+            query = query.filter(MigrationJob.status == status)
+        job_refs = query.order_by(MigrationJob.id.desc()).limit(limit).all()
+        return [self.to_dict(job_ref) for job_ref in job_refs]
+
+    def to_dict(self, job_ref):
+        job = {name: getattr(job_ref, name) for name in _COLUMNS}
+        job['owner'] = job_ref.owner
+        job['spec'] = json.loads(job['spec'])
+        job['timings'] = json.loads(job['timings'] or '{}')
+        return job
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+import os
+import json
+import time
+import logging
+import sqlite3
+import threading
+
+from oslo_config import cfg
+
+LOG = logging.getLogger(__name__)
+
+CONF = cfg.CONF
+
+default_opts = [
+    cfg.StrOpt('journal', default='',
+               help='sqlite file recording the finished steps of each vm, '
+                    'a rerun resumes from the failed step. empty: disabled.'),
+]
+
+CONF.register_cli_opts(default_opts)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS journal (
+    vm TEXT NOT NULL,
+    step TEXT NOT NULL,
+    outputs TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (vm, step)
+)
+"""
+
+
+# NOTE(同一个journal文件的所有vm共用一个连接和锁, 批量时不会每台vm
+#      占用一个文件描述符; 最后一个使用者close时才关闭连接.)
+_CONNECTIONS = {}
+_LOCK = threading.Lock()
+
+
+def connect(path):
+    """Return the shared [connection, lock, users] of a journal file.
+    """
+    key = os.path.abspath(path)
+    with _LOCK:
+        entry = _CONNECTIONS.get(key)
+        if entry is None:
+            dirname = os.path.dirname(key)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            conn = sqlite3.connect(key, timeout=30, check_same_thread=False,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(_SCHEMA)
+            entry = _CONNECTIONS[key] = [conn, threading.Lock(), 0]
+        entry[2] += 1
+        return entry
+
+
+def release(path):
+    key = os.path.abspath(path)
+    with _LOCK:
+        entry = _CONNECTIONS[key]
+        entry[2] -= 1
+        if entry[2] > 0:
+            return
+        del _CONNECTIONS[key]
+    with entry[1]:
+        entry[0].close()
+
+
+class Journal:
+    """Durable record of the finished steps of one vm and their outputs.
+
+    usage:
+
+        journal = Journal(CONF.journal, 'yy-jinlong00.yy@dx-tkvm00.dx')
+        done = journal.get('step15')
+        if not done:
+            ...
+            journal.record('step15', xml_hash=xml_hash)
+
+    With an empty path the journal is disabled: nothing is recorded and
+    every step is reported as not done. The journals of one file share a
+    connection, keyed by vm in the table.
+    """
+
+    def __init__(self, path, vm):
+        self.path = path
+        self.vm = vm
+        self.conn = None
+        self.lock = None
+        if path:
+            self.conn, self.lock, _ = connect(path)
+
+    @property
+    def enabled(self):
+        return self.conn is not None
+
+    def get(self, step):
+        """Return the outputs of a finished step, None if not finished.
+        """
+        if not self.enabled:
+            return None
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT outputs FROM journal WHERE vm = ? AND step = ?',
+                (self.vm, step)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def record(self, step, **outputs):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?)',
+                (self.vm, step, json.dumps(outputs), time.time()))
+        LOG.debug('Journal vm: %s step: %s outputs: %s'
+                  % (self.vm, step, outputs))
+
+    def discard(self, step=None):
+        """Forget one step, or all the steps of the vm.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            if step is None:
+                self.conn.execute('DELETE FROM journal WHERE vm = ?',
+                                  (self.vm,))
+            else:
+                self.conn.execute(
+                    'DELETE FROM journal WHERE vm = ? AND step = ?',
+                    (self.vm, step))
+
+    def close(self):
+        if not self.enabled:
+            return
+        self.conn = None
+        self.lock = None
+        release(self.path)
@@ -6,47 +6,106 @@
 #
 
 import json
+import time
+import shlex
+import base64
+import inspect
+import hashlib
 import logging
-import netaddr
+import threading
+import contextlib
+import subprocess
 
-import paramiko
-from dotmap import DotMap
+from concurrent import futures
 from oslo_config import cfg
 
 from v2os.migrate.manager import Manager
 from v2os import objects
 from v2os.libvirt.config import LibvirtConfigGuest
 from v2os.libvirt.driver import LibvirtDriver
+from v2os.migrate.journal import Journal
+from v2os.migrate.cache import cached
+from v2os.migrate.dag import StepGraph
+from v2os.disk import delta, fetch, probe, qcow2, stage, verify, vmdk
 
 LOG = logging.getLogger(__name__)
 
 CONF = cfg.CONF
 
-vm_opts = [
-    cfg.StrOpt('mount', default='/data', help='nova instance mount dir.'),
-    cfg.StrOpt('source', default='/opt/migrate',
-               help='migrate image disk source directory.')
+default_opts = [
+    cfg.IntOpt('fetch_connections', default=8,
+               help='parallel range requests pulling a disk from its '
+                    'source_url.'),
+    cfg.IntOpt('fetch_chunk_mb', default=64,
+               help='size of the chunks a disk is pulled and resumed in.'),
+    cfg.BoolOpt('fetch_insecure', default=False,
+                help='do not verify the certificate of the source_url.'),
+    cfg.StrOpt('fetch_user', default='',
+               help='basic auth user of the source_url.'),
+    cfg.StrOpt('fetch_password', default='', secret=True,
+               help='basic auth password of the source_url.'),
+    cfg.IntOpt('delta_block_kb', default=4096,
+               help='block size compared by the delta sync.'),
+    cfg.IntOpt('delta_workers', default=4,
+               help='threads hashing the blocks on each host.'),
+    cfg.IntOpt('delta_streams', default=4,
+               help='parallel streams sending the changed blocks.'),
+    cfg.StrOpt('transfer_encoding', default='none',
+               choices=['none', 'zlib', 'lzma'],
+               help='compress the blocks sent by the delta sync, blocks '
+                    'not compressed well are sent raw.'),
+    cfg.IntOpt('transfer_procs', default=4,
+               help='processes compressing(and decompressing) the blocks '
+                    'of each stream.'),
+    cfg.BoolOpt('zero_detect', default=True,
+                help='leave the zero ranges of thick disks as holes: the '
+                     'sparse disk staging reads a fully allocated source '
+                     'instead of copying it in the kernel(thin ones are '
+                     'still copied in the kernel), the pulls and delta '
+                     'sync punch zero blocks instead of writing them.'),
+    cfg.BoolOpt('disk_verify', default=True,
+                help='compare the staged(sparse copy) or delta synced disk '
+                     'with its source chunk by chunk on the hosts.'),
+    cfg.IntOpt('verify_chunk_mb', default=64,
+               help='chunk size digested by the disk verification.'),
+    cfg.IntOpt('verify_workers', default=4,
+               help='threads reading and digesting the chunks.'),
+    cfg.IntOpt('convert_procs', default=4,
+               help='processes inflating the grains of a vmdk source.'),
 ]
 
-keystone_opts = [
-    cfg.StrOpt('user_id', default='', help='current user id'),
-    cfg.StrOpt('tenant_id', default='', help='current tenant id'),
-]
+CONF.register_cli_opts(default_opts)
+CONF.import_opt('remote_python', 'v2os.migrate.spec')
+CONF.import_opt('disk_staging', 'v2os.migrate.spec')
 
-glance_opts = [
-    cfg.StrOpt('image_ref', default='', help='current image id')
-]
 
-CONF.register_cli_opts(vm_opts, 'VM')
-CONF.register_opts(keystone_opts, 'KEYSTONE')
-CONF.register_opts(glance_opts, 'GLANCE')
+class SSHPool:
+    """Open ssh connections kept per host and reused by every command.
 
+    NOTE(paramiko的transport支持多个channel并发, 同一台宿主机上的命令
+         共用一个连接, 不再每条命令都重新握手.)
+    """
 
-class RPC:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = {}
+
+    def get(self, host, port, user, pswd):
+        key = (host, port, user)
+        with self.lock:
+            ssh = self.clients.get(key)
+            if ssh is not None:
+                transport = ssh.get_transport()
+                if transport is not None and transport.is_active():
+                    return ssh
+                ssh.close()
+            ssh = self.connect(host, port, user, pswd)
+            self.clients[key] = ssh
+            return ssh
+
+    def connect(self, host, port, user, pswd):
+        import paramiko
 
-    def execute(self, host, cmd, port=22, user='root', pswd=''):
-        """Remote commond execute.
-        """
         ssh = paramiko.SSHClient()
         ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         try:
@@ -56,11 +115,428 @@ class RPC:
             LOG.error('host: %s ssh remote connect failed: %s'
                       % (host, str(_ex)))
             raise Exception('连接到目标机器: %s 失败!' % host)
-        stdin, stdout, stderr = ssh.exec_command(cmd)
+        return ssh
+
+    def discard(self, host, port, user):
+        with self.lock:
+            ssh = self.clients.pop((host, port, user), None)
+        if ssh is not None:
+            ssh.close()
+
+
+SSH_POOL = SSHPool()
+
+# NOTE(同一进程内并行迁移到同一宿主机的虚拟机共用base, 只拉取一次.)
+BASE_LOCK = threading.Lock()
+BASE_LOCKS = {}
+
+# NOTE(同一进程内并行构建的虚拟机按租约名互斥, 数据库租约只用于多个
+#      迁移进程/节点之间.)
+LEASE_LOCK = threading.Lock()
+LEASE_LOCKS = {}
+
+
+def format_network(network_ref, ip, mac, hostname):
+    """Network info of an instance, for the bridge、dhcp and libvirt xml.
+    """
+    import netaddr
+    from dotmap import DotMap
+
+    net = DotMap()
+    net.mac = mac
+    net.vlan = network_ref.vlan
+    net.bridge = network_ref.bridge
+    net.label = network_ref.label
+    net.cidr = network_ref.cidr
+    net.netmask = network_ref.netmask
+    net.gateway = network_ref.gateway
+    net.dhcp_server = network_ref.dhcp_server
+    net.dhcp_start = network_ref.dhcp_start
+    net.lease_max = netaddr.IPNetwork(network_ref.cidr).size
+    net.ip = ip
+    net.hostname = hostname
+    return net.toDict()
+
+
+class RPC:
+    """Commands and scripts on the remote hosts.
+
+    The remote python and the disk staging are of `spec`, the vm being
+    migrated; without one(the batch level tools) of the configuration.
+    """
+
+    spec = None
+
+    def __init__(self, spec=None):
+        self.spec = spec
+
+    @property
+    def python(self):
+        if self.spec is None:
+            return CONF.remote_python
+        return self.spec.remote_python
+
+    @property
+    def staging(self):
+        if self.spec is None:
+            return CONF.disk_staging
+        return self.spec.disk_staging
+
+    def execute(self, host, cmd, port=22, user='root', pswd=''):
+        """Remote commond execute.
+        """
+        return self.call(host, cmd, port, user, pswd) is not None
+
+    def call(self, host, cmd, port=22, user='root', pswd=''):
+        """Remote commond execute, return its output, None on error.
+        """
+        stdin, stdout, stderr = self.open(host, cmd, port, user, pswd)
+        output = stdout.read()
         err_list = stderr.readlines()
         if len(err_list) > 0:
-            return False
-        return True
+            return None
+        return output.decode('utf-8')
+
+    def open(self, host, cmd, port=22, user='root', pswd=''):
+        """Start a remote command, return its (stdin, stdout, stderr).
+        """
+        import paramiko
+
+        ssh = SSH_POOL.get(host, port, user, pswd)
+        try:
+            return ssh.exec_command(cmd)
+        except paramiko.SSHException:
+            # NOTE(连接被对端关闭时重连一次.)
+            SSH_POOL.discard(host, port, user)
+            ssh = SSH_POOL.get(host, port, user, pswd)
+            return ssh.exec_command(cmd)
+
+    def script_command(self, module, args, env=None, stdin=False):
+        """Command running a module with the remote python, the module
+        source is sent as a here document, or with -c when the script
+        reads its stdin.
+
+        NOTE(模块REQUIRES中的模块一起发送, 预先放入sys.modules.)
+        """
+        prefix = ''.join('%s=%s ' % (k, shlex.quote(v))
+                         for k, v in sorted((env or {}).items()))
+        args = ' '.join(shlex.quote(str(arg)) for arg in args)
+        source = inspect.getsource(module)
+        for required in getattr(module, 'REQUIRES', ()):
+            name = required.__name__.rsplit('.', 1)[-1]
+            code = base64.b64encode(
+                inspect.getsource(required).encode('utf-8')).decode('ascii')
+            source = ("import sys, types, base64\n"
+                      "_module = types.ModuleType('%s')\n"
+                      "exec(base64.b64decode('%s'), _module.__dict__)\n"
+                      "sys.modules['%s'] = _module\n%s"
+                      % (name, code, name, source))
+        if getattr(module, 'REQUIRES', ()):
+            # NOTE(python2要求编码声明在第一行.)
+            source = '# -*- coding: utf-8 -*-\n' + source
+        if stdin:
+            code = "import base64;exec(base64.b64decode('%s'))" % (
+                base64.b64encode(source.encode('utf-8')).decode('ascii'))
+            return '%s%s -c %s %s' % (prefix, self.python,
+                                      shlex.quote(code), args)
+        return "%s%s - %s << 'V2OS_EOF'\n%sV2OS_EOF" % (
+            prefix, self.python, args, source)
+
+    def run_script(self, host, module, args, env=None):
+        """Run a standard library only module with the remote python,
+        return its output, None on error.
+        """
+        return self.call(host, self.script_command(module, args, env))
+
+    def stage_file(self, host, src, dst):
+        """Move a disk file on the remote host, return how it was moved.
+
+        NOTE(源目录和实例目录不在同一文件系统时mv是整盘拷贝, 会把空洞
+             写成0; auto依次尝试rename、reflink和只拷贝已分配extent的
+             稀疏拷贝.)
+        """
+        if self.staging == 'mv':
+            start = time.time()
+            cmd = 'mv %s %s' % (src, dst)
+            if not self.execute(host, cmd):
+                raise Exception('移动磁盘文件失败: %s' % cmd)
+            return {'src': src, 'dst': dst, 'strategy': 'mv',
+                    'elapsed': round(time.time() - start, 3)}
+
+        args = [src, dst]
+        if CONF.zero_detect:
+            args.append('--zeros')
+        if CONF.disk_verify:
+            args.extend(['--verify', '--chunk-kb',
+                         CONF.verify_chunk_mb * 1024,
+                         '--workers', CONF.verify_workers])
+        output = self.run_script(host, stage, args)
+        if output is None:
+            raise Exception('暂存磁盘文件: %s 到: %s 失败(校验不一致时源'
+                            '文件保留)!' % (src, dst))
+        result = json.loads(output)
+        LOG.info('** Stage disk: %s to: %s strategy: %s size: %d copied: %d '
+                 'zero: %d elapsed: %.3fs throughput: %.1fMB/s'
+                 % (src, dst, result['strategy'], result['size'],
+                    result['copied'], result['zero'], result['elapsed'],
+                    result['throughput_mb']))
+        if result['verify']:
+            LOG.info('** Verify disk: %s chunks: %d root: %s elapsed: %.3fs '
+                     'throughput: %.1fMB/s'
+                     % (dst, result['verify']['chunks'],
+                        result['verify']['root'],
+                        result['verify']['elapsed'],
+                        result['verify']['throughput_mb']))
+        return result
+
+    def fetch_file(self, host, url, dst):
+        """Pull a disk from the url into dst on the remote host, resuming
+        an interrupted pull.
+        """
+        args = [url, dst, '--connections', CONF.fetch_connections,
+                '--chunk-mb', CONF.fetch_chunk_mb]
+        if CONF.fetch_insecure:
+            args.append('--insecure')
+        env = {}
+        if CONF.fetch_user:
+            env['V2OS_FETCH_AUTH'] = '%s:%s' % (CONF.fetch_user,
+                                                CONF.fetch_password)
+        output = self.run_script(host, fetch, args, env)
+        if output is None:
+            raise Exception('拉取磁盘文件: %s 到: %s 失败, 重跑可断点续传!'
+                            % (url, dst))
+        result = json.loads(output)
+        LOG.info('** Fetch disk: %s to: %s size: %d chunks: %d resumed: %d '
+                 'connections: %d zero: %d elapsed: %.3fs throughput: '
+                 '%.1fMB/s' % (url, dst, result['size'], result['chunks'],
+                               result['resumed'], result['connections'],
+                               result['zero'], result['elapsed'],
+                               result['throughput_mb']))
+        return result
+
+    def probe_disks(self, host, paths):
+        """Read the headers of the disks(files or urls) on the remote
+        host, return their format, sizes and backing chain.
+        """
+        args = list(paths)
+        if CONF.fetch_insecure:
+            args.append('--insecure')
+        env = {}
+        if CONF.fetch_user:
+            env['V2OS_FETCH_AUTH'] = '%s:%s' % (CONF.fetch_user,
+                                                CONF.fetch_password)
+        output = self.run_script(host, probe, args, env)
+        if output is None:
+            raise Exception('读取宿主机: %s 上的磁盘头失败!' % host)
+        return json.loads(output)
+
+    def delta_sync(self, source_host, source_path, host, dst):
+        """Make dst on the remote host the same as source_path on the
+        source host, sending only the blocks whose hashes differ.
+
+        NOTE(两端在各自主机上并行计算块hash, 只有变化的块经跳板机
+             分多路转发; 目标文件不存在时即为全量拷贝(空洞除外).)
+        """
+        start = time.time()
+        args = ['--block-kb', CONF.delta_block_kb,
+                '--workers', CONF.delta_workers]
+        with futures.ThreadPoolExecutor(max_workers=2) as pool:
+            source_task = pool.submit(self.run_script, source_host, delta,
+                                      ['hash', source_path] + args)
+            target_task = pool.submit(self.run_script, host, delta,
+                                      ['hash', dst] + args)
+            outputs = (source_task.result(), target_task.result())
+        if None in outputs:
+            raise Exception('计算磁盘块hash失败: %s:%s %s:%s'
+                            % (source_host, source_path, host, dst))
+        source, target = [json.loads(output) for output in outputs]
+        if not source['exists']:
+            raise Exception('源磁盘: %s:%s 不存在!'
+                            % (source_host, source_path))
+        hashed = time.time() - start
+
+        # NOTE(目标文件之外的全0块不发送, 截断后即为空洞; 目标文件之内
+        #      变为全0的块也不发送, 由目标端打洞.)
+        hashes = target['hashes']
+        block = source['block']
+        count = len(source['hashes'])
+        last = source['size'] - (count - 1) * block
+        zero = hashlib.sha1(b'\0' * block).hexdigest()
+        empty = set([zero, hashlib.sha1(b'\0' * last).hexdigest()])
+        dirty = [i for i, h in enumerate(source['hashes'])
+                 if (hashes[i] != h if i < len(hashes) else h != zero)]
+        zeros = []
+        if CONF.zero_detect:
+            zeros = [i for i in dirty if source['hashes'][i] in empty]
+            dirty = [i for i in dirty if source['hashes'][i] not in empty]
+        groups = []
+        if dirty or zeros or source['size'] != target['size']:
+            size = max(1, -(-len(dirty) // CONF.delta_streams))
+            groups = [dirty[i:i + size]
+                      for i in range(0, len(dirty), size)] or [[]]
+        # NOTE(打洞的块只交给第一路.)
+        with futures.ThreadPoolExecutor(
+                max_workers=max(1, len(groups))) as pool:
+            results = list(pool.map(
+                lambda item: self.relay_blocks(
+                    source_host, source_path, host, dst, item[1],
+                    source['size'], zeros if item[0] == 0 else ()),
+                enumerate(groups)))
+
+        elapsed = time.time() - start
+        written = sum(r['written'] for r in results)
+        wire = sum(r['wire'] for r in results)
+        reclaimed = sum(r['zero'] for r in results)
+        result = {'size': source['size'], 'blocks': len(source['hashes']),
+                  'dirty': len(dirty) + len(zeros), 'written': written,
+                  'wire': wire, 'zero': reclaimed,
+                  'encoding': CONF.transfer_encoding,
+                  'streams': len(groups), 'hash_elapsed': round(hashed, 3),
+                  'elapsed': round(elapsed, 3),
+                  'throughput_mb': round(written / max(elapsed - hashed,
+                                                       0.001) / 1048576, 1)}
+        if CONF.disk_verify:
+            self.verify_blocks(host, dst, source)
+        LOG.info('** Delta sync disk: %s:%s to: %s:%s blocks: %d dirty: %d '
+                 'written: %d wire(%s): %d zero: %d streams: %d hash: %.3fs '
+                 'elapsed: %.3fs throughput: %.1fMB/s'
+                 % (source_host, source_path, host, dst, result['blocks'],
+                    result['dirty'], written, CONF.transfer_encoding, wire,
+                    reclaimed, result['streams'], hashed,
+                    elapsed, result['throughput_mb']))
+        return result
+
+    def verify_blocks(self, host, dst, source):
+        """Digest dst on the remote host in blocks of the delta sync and
+        compare them with the block hashes of the source.
+
+        NOTE(源端的块hash同步前已算好(源虚拟机已关机), 只需读目标端;
+             只有digest回到跳板机, 数据不回传.)
+        """
+        output = self.run_script(host, verify, [
+            'digest', dst, '--chunk-kb', source['block'] // 1024,
+            '--workers', CONF.verify_workers])
+        if output is None:
+            raise Exception('校验磁盘: %s:%s 失败!' % (host, dst))
+        result = json.loads(output)
+        block = source['block']
+        mismatches = [[i * block, min((i + 1) * block, source['size'])]
+                      for i, (h, d) in enumerate(zip(source['hashes'],
+                                                    result['digests']))
+                      if h != d]
+        if result['size'] != source['size']:
+            mismatches.append([min(result['size'], source['size']),
+                               max(result['size'], source['size'])])
+        if mismatches:
+            raise Exception('同步后的磁盘: %s:%s 与源不一致, 范围: %s'
+                            % (host, dst, verify.merge(mismatches)[:8]))
+        LOG.info('** Verify disk: %s:%s chunks: %d root: %s'
+                 % (host, dst, len(result['digests']), result['root']))
+        return result
+
+    def relay_blocks(self, source_host, source_path, host, dst, blocks,
+                     size, zeros=()):
+        """Stream the blocks from the source host into dst, punch the
+        zero blocks.
+        """
+        args = ['--block-kb', CONF.delta_block_kb,
+                '--ranges', delta.format_ranges(blocks),
+                '--encoding', CONF.transfer_encoding,
+                '--procs', CONF.transfer_procs]
+        _, reader, reader_err = self.open(source_host, self.script_command(
+            delta, ['read', source_path] + args, stdin=True))
+        writer, writer_out, writer_err = self.open(host, self.script_command(
+            delta, ['write', dst, '--size', size,
+                    '--zeros', delta.format_ranges(zeros)] + args,
+            stdin=True))
+        while True:
+            data = reader.read(1024 * 1024)
+            if not data:
+                break
+            writer.write(data)
+        writer.channel.shutdown_write()
+        output = writer_out.read()
+        errors = reader_err.read() + writer_err.read()
+        if reader.channel.recv_exit_status() != 0 or \
+           writer_out.channel.recv_exit_status() != 0 or errors:
+            raise Exception('同步磁盘块到: %s:%s 失败: %s'
+                            % (host, dst, errors[-512:]))
+        return json.loads(output.decode('utf-8'))
+
+    def convert_vmdk(self, host, src, dst):
+        """Convert the streamOptimized vmdk(a file or an url) into the
+        qcow2 dst on the remote host, in one pass while it is read.
+        """
+        args = [src, '--procs', CONF.convert_procs]
+        if CONF.fetch_insecure:
+            args.append('--insecure')
+        env = {}
+        if CONF.fetch_user:
+            env['V2OS_FETCH_AUTH'] = '%s:%s' % (CONF.fetch_user,
+                                                CONF.fetch_password)
+        cmd = '%s | %s' % (
+            self.script_command(vmdk, args, env, stdin=True),
+            self.script_command(qcow2, ['-', dst], stdin=True))
+        output = self.call(host, cmd)
+        if output is None:
+            raise Exception('转换vmdk: %s 到: %s 失败!' % (src, dst))
+        result = json.loads(output)
+        LOG.info('** Convert vmdk: %s to qcow2: %s size: %d clusters '
+                 'written: %d skipped: %d zero: %d elapsed: %.3fs '
+                 'throughput: %.1fMB/s'
+                 % (src, dst, result['size'], result['written'],
+                    result['skipped'], result['zero'], result['elapsed'],
+                    result['throughput_mb']))
+        return result
+
+    def convert_raw(self, host, src, dst):
+        """Convert the raw disk file src into the qcow2 dst on the remote
+        host, reading only its allocated extents.
+        """
+        output = self.run_script(host, qcow2, [src, dst, '--raw'])
+        if output is None:
+            raise Exception('转换raw磁盘: %s 到: %s 失败!' % (src, dst))
+        result = json.loads(output)
+        LOG.info('** Convert raw: %s to qcow2: %s size: %d clusters '
+                 'written: %d skipped: %d zero: %d elapsed: %.3fs '
+                 'throughput: %.1fMB/s'
+                 % (src, dst, result['size'], result['written'],
+                    result['skipped'], result['zero'], result['elapsed'],
+                    result['throughput_mb']))
+        return result
+
+    def ensure_base(self, host, url, base):
+        """Pull the base image into the nova _base cache of the remote host
+        unless it is already there, return whether it was pulled.
+        """
+        with BASE_LOCK:
+            lock = BASE_LOCKS.setdefault((host, base), threading.Lock())
+        with lock:
+            if self.file_exists(host, base):
+                return False
+            self.mkdir(host, base.rsplit('/', 1)[0])
+            self.fetch_file(host, url, base)
+            self.chmod(host, base, '644')
+            self.chown(host, base, 'qemu', 'qemu')
+            return True
+
+    def rebase_disk(self, host, disk_file, base, base_format):
+        """Make the qcow2 disk a thin overlay of the base image.
+
+        NOTE(已是overlay的disk只改backing指针(rebase -u), 内容与base一致
+             由导出方保证; 完整的disk用convert -B重写, 只保留与base不同
+             的cluster.)
+        """
+        thin = '%s.thin' % disk_file
+        cmd = ("if qemu-img info %(disk)s | grep -q '^backing file:'; then "
+               "qemu-img rebase -u -f qcow2 -b %(base)s -F %(fmt)s %(disk)s; "
+               "else qemu-img convert -O qcow2 -B %(base)s "
+               "-o backing_fmt=%(fmt)s %(disk)s %(thin)s && "
+               "mv -f %(thin)s %(disk)s; fi"
+               % {'disk': disk_file, 'base': base, 'fmt': base_format,
+                  'thin': thin})
+        if not self.execute(host, cmd):
+            raise Exception('磁盘: %s 关联base: %s 失败!' % (disk_file, base))
 
     def device_exists(self, host, device):
         """Check remote host if ethernet device exists.
@@ -68,6 +544,18 @@ class RPC:
         cmd = 'ls /sys/class/net/%s' % device
         return self.execute(host, cmd)
 
+    def file_exists(self, host, path):
+        """Check remote host if file or directory exists.
+        """
+        cmd = 'ls %s' % path
+        return self.execute(host, cmd)
+
+    def file_matches(self, host, path, sha1):
+        """Check remote host if file exists and has the sha1 digest.
+        """
+        cmd = "echo '%s  %s' | sha1sum -c --status || ls 999" % (sha1, path)
+        return self.execute(host, cmd)
+
     def mkdir(self, host, path):
         """Make diriectory in the remote host.
         """
@@ -96,6 +584,13 @@ class RPC:
         if not self.execute(host, cmd):
             raise Exception('修改所属用户和所属组: %s 失败!' % cmd)
 
+    def remove(self, host, path):
+        """Remove a file in the remote host.
+        """
+        cmd = 'rm -f %s' % path
+        if not self.execute(host, cmd):
+            raise Exception('删除文件: %s 失败!' % path)
+
     def redirect(self, host, content, dist):
         """Redirect content to dist file, such as: echo 'x' > /tmp/a.log
         """
@@ -124,6 +619,39 @@ EOF""" % (dist, content)
             raise Exception('写入文本数据到文件: %s 失败!' % cmd)
 
 
+class LocalFile(object):
+    """A pipe of a local process, with the channel api of paramiko.
+    """
+
+    def __init__(self, pipe, process):
+        self.pipe = pipe
+        self.channel = self
+        self.process = process
+
+    def __getattr__(self, name):
+        return getattr(self.pipe, name)
+
+    def shutdown_write(self):
+        self.process.stdin.close()
+
+    def recv_exit_status(self):
+        return self.process.wait()
+
+
+class LocalRPC(RPC):
+    """RPC running the commands on this machine whatever the host, to try
+    the remote scripts(such as a swarm of local peers) without ssh.
+    """
+
+    def open(self, host, cmd, port=22, user='root', pswd=''):
+        process = subprocess.Popen(['bash', '-c', cmd],
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        return tuple(LocalFile(pipe, process) for pipe in (
+            process.stdin, process.stdout, process.stderr))
+
+
 class L2Drivier(RPC):
 
     def ensure_vlan(self, hypervisor, vlan):
@@ -180,7 +708,7 @@ class L2Drivier(RPC):
         """Return path to a pid, leases, hosts or conf file for a bridge/device.
         """
         prefix = '%(mount)s/nova/networks/nova-%(bridge)s' % {
-            'mount': CONF.VM.mount, 'bridge': bridge
+            'mount': self.spec.mount, 'bridge': bridge
         }
         return '%(prefix)s.%(kind)s' % {'prefix': prefix, 'kind': kind}
 
@@ -204,6 +732,12 @@ class L2Drivier(RPC):
         hostfile = self._dhcp_file(bridge, 'conf')
         item = '%(mac)s,%(hostname)s,%(ip)s' % {'mac': mac,
                                                 'hostname': hostname, 'ip': ip}
+
+        # NOTE: 重跑时不重复写入同一条记录.
+        cmd = "grep -qsx '%s' %s || ls 999" % (item, hostfile)
+        if self.execute(hypervisor, cmd):
+            LOG.info('** Dhcp config item: %s already exists.' % item)
+            return
         self.add_to(hypervisor, item, hostfile)
         LOG.info('** Create dhcp config item: %s success.' % item)
 
@@ -275,72 +809,265 @@ class L2Drivier(RPC):
 
 class LibvirtManager(Manager, L2Drivier):
 
-    def __init__(self, session, instance_ref):
+    workers = None
+
+    def __init__(self, session, spec, instance_ref, journal=None,
+                 leases=None, network_info=None):
         self.session = session
+        self.spec = spec
         self.instance_ref = instance_ref
-        self.network_info = self.read_network_info()
+        self.journal = journal or Journal('', instance_ref.hostname)
+        self.leases = leases
+        self.network_info = network_info or self.read_network_info()
+        self.flavor_info = self.read_flavor_info()
         self.instance_name = self.generate_instance_name(self.instance_ref.id)
+        self.timings = {}
+
+    def done(self, step, verify=None):
+        """Whether the step is in the journal and its result still there.
+        """
+        outputs = self.journal.get(step)
+        if outputs is None:
+            return None
+        if verify is not None and not verify(outputs):
+            LOG.warning('Journal %s of instance: %s failed verification, '
+                        'redo it.' % (step, self.instance_ref.uuid))
+            self.journal.discard(step)
+            return None
+        LOG.info('%s instance: %s already done, skip.'
+                 % (step, self.instance_ref.uuid))
+        return outputs
+
+    @contextlib.contextmanager
+    def lease(self, name):
+        """Hold the lease of a shared resource of the hypervisor, so other
+        vms do not operate on it at the same time.
+
+        The vms built by this process are serialized by an in-process lock
+        of the name; the database lease(with --coordination) is needed
+        only across migrator processes and nodes.
+        """
+        with LEASE_LOCK:
+            lock = LEASE_LOCKS.setdefault(name, threading.Lock())
+        with lock:
+            if self.leases is None:
+                yield
+                return
+            holder = '%s/%s' % (self.leases.node, self.instance_ref.uuid)
+            with self.leases.hold(name, holder):
+                yield
 
     def build(self):
-        mount = CONF.VM.mount
-        uuid = self.instance_ref.uuid
         hypervisor = self.instance_ref.host
-        vlan = self.network_info.get('vlan')
+        hypervisor_ip = self.get_hypervisor_ip(hypervisor)
 
-        # l2 build
-        self.ensure_vlan(hypervisor, vlan)
-        self.ensure_bridge(hypervisor, self.network_info)
+        # NOTE: 网络设备与实例目录、磁盘互不依赖, 按依赖关系并行执行;
+        #       数据库读取都在这之前完成, 各步骤只做远程操作.
+        graph = StepGraph(workers=self.workers or self.spec.build_workers)
+        graph.add('network', self.build_network, provides=['bridge'])
+        graph.add('step12', self.build_dir, provides=['instance_dir'])
+        graph.add('step13', self.write_disk_info, requires=['instance_dir'],
+                  provides=['info_file'])
+        graph.add('step14', self.write_console, requires=['instance_dir'],
+                  provides=['console_file'])
+        graph.add('step15', self.write_xml, requires=['instance_dir'],
+                  provides=['xml'])
+        graph.add('step16', self.stage_disk, requires=['instance_dir'],
+                  provides=['disk_file'])
+        graph.add('step17', self.boot,
+                  requires=['hypervisor_ip', 'bridge', 'info_file',
+                            'console_file', 'xml', 'disk_file'],
+                  provides=['instance_name'])
+        self.timings = graph.timings
+        outputs = graph.run(hypervisor_ip=hypervisor_ip)
 
-        # NOTE: 应用到线上需要注释掉, 因为需要reload dhcp配置. 而这个reload
-        #       是kill再启动, 所以线上dnsmasq服务还是最好不要动. 同时,
-        #       这个dnsmasq服务启动去掉了--dhcp-script选项, 跟线上还是有差别.
-        self.restart_dhcp(hypervisor, self.network_info)
+        # NOTE: 通过root执行virsh命令后, 必须保证disk的owner为qemu:qemu
+        console_log = """虚拟机已创建完成:
+        1、磁盘路径: %s
+        2、实例名称: %s
+        """ % (outputs['instance_dir'], outputs['instance_name'])
+        self.purple(console_log)
+        return outputs
+
+    def build_network(self):
+        hypervisor = self.instance_ref.host
+        vlan = self.network_info.get('vlan')
+        bridge = self.network_info.get('bridge')
+        if self.done('network', lambda o: self.device_exists(
+                hypervisor, bridge)):
+            return {'bridge': bridge}
+
+        # NOTE: vlan、网桥和dnsmasq是宿主机上同一网桥的虚拟机共用的.
+        with self.lease('bridge:%s:%s' % (hypervisor, bridge)):
+            self.ensure_vlan(hypervisor, vlan)
+            self.ensure_bridge(hypervisor, self.network_info)
+
+            # NOTE: 应用到线上需要注释掉, 因为需要reload dhcp配置. 而这个
+            #       reload是kill再启动, 所以线上dnsmasq服务还是最好不要动.
+            #       同时, 这个dnsmasq服务启动去掉了--dhcp-script选项,
+            #       跟线上还是有差别.
+            self.restart_dhcp(hypervisor, self.network_info)
+        self.journal.record('network', bridge=bridge,
+                            ip=self.network_info.get('ip'),
+                            mac=self.network_info.get('mac'))
+        return {'bridge': bridge}
+
+    def build_dir(self):
+        uuid = self.instance_ref.uuid
+        hypervisor = self.instance_ref.host
+        instance_dir = '%s/nova/instances/%s' % (self.spec.mount, uuid)
+        if self.done('step12', lambda o: self.file_exists(
+                hypervisor, o['instance_dir'])):
+            return {'instance_dir': instance_dir}
 
-        # directory
-        instance_dir = '%s/nova/instances/%s' % (mount, uuid)
         self.mkdir(hypervisor, instance_dir)
+        self.journal.record('step12', instance_dir=instance_dir)
         LOG.info('step12 build instance: %s nova dir: %s success.'
                  % (uuid, instance_dir))
+        return {'instance_dir': instance_dir}
 
-        # disk.info
+    def write_disk_info(self, instance_dir):
+        uuid = self.instance_ref.uuid
+        hypervisor = self.instance_ref.host
         disk_file = '%s/disk' % instance_dir
         info_file = '%s/disk.info' % instance_dir
-        disk_info = json.dumps({disk_file: 'qcow2'})
+        if self.done('step13', lambda o: self.file_exists(
+                hypervisor, info_file)):
+            return {'info_file': info_file}
+
+        disk_info = {disk_file: 'qcow2'}
+        if self.spec.base_url:
+            disk_info[self.spec.base_image] = self.spec.base_format
+        disk_info = json.dumps(disk_info)
         self.textarea(hypervisor, disk_info, info_file)
         self.chown(hypervisor, info_file, 'nova', 'nova')
+        self.journal.record('step13', info_file=info_file)
         LOG.info('step13 write instance: %s disk.info success.' % uuid)
+        return {'info_file': info_file}
 
-        # console.log
+    def write_console(self, instance_dir):
+        uuid = self.instance_ref.uuid
+        hypervisor = self.instance_ref.host
         console_file = '%s/console.log' % instance_dir
+        if self.done('step14', lambda o: self.file_exists(
+                hypervisor, console_file)):
+            return {'console_file': console_file}
+
         self.touch(hypervisor, console_file)
         self.chown(hypervisor, console_file, 'qemu', 'qemu')
+        self.journal.record('step14', console_file=console_file)
         LOG.info('step14 build instance: %s console.log success.' % uuid)
+        return {'console_file': console_file}
 
-        # libvirt.xml
-        xml = self.generate_xml()
+    def write_xml(self, instance_dir):
+        uuid = self.instance_ref.uuid
+        hypervisor = self.instance_ref.host
         libvirt_xml = '%s/libvirt.xml' % instance_dir
+        outputs = self.done('step15', lambda o: self.file_matches(
+            hypervisor, libvirt_xml, o['xml_hash']))
+        if outputs:
+            # NOTE: 用同一个serial uuid重新生成, 与已写入的xml一致.
+            return {'xml': self.generate_xml(outputs['serial_uuid'])}
+
+        serial_uuid = self.generate_uuid()
+        xml = self.generate_xml(serial_uuid)
         self.textarea(hypervisor, xml, libvirt_xml)
         self.chown(hypervisor, libvirt_xml, 'nova', 'nova')
+        self.journal.record('step15', serial_uuid=serial_uuid,
+                            xml_hash=self.xml_hash(xml))
         LOG.info('step15 write instance: %s libvirt.xml success.' % uuid)
+        return {'xml': xml}
 
+    def stage_disk(self, instance_dir):
         # disk (mv /opt/migrate/disk $instance_dir)
-        self.move_disk(hypervisor, instance_dir)
-        LOG.info('step16 move instacne: %s source disk to current instance '
-                 'dir: %s success' % (uuid, instance_dir))
+        uuid = self.instance_ref.uuid
+        hypervisor = self.instance_ref.host
+        disk_file = '%s/disk' % instance_dir
+        if self.done('step16', lambda o: self.file_exists(
+                hypervisor, disk_file)):
+            return {'disk_file': disk_file}
+
+        if self.spec.source_host:
+            # NOTE: 停机后只同步预拷贝(--presync)以来变化的块, 再改名到
+            #       实例目录(同一文件系统); raw磁盘转换为qcow2写入实例目录.
+            self.delta_sync(self.spec.source_host, self.spec.source_path,
+                            hypervisor, self.spec.staging_disk)
+            if self.spec.source_format == 'raw':
+                self.convert_raw(hypervisor, self.spec.staging_disk,
+                                 disk_file)
+                self.remove(hypervisor, self.spec.staging_disk)
+            else:
+                self.stage_file(hypervisor, self.spec.staging_disk,
+                                disk_file)
+            self.chown(hypervisor, disk_file, 'qemu', 'qemu')
+            strategy = 'delta'
+        elif self.spec.source_format == 'vmdk':
+            # NOTE: vcenter导出的vmdk边读边转换为qcow2写入实例目录,
+            #       源文件保留.
+            if self.spec.source_url:
+                self.convert_vmdk(hypervisor, self.spec.source_url, disk_file)
+            else:
+                with self.lease('hypervisor:%s' % hypervisor):
+                    self.convert_vmdk(hypervisor,
+                                      '%s/disk' % self.spec.source, disk_file)
+            self.chown(hypervisor, disk_file, 'qemu', 'qemu')
+            strategy = 'convert'
+        elif self.spec.source_format == 'raw':
+            # NOTE: raw磁盘(如vcenter/esxi的-flat.vmdk)只读取已分配的extent
+            #       转换为qcow2写入实例目录; source_url先拉取到实例目录.
+            if self.spec.source_url:
+                raw_file = '%s.raw' % disk_file
+                self.fetch_file(hypervisor, self.spec.source_url, raw_file)
+                self.convert_raw(hypervisor, raw_file, disk_file)
+                self.remove(hypervisor, raw_file)
+            else:
+                with self.lease('hypervisor:%s' % hypervisor):
+                    self.convert_raw(hypervisor,
+                                     '%s/disk' % self.spec.source, disk_file)
+            self.chown(hypervisor, disk_file, 'qemu', 'qemu')
+            strategy = 'convert'
+        elif self.spec.source_url:
+            # NOTE: 直接拉取到实例目录, 不经过共用的迁移源目录.
+            self.fetch_file(hypervisor, self.spec.source_url, disk_file)
+            self.chown(hypervisor, disk_file, 'qemu', 'qemu')
+            strategy = 'fetch'
+        else:
+            # NOTE: 迁移源目录(source)是宿主机上所有虚拟机共用的.
+            with self.lease('hypervisor:%s' % hypervisor):
+                strategy = self.move_disk(hypervisor, instance_dir)
+        if self.spec.base_url:
+            self.link_base(hypervisor, disk_file)
+            strategy = '%s+base' % strategy
+        self.journal.record('step16', disk_file=disk_file, strategy=strategy)
+        LOG.info('step16 move instacne: %s source disk to current '
+                 'instance dir: %s by %s success'
+                 % (uuid, instance_dir, strategy))
+        return {'disk_file': disk_file}
+
+    def link_base(self, hypervisor, disk_file):
+        """Make the disk a thin overlay of the base image shared by the
+        vms of the hypervisor.
+        """
+        base = self.spec.base_image
+        with self.lease('base:%s:%s' % (hypervisor, base)):
+            if self.ensure_base(hypervisor, self.spec.base_url, base):
+                LOG.info('step16 pull base image: %s to hypervisor: %s '
+                         'success.' % (base, hypervisor))
+        self.rebase_disk(hypervisor, disk_file, base, self.spec.base_format)
+        self.chown(hypervisor, disk_file, 'qemu', 'qemu')
 
+    def boot(self, hypervisor_ip, xml, **kwargs):
         # create virtual machine
-        self.create_vm(hypervisor, instance_dir, xml)
-
-        # NOTE: 通过root执行virsh命令后, 必须保证disk的owner为qemu:qemu
-        console_log = """虚拟机已创建完成:
-        1、磁盘路径: %s
-        2、实例名称: %s
-        """ % (instance_dir, self.instance_name)
-        self.purple(console_log)
+        self.create_vm(self.instance_ref.host, hypervisor_ip, xml)
+        self.journal.record('step17', instance_name=self.instance_name)
+        return {'instance_name': self.instance_name}
 
+    @cached(lambda self: self.instance_ref.instance_type_id)
     def read_flavor_info(self):
+        from dotmap import DotMap
+
         instance_type_id = self.instance_ref.instance_type_id
-        instance_type_ref = self.session.query(objects.InstanceTypes)\
+        instance_type_ref = self.reader.query(objects.InstanceTypes)\
                 .filter(objects.InstanceTypes.id == instance_type_id)\
                 .first()
         flavor = DotMap()
@@ -356,35 +1083,19 @@ class LibvirtManager(Manager, L2Drivier):
                 .filter(objects.VirtualInterface.instance_uuid == domain_uuid)\
                 .first()
         network_id = vif_ref.network_id
-        network_ref = self.session.query(objects.Network)\
+        network_ref = self.reader.query(objects.Network)\
                 .filter(objects.Network.id == network_id)\
                 .first()
         fixed_ip_ref = self.session.query(objects.FixedIp)\
                 .filter(objects.FixedIp.instance_uuid == domain_uuid)\
                 .first()
+        return format_network(network_ref, fixed_ip_ref.address,
+                              vif_ref.address, self.instance_ref.hostname)
 
-        cidr = network_ref.cidr
-        lease_max = netaddr.IPNetwork(cidr).size
-
-        net = DotMap()
-        net.mac = vif_ref.address
-        net.vlan = network_ref.vlan
-        net.bridge = network_ref.bridge
-        net.label = network_ref.label
-        net.cidr = network_ref.cidr
-        net.netmask = network_ref.netmask
-        net.gateway = network_ref.gateway
-        net.dhcp_server = network_ref.dhcp_server
-        net.dhcp_start = network_ref.dhcp_start
-        net.lease_max = lease_max
-        net.ip = fixed_ip_ref.address
-        net.hostname = self.instance_ref.hostname
-        return net.toDict()
-
-    def generate_xml(self):
+    def generate_xml(self, serial_uuid):
         """Generate instance xml.
         """
-        flavor_dict = self.read_flavor_info()
+        flavor_dict = self.flavor_info
         xml_data = {
             'uuid': self.instance_ref.uuid,
             'name': self.instance_name,
@@ -395,44 +1106,64 @@ class LibvirtManager(Manager, L2Drivier):
             'flavor_name': flavor_dict.get('name'),
             'flavor_mem': flavor_dict.get('memory_mb'),
             'flavor_disk': flavor_dict.get('root_gb'),
-            'user_id': CONF.KEYSTONE.user_id,
-            'tenant_id': CONF.KEYSTONE.tenant_id,
-            'image_id': CONF.GLANCE.image_ref,
-            'serial_uuid': self.generate_uuid(),
-            'mount': CONF.VM.mount,
+            'user_id': self.spec.user_id,
+            'tenant_id': self.spec.tenant_id,
+            'image_id': self.spec.image_ref,
+            'serial_uuid': serial_uuid,
+            'mount': self.spec.mount,
             'mac': self.network_info.get('mac'),
             'bridge': self.network_info.get('bridge')
         }
+        if self.spec.base_url:
+            xml_data['backing_file'] = self.spec.base_image
+            xml_data['backing_format'] = self.spec.base_format
         domain = LibvirtConfigGuest(**xml_data)
         return domain.to_xml()
 
+    def xml_hash(self, xml):
+        """Sha1 of the libvirt.xml file content(textarea adds a newline).
+        """
+        return hashlib.sha1(('%s\n' % xml).encode('utf-8')).hexdigest()
+
     def purple(self, output):
         convert = '\033[35m%(output)s\033[0m' % {'output': output}
         print (convert)
 
     def move_disk(self, hypervisor, instance_dir):
-        cmd = 'ls %(source)s/disk' % {'source': CONF.VM.source}
-        if not self.execute(hypervisor, cmd):
-            raise Exception('迁移源目录下没有disk磁盘文件!, 命令: %s' % cmd)
+        """Move the source disk into the instance dir, return the strategy.
+        """
+        disk_file = '%(instance_dir)s/disk' % {'instance_dir': instance_dir}
 
-        cmd = 'mv %(source)s/disk %(instance_dir)s' % {
-            'source': CONF.VM.source, 'instance_dir': instance_dir}
+        cmd = 'ls %(source)s/disk' % {'source': self.spec.source}
         if not self.execute(hypervisor, cmd):
-            raise Exception('移动迁移源目录下的disk到实例目录(%s)失败!' % cmd)
+            # NOTE: mv已完成但未来得及记录journal时, 不再重复移动.
+            if self.file_exists(hypervisor, disk_file):
+                self.chown(hypervisor, disk_file, 'qemu', 'qemu')
+                return 'done'
+            raise Exception('迁移源目录下没有disk磁盘文件!, 命令: %s' % cmd)
 
-        disk_file = '%(instance_dir)s/disk' % {'instance_dir': instance_dir}
+        result = self.stage_file(hypervisor, '%s/disk' % self.spec.source,
+                                 disk_file)
         self.chown(hypervisor, disk_file, 'qemu', 'qemu')
+        return result['strategy']
 
-    def create_vm(self, hypervisor, instance_dir, xml):
-        hypervisor_ip = self.get_hypervisor_ip(hypervisor)
-
+    def create_vm(self, hypervisor, hypervisor_ip, xml):
         driver = LibvirtDriver()
         driver.connect(hypervisor_ip)
-        domain = driver.define(xml)
-        is_create = driver.launch(domain)
-        if is_create != 0:
-            raise Exception('创建实例失败!')
-        LOG.info('step17 create instacne: %s success.' % domain.UUIDString())
+
+        # NOTE: 重跑时已定义或已运行的domain不再重复创建.
+        domain = driver.lookup(self.instance_ref.uuid)
+        if domain is None:
+            domain = driver.define(xml)
+        if domain.isActive():
+            LOG.info('step17 instance: %s already running, skip.'
+                     % domain.UUIDString())
+        else:
+            is_create = driver.launch(domain)
+            if is_create != 0:
+                raise Exception('创建实例失败!')
+            LOG.info('step17 create instacne: %s success.'
+                     % domain.UUIDString())
 
         self.purple('当前hypervisor: %s 已运行虚拟机实例列表为:' % hypervisor)
         driver.list_domain()
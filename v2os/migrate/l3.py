@@ -9,27 +9,19 @@ import json
 import logging
 from datetime import datetime
 
-from dotmap import DotMap
-from oslo_config import cfg
-
+from v2os.migrate.cache import cached
 from v2os.migrate.manager import Manager
 from v2os import objects
 
 LOG = logging.getLogger(__name__)
 
-CONF = cfg.CONF
-
-vm_opts = [
-    cfg.IntOpt('vlan', default=0, help='nova network.'),
-]
-
-CONF.register_cli_opts(vm_opts, 'VM')
-
 
 class L3Manager(Manager):
 
-    def __init__(self, session, instance_ref):
+    def __init__(self, session, spec, instance_ref, pending=None):
         self.session = session
+        self.spec = spec
+        self.pending = pending
         self.instance_ref = instance_ref
         self.instance_uuid = instance_ref.uuid
 
@@ -45,9 +37,10 @@ class L3Manager(Manager):
         LOG.info('step11 write instance: %s instance info cache success.'
                  % self.instance_uuid)
 
+    @cached(lambda self: self.spec.vlan)
     def read_network_id(self):
-        network_ref = self.session.query(objects.Network)\
-                .filter(objects.Network.vlan == CONF.VM.vlan)\
+        network_ref = self.reader.query(objects.Network)\
+                .filter(objects.Network.vlan == self.spec.vlan)\
                 .first()
         return network_ref.id
 
@@ -55,7 +48,8 @@ class L3Manager(Manager):
         """Create the instance of virtual interface.
         """
         vif_ref = objects.VirtualInterface()
-        vif_ref.address = self.generate_mac_address()
+        self.mac = self.generate_mac_address()
+        vif_ref.address = self.mac
         vif_ref.network_id = network_id
         vif_ref.instance_uuid = self.instance_uuid
         vif_ref.uuid = self.generate_uuid()
@@ -83,12 +77,14 @@ class L3Manager(Manager):
                      'success.' % (self.instance_uuid, self.ip))
 
     def read_network_info(self):
+        from dotmap import DotMap
+
         vif_ref = self.session.query(objects.VirtualInterface)\
                 .filter(objects.VirtualInterface.instance_uuid == self.instance_uuid)\
                 .first()
 
-        network_ref = self.session.query(objects.Network)\
-                .filter(objects.Network.vlan == CONF.VM.vlan)\
+        network_ref = self.reader.query(objects.Network)\
+                .filter(objects.Network.vlan == self.spec.vlan)\
                 .first()
 
         fixed_ip_ref = self.session.query(objects.FixedIp)\
@@ -170,4 +166,4 @@ class L3Manager(Manager):
         instance_cache_ref.instance_uuid = self.instance_uuid
         instance_cache_ref.created_at = datetime.now()
         instance_cache_ref.deleted = 0
-        self.session.add(instance_cache_ref)
+        self.add(instance_cache_ref)
@@ -6,7 +6,6 @@
 #
 
 import uuid
-import time
 import random
 import logging
 from datetime import datetime
@@ -15,6 +14,8 @@ from osmo.db import model_query
 from sqlalchemy.sql.expression import asc
 
 from v2os import objects
+from v2os.db.api import get_reader_session
+from v2os.migrate.cache import cached
 
 LOG = logging.getLogger(__name__)
 
@@ -24,10 +25,32 @@ _ISO8601_TIME_FORMAT_SUBSECOND = '%Y-%m-%dT%H:%M:%S.%f'
 
 class Manager:
 
+    # NOTE(为list时, 不需要回填主键的记录先暂存, 由调用方按表批量插入.)
+    pending = None
+
+    @property
+    def reader(self):
+        """Session for reference data reads, served by the slave database
+        when it is configured and usable, otherwise `self.session`.
+        Allocation and writes use `self.session`.
+        """
+        if getattr(self, '_reader', None) is None:
+            self._reader = get_reader_session(getattr(self, 'session', None))
+        return self._reader
+
+    def add(self, model_ref):
+        """Add a new row to the session, or defer it to the bulk insert.
+        """
+        if self.pending is None:
+            self.session.add(model_ref)
+        else:
+            self.pending.append(model_ref)
+
     def generate_uuid(self):
         """Generate an instance unique id(36bit).
         """
-        return str(uuid.uuid3(uuid.NAMESPACE_DNS, str(time.time())))
+        # NOTE(批量时同一时刻会生成多个uuid, 不能再以时间戳为种子.)
+        return str(uuid.uuid4())
 
     def generate_mac_address(self):
         """Generate an Ethernet MAC address.
@@ -49,7 +72,9 @@ class Manager:
         """
         # NOTE(从已创建的vlan中取出一个ip. 要求:
         #      没有预留的且没有分配过实例的; 同时要按updated_at升序.
-        fixed_ip = model_query(objects.FixedIp)\
+        # NOTE(在当前事务的session里查询, 同一批次中已分配但未提交的ip
+        #      会先flush, 不会被重复分配.)
+        fixed_ip = model_query(objects.FixedIp, session=self.session)\
                 .filter(objects.FixedIp.reserved == False)\
                 .filter(objects.FixedIp.instance_uuid == None)\
                 .filter(objects.FixedIp.host == None)\
@@ -137,8 +162,9 @@ class Manager:
         """
         return 'instance-%08x' % instance_id
 
+    @cached()
     def get_hypervisor_ip(self, hostname):
-        compute_ref = model_query(objects.ComputeNode)\
+        compute_ref = model_query(objects.ComputeNode, session=self.reader)\
                 .filter(objects.ComputeNode.host == hostname)\
                 .first()
         return compute_ref.host_ip
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+import logging
+from collections import Counter, defaultdict, deque
+from datetime import datetime
+
+from oslo_config import cfg
+from sqlalchemy import func
+from sqlalchemy.sql.expression import asc
+
+from v2os import objects
+from v2os.migrate.instance import InstanceManager
+from v2os.migrate.l2 import LibvirtManager, format_network
+from v2os.migrate.l3 import L3Manager
+from v2os.migrate.manager import Manager
+from v2os.disk import delta, fetch, qcow2, stage, verify, vmdk
+
+LOG = logging.getLogger(__name__)
+
+CONF = cfg.CONF
+
+
+class PlanRecorder(LibvirtManager):
+    """LibvirtManager recording the remote operations instead of running
+    them.
+
+    The hypervisor is assumed fresh: existence checks are answered as
+    missing, except the source disk and the devices planned by earlier vms
+    of the same plan.
+    """
+
+    workers = 1
+
+    def __init__(self, spec, instance_ref, network_info, devices):
+        super(PlanRecorder, self).__init__(None, spec, instance_ref,
+                                           network_info=network_info)
+        self.devices = devices
+        self.commands = []
+
+    def execute(self, host, cmd, port=22, user='root', pswd=''):
+        if '\n' in cmd:
+            # NOTE(写文件的内容和远程脚本不重复记录, xml单独输出.)
+            cmd = '%s ...' % cmd.splitlines()[0]
+        self.commands.append({'host': host, 'cmd': cmd})
+        if cmd == 'ls %s/disk' % self.spec.source:
+            return True
+        return not (cmd.startswith('ls ') or 'ls 999' in cmd)
+
+    def device_exists(self, host, device):
+        self.commands.append({'host': host,
+                              'cmd': 'ls /sys/class/net/%s' % device})
+        if (host, device) in self.devices:
+            return True
+        self.devices.add((host, device))
+        return False
+
+    def stage_file(self, host, src, dst):
+        self.execute(host, self.script_command(stage, [src, dst]))
+        return {'strategy': 'plan'}
+
+    def delta_sync(self, source_host, source_path, host, dst):
+        self.execute(source_host, self.script_command(
+            delta, ['hash', source_path]))
+        self.execute(host, self.script_command(delta, ['hash', dst]))
+        if CONF.disk_verify:
+            self.execute(host, self.script_command(verify, ['digest', dst]))
+        return {}
+
+    def fetch_file(self, host, url, dst):
+        # NOTE(不记录认证信息.)
+        self.execute(host, self.script_command(fetch, [url, dst]))
+        return {}
+
+    def convert_vmdk(self, host, src, dst):
+        self.execute(host, self.script_command(vmdk, [src]))
+        self.execute(host, self.script_command(qcow2, ['-', dst]))
+        return {}
+
+    def convert_raw(self, host, src, dst):
+        self.execute(host, self.script_command(qcow2, [src, dst, '--raw']))
+        return {}
+
+    def create_vm(self, hypervisor, hypervisor_ip, xml):
+        self.commands.append({
+            'host': hypervisor,
+            'cmd': 'virsh define && virsh start %s(qemu+ssh://root@%s/system)'
+                   % (self.instance_name, hypervisor_ip)})
+
+    def purple(self, output):
+        pass
+
+
+class Planner(Manager):
+    """Resolve what migrating each spec would do, reading the db only.
+
+    usage:
+
+        planner = Planner()
+        for spec in specs:
+            record = planner.plan(spec)
+        summary = planner.summary()
+
+    IPs are handed out in the order the real run takes them, skipping the
+    ones planned for earlier vms. Instance uuid, mac and serial are random
+    and the instance id is predicted from the current max id, so these are
+    generated again by the real run.
+    """
+
+    def __init__(self):
+        self.session = None
+        self.devices = set()
+        self.networks = {}
+        self.ip_pools = {}
+        self.next_id = None
+        self.failed = 0
+        self.hypervisors = defaultdict(Counter)
+        self.vlans = defaultdict(Counter)
+
+    def plan(self, spec):
+        record = {'vm': spec.name, 'hostname': spec.hostname,
+                  'hypervisor': spec.hypervisor, 'vlan': spec.vlan}
+        try:
+            record.update(self.resolve(spec))
+        except Exception as _ex:
+            LOG.error('Plan vm: %s failed: %s' % (spec.name, _ex))
+            record['error'] = str(_ex)
+            self.failed += 1
+            return record
+
+        usage = self.hypervisors[spec.hypervisor]
+        usage['vms'] += 1
+        usage['vcpus'] += spec.cpu
+        usage['memory_mb'] += spec.mem * 1024
+        usage['disk_gb'] += spec.disk
+        self.vlans[spec.vlan]['vms'] += 1
+        return record
+
+    def resolve(self, spec):
+        spec.check()
+        instance_manager = InstanceManager(None, spec)
+        instance_manager.read_key_data()
+        instance_type_id = instance_manager.read_instance_type()
+        if instance_type_id is None:
+            raise Exception('给定规格不匹配!')
+        zone = instance_manager.read_zone()
+
+        instance_ref = objects.Instance()
+        instance_ref.id = self.allocate_id()
+        network_id = ip = None
+        try:
+            instance_ref.uuid = instance_manager.instance_uuid
+            instance_ref.hostname = spec.hostname
+            instance_ref.host = spec.hypervisor
+            instance_ref.vcpus = spec.cpu
+            instance_ref.memory_mb = spec.mem * 1024
+            instance_ref.instance_type_id = instance_type_id
+            instance_ref.created_at = datetime.utcnow()
+
+            network_id = L3Manager(None, spec, instance_ref).read_network_id()
+            ip = self.allocate_ip(network_id, spec.vlan)
+            mac = self.generate_mac_address()
+            network_info = format_network(self.read_network(network_id), ip,
+                                          mac, spec.hostname)
+
+            recorder = PlanRecorder(spec, instance_ref, network_info,
+                                    self.devices)
+            outputs = recorder.build()
+        except Exception:
+            # NOTE(真实执行时失败的vm会回滚, 不占用id和ip; 归还后后面vm
+            #      的预测才与真实执行一致.)
+            self.release(instance_ref.id, network_id, ip, spec.vlan)
+            raise
+        return {
+            'uuid': instance_ref.uuid,
+            'instance_id': instance_ref.id,
+            'instance_name': recorder.instance_name,
+            'flavor': recorder.flavor_info.get('name'),
+            'instance_type_id': instance_type_id,
+            'zone': zone,
+            'bridge': network_info['bridge'],
+            'ip': ip,
+            'mac': mac,
+            'hypervisor_ip': outputs['hypervisor_ip'],
+            'instance_dir': outputs['instance_dir'],
+            'xml': outputs['xml'],
+            'commands': recorder.commands,
+        }
+
+    def allocate_id(self):
+        if self.next_id is None:
+            max_id = self.reader.query(func.max(objects.Instance.id)).scalar()
+            self.next_id = (max_id or 0) + 1
+        self.next_id += 1
+        return self.next_id - 1
+
+    def allocate_ip(self, network_id, vlan):
+        if network_id not in self.ip_pools:
+            # NOTE(与generate_ip_address的条件和顺序一致.)
+            fixed_ip_refs = self.reader.query(objects.FixedIp.address)\
+                    .filter(objects.FixedIp.reserved == False)\
+                    .filter(objects.FixedIp.instance_uuid == None)\
+                    .filter(objects.FixedIp.host == None)\
+                    .filter(objects.FixedIp.network_id == network_id)\
+                    .order_by(asc(objects.FixedIp.updated_at))\
+                    .all()
+            self.ip_pools[network_id] = deque(r.address for r in
+                                              fixed_ip_refs)
+        pool = self.ip_pools[network_id]
+        self.vlans[vlan]['ips_left'] = max(len(pool) - 1, 0)
+        if not pool:
+            raise Exception('vlan: %s 没有可分配的ip!' % vlan)
+        return pool.popleft()
+
+    def release(self, instance_id, network_id, ip, vlan):
+        """Give back the id and ip allocated to a vm that failed to plan.
+        """
+        if instance_id == self.next_id - 1:
+            self.next_id -= 1
+        if ip is not None:
+            pool = self.ip_pools[network_id]
+            pool.appendleft(ip)
+            self.vlans[vlan]['ips_left'] = len(pool)
+
+    def read_network(self, network_id):
+        if network_id not in self.networks:
+            self.networks[network_id] = self.reader.query(objects.Network)\
+                    .filter(objects.Network.id == network_id)\
+                    .first()
+        return self.networks[network_id]
+
+    def summary(self):
+        total = sum(c['vms'] for c in self.hypervisors.values())
+        return {
+            'planned': total,
+            'failed': self.failed,
+            'hypervisors': {h: dict(c) for h, c in self.hypervisors.items()},
+            'vlans': {v: dict(c) for v, c in self.vlans.items()},
+        }
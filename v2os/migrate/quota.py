@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+import logging
+import collections
+from datetime import datetime
+
+from v2os.migrate.manager import Manager
+from v2os import objects
+
+LOG = logging.getLogger(__name__)
+
+
+class QuotaManager(Manager):
+    """Keep per-project quota usage deltas of a migration batch in memory,
+    and apply them to `quota_usages` once when the batch commits.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.deltas = collections.defaultdict(collections.Counter)
+
+    def add(self, instance_ref, sign=1):
+        """Account the resources of an instance to its project.
+        """
+        usage = self.deltas[(instance_ref.project_id, instance_ref.user_id)]
+        usage['instances'] += sign
+        usage['cores'] += sign * instance_ref.vcpus
+        usage['ram'] += sign * instance_ref.memory_mb
+
+    def commit(self):
+        """Apply the accumulated deltas, one aggregated update for each
+        project/resource, inside the caller's transaction.
+        """
+        for (project_id, user_id), usage in self.deltas.items():
+            for resource, delta in usage.items():
+                if not delta:
+                    continue
+                self.update_usage(project_id, user_id, resource, delta)
+                LOG.info('Update project: %s quota usage: %s delta: %+d '
+                         'success.' % (project_id, resource, delta))
+        self.deltas.clear()
+
+    def update_usage(self, project_id, user_id, resource, delta):
+        # NOTE(in_use = in_use + delta, 由数据库完成累加, 不需要先查出当前值.
+        #      如果该项目还没有这项资源的usage记录, 则新建一条.)
+        count = self.session.query(objects.QuotaUsage)\
+                .filter(objects.QuotaUsage.project_id == project_id)\
+                .filter(objects.QuotaUsage.user_id == user_id)\
+                .filter(objects.QuotaUsage.resource == resource)\
+                .filter(objects.QuotaUsage.deleted == 0)\
+                .update({objects.QuotaUsage.in_use:
+                         objects.QuotaUsage.in_use + delta,
+                         objects.QuotaUsage.updated_at: datetime.now()},
+                        synchronize_session=False)
+        if count:
+            return
+
+        usage_ref = objects.QuotaUsage()
+        usage_ref.project_id = project_id
+        usage_ref.user_id = user_id
+        usage_ref.resource = resource
+        usage_ref.in_use = max(delta, 0)
+        usage_ref.reserved = 0
+        usage_ref.until_refresh = None
+        usage_ref.created_at = datetime.now()
+        usage_ref.deleted = 0
+        self.session.add(usage_ref)
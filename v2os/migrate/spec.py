@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+import re
+import hashlib
+
+from oslo_config import cfg
+
+CONF = cfg.CONF
+
+vm_opts = [
+    cfg.StrOpt('os', default='centos-6.9',
+               help='instance os type, such as: centos-6.7、centos-6.9'),
+    cfg.IntOpt('cpu', default=4, help='instance cpu number.'),
+    cfg.IntOpt('mem', default=4, help='instance mem size(G).'),
+    cfg.IntOpt('disk', default=150, help='instance disk size(G).'),
+    cfg.IntOpt('vlan', default=0, help='nova network.'),
+    cfg.StrOpt('hostname', default='', help='instance hostname.'),
+    cfg.StrOpt('hypervisor', default='', help='instance of hypervisor.'),
+    cfg.StrOpt('mount', default='/data', help='nova instance mount dir.'),
+    cfg.StrOpt('source', default='/opt/migrate',
+               help='migrate image disk source directory.'),
+    cfg.StrOpt('source_url', default='',
+               help='pull the disk from this http(s) url(such as the '
+                    'vcenter datastore) instead of the source directory.'),
+    cfg.StrOpt('source_host', default='',
+               help='sync the disk block by block from source_path on this '
+                    'host(ssh), such as the esxi host of the source vm.'),
+    cfg.StrOpt('source_path', default='',
+               help='disk file on the source_host.'),
+    cfg.StrOpt('source_format', default='qcow2',
+               choices=['qcow2', 'vmdk', 'raw'],
+               help='format of the disk in the source directory, at the '
+                    'source_url or source_path, a streamOptimized vmdk or '
+                    'a raw disk(such as <vm>-flat.vmdk) is converted to '
+                    'qcow2.'),
+    cfg.StrOpt('base_url', default='',
+               help='http(s) url of the base image(image_ref), kept once '
+                    'per hypervisor in nova _base, the disk becomes a thin '
+                    'overlay of it.'),
+    cfg.StrOpt('base_format', default='raw', choices=['raw', 'qcow2'],
+               help='format of the base image at the base_url.'),
+]
+
+default_opts = [
+    cfg.IntOpt('build_workers', default=4,
+               help='max host side build steps of a vm running at the same '
+                    'time.'),
+    cfg.StrOpt('disk_staging', default='auto', choices=['auto', 'mv'],
+               help='how to move a disk on the hypervisor. auto: rename, '
+                    'reflink or sparse copy, mv: plain mv.'),
+    cfg.StrOpt('remote_python', default='python',
+               help='python interpreter on the hypervisors and source '
+                    'hosts.'),
+]
+
+keystone_opts = [
+    cfg.StrOpt('user_id', default='', help='current user id'),
+    cfg.StrOpt('tenant_id', default='', help='current tenant id'),
+]
+
+glance_opts = [
+    cfg.StrOpt('image_ref', default='', help='current image id')
+]
+
+nova_opts = [
+    cfg.StrOpt('key_name', default='admin', help='tenant key name.'),
+    cfg.StrOpt('security_group', default='default', help='security group.')
+]
+
+CONF.register_cli_opts(default_opts)
+CONF.register_cli_opts(vm_opts, 'VM')
+CONF.register_opts(keystone_opts, 'KEYSTONE')
+CONF.register_opts(glance_opts, 'GLANCE')
+CONF.register_opts(nova_opts, 'NOVA')
+
+# NOTE(spec字段与配置项的对应关系: 字段名 -> (配置组, 配置项), 配置组为
+#      None时是DEFAULT组.)
+FIELDS = {
+    'os': ('VM', 'os'),
+    'cpu': ('VM', 'cpu'),
+    'mem': ('VM', 'mem'),
+    'disk': ('VM', 'disk'),
+    'vlan': ('VM', 'vlan'),
+    'hostname': ('VM', 'hostname'),
+    'hypervisor': ('VM', 'hypervisor'),
+    'mount': ('VM', 'mount'),
+    'source': ('VM', 'source'),
+    'source_url': ('VM', 'source_url'),
+    'source_host': ('VM', 'source_host'),
+    'source_path': ('VM', 'source_path'),
+    'source_format': ('VM', 'source_format'),
+    'base_url': ('VM', 'base_url'),
+    'base_format': ('VM', 'base_format'),
+    'build_workers': (None, 'build_workers'),
+    'disk_staging': (None, 'disk_staging'),
+    'remote_python': (None, 'remote_python'),
+    'user_id': ('KEYSTONE', 'user_id'),
+    'tenant_id': ('KEYSTONE', 'tenant_id'),
+    'image_ref': ('GLANCE', 'image_ref'),
+    'key_name': ('NOVA', 'key_name'),
+    'security_group': ('NOVA', 'security_group'),
+}
+
+
+class MigrationSpec:
+    """Everything needed to migrate one vm, passed explicitly to the
+    managers instead of read from the global CONF.
+
+    usage:
+
+        spec = MigrationSpec(os='centos-6.9', cpu=4, mem=4, disk=150,
+                             vlan=1220, hostname='yy-jinlong00.yy',
+                             hypervisor='dx-tkvm00.dx', user_id='...',
+                             tenant_id='...', image_ref='...')
+        Nova().constuct(KVMInstance(spec))
+
+    The CLI builds it from the config with `from_conf`.
+    """
+
+    def __init__(self, os='centos-6.9', cpu=4, mem=4, disk=150, vlan=0,
+                 hostname='', hypervisor='', mount='/data',
+                 source='/opt/migrate', user_id='', tenant_id='',
+                 image_ref='', key_name='admin', security_group='default',
+                 source_url='', source_host='', source_path='', base_url='',
+                 source_format='qcow2', base_format='raw', build_workers=4,
+                 disk_staging='auto', remote_python='python'):
+        self.os = os
+        self.cpu = cpu
+        self.mem = mem
+        self.disk = disk
+        self.vlan = vlan
+        self.hostname = hostname
+        self.hypervisor = hypervisor
+        self.mount = mount
+        self.source = source
+        self.source_url = source_url
+        self.source_host = source_host
+        self.source_path = source_path
+        self.source_format = source_format
+        self.base_url = base_url
+        self.base_format = base_format
+        self.build_workers = build_workers
+        self.disk_staging = disk_staging
+        self.remote_python = remote_python
+        self.user_id = user_id
+        self.tenant_id = tenant_id
+        self.image_ref = image_ref
+        self.key_name = key_name
+        self.security_group = security_group
+
+    @classmethod
+    def from_conf(cls, **overrides):
+        """Spec of the configured options, `overrides` replace some of them.
+        """
+        unknown = set(overrides) - set(FIELDS)
+        if unknown:
+            raise Exception('包含不支持的参数: %s' % sorted(unknown))
+        values = {}
+        for field, (group, name) in FIELDS.items():
+            section = CONF if group is None else getattr(CONF, group)
+            values[field] = getattr(section, name)
+        values.update(overrides)
+        return cls(**values)
+
+    def check(self):
+        if not self.os or not self.vlan or \
+           not self.cpu or not self.mem or not self.disk or \
+           not self.hostname or not self.hypervisor:
+            raise Exception('参数: os、vlan、cpu、mem、disk、hostname、'
+                            'hypervisor不能为空!')
+        if self.cpu > 64:
+            raise Exception('cpu核数不能超过64核!')
+        if self.mem > 256:
+            raise Exception('内存不能大于256G!')
+        if not re.search(r'\w*-\d*.\d*', self.os):
+            raise Exception('os值错误, 正确如: centos-6.9、centos-7.5...')
+        if self.source_host and not self.source_path:
+            raise Exception('指定source_host时source_path不能为空!')
+        if self.source_host and self.source_format == 'vmdk':
+            raise Exception('指定source_host时source_format只能是qcow2或raw!')
+        if self.base_url and not self.image_ref:
+            raise Exception('指定base_url时image_ref不能为空!')
+
+    @property
+    def name(self):
+        """Name of the vm in the journal and logs, such as:
+        yy-jinlong00.yy@dx-tkvm00.dx
+        """
+        return '%s@%s' % (self.hostname, self.hypervisor)
+
+    @property
+    def staging_disk(self):
+        """Disk synced before the cutover, such as:
+        /data/nova/staging/yy-jinlong00.yy/disk
+        """
+        return '%s/nova/staging/%s/disk' % (self.mount, self.hostname)
+
+    @property
+    def source_disk(self):
+        """Host and path(or url) the disk is read from, such as:
+        ('dx-tkvm00.dx', '/opt/migrate/disk')
+        """
+        if self.source_host:
+            return self.source_host, self.source_path
+        if self.source_url:
+            return self.hypervisor, self.source_url
+        return self.hypervisor, '%s/disk' % self.source
+
+    @property
+    def base_image(self):
+        """Base image in the nova _base cache, named by the sha1 of the
+        image id like nova does(glance images never change), such as:
+        /data/nova/instances/_base/<sha1 of image_ref>
+        """
+        name = hashlib.sha1(self.image_ref.encode('utf-8')).hexdigest()
+        return '%s/nova/instances/_base/%s' % (self.mount, name)
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in FIELDS}
+
+    def __repr__(self):
+        return 'MigrationSpec(%s)' % self.name
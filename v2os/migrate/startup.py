@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+import sys
+import time
+import builtins
+
+
+class ImportProfiler:
+    """Time the first import of each module during startup.
+
+    usage(must be installed before the imports to measure):
+
+        profiler = ImportProfiler.from_argv(sys.argv)
+        import ...
+        if profiler:
+            profiler.report()
+    """
+
+    flag = '--startup-profile'
+
+    def __init__(self):
+        self.started = time.time()
+        self.records = []
+        self.stack = []
+        self.origin = None
+
+    @classmethod
+    def from_argv(cls, argv):
+        if cls.flag not in argv:
+            return None
+        profiler = cls()
+        profiler.install()
+        return profiler
+
+    def install(self):
+        self.origin = builtins.__import__
+        builtins.__import__ = self
+
+    def uninstall(self):
+        if self.origin is not None:
+            builtins.__import__ = self.origin
+            self.origin = None
+
+    def __call__(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level or name in sys.modules:
+            return self.origin(name, globals, locals, fromlist, level)
+
+        # NOTE(栈上记录子模块的累计耗时, 用于计算模块自身的耗时.)
+        self.stack.append(0.0)
+        start = time.time()
+        try:
+            return self.origin(name, globals, locals, fromlist, level)
+        finally:
+            cumulative = time.time() - start
+            children = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += cumulative
+            self.records.append((name, cumulative, cumulative - children))
+
+    def report(self, limit=25):
+        """Print the slowest imports, mapper configuration and total time.
+        """
+        self.uninstall()
+        startup = time.time() - self.started
+
+        from sqlalchemy.orm import configure_mappers
+        start = time.time()
+        configure_mappers()
+        mappers = time.time() - start
+
+        lines = ['%10s %10s  %s' % ('cumulative', 'self', 'module')]
+        records = sorted(self.records, key=lambda r: r[1], reverse=True)
+        for name, cumulative, own in records[:limit]:
+            lines.append('%8.1fms %8.1fms  %s' % (cumulative * 1000,
+                                                 own * 1000, name))
+        lines.append('imported %d modules, configure mappers: %.1fms, '
+                     'startup: %.1fms' % (len(self.records), mappers * 1000,
+                                          startup * 1000))
+        print('\n'.join(lines))
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+import logging
+from datetime import datetime
+
+from v2os.migrate.manager import Manager
+from v2os import objects
+
+LOG = logging.getLogger(__name__)
+
+# NOTE(随实例一起软删除的子表, 都以instance_uuid关联.)
+INSTANCE_CHILD_MODELS = (
+    objects.InstanceInfoCache,
+    objects.InstanceExtra,
+    objects.BlockDeviceMapping,
+    objects.SecurityGroupInstanceAssociation,
+    objects.InstanceSystemMetadata,
+    objects.VirtualInterface,
+)
+
+
+class StateManager(Manager):
+    """Move committed instances out of the transitional `building` state,
+    to `active` after the host side steps succeeded, or back out of the
+    database when they failed. All updates are set based on uuid lists.
+    """
+
+    def __init__(self, session):
+        self.session = session
+
+    def activate(self, instance_uuids):
+        now = datetime.now()
+        return self.session.query(objects.Instance)\
+                .filter(objects.Instance.uuid.in_(instance_uuids))\
+                .filter(objects.Instance.deleted == 0)\
+                .update({objects.Instance.vm_state: 'active',
+                         objects.Instance.power_state: 1,
+                         objects.Instance.task_state: None,
+                         objects.Instance.launched_at: now,
+                         objects.Instance.updated_at: now},
+                        synchronize_session=False)
+
+    def release_fixed_ips(self, instance_uuids):
+        """Give the fixed ips of the instances back to the network.
+        """
+        return self.session.query(objects.FixedIp)\
+                .filter(objects.FixedIp.instance_uuid.in_(instance_uuids))\
+                .update({objects.FixedIp.instance_uuid: None,
+                         objects.FixedIp.virtual_interface_id: None,
+                         objects.FixedIp.allocated: False,
+                         objects.FixedIp.leased: False,
+                         objects.FixedIp.updated_at: datetime.now()},
+                        synchronize_session=False)
+
+    def soft_delete(self, instance_uuids):
+        """Soft delete the instances and their child rows, nova style:
+        deleted = id.
+        """
+        now = datetime.now()
+        for model in INSTANCE_CHILD_MODELS:
+            self.session.query(model)\
+                    .filter(model.instance_uuid.in_(instance_uuids))\
+                    .filter(model.deleted == 0)\
+                    .update({model.deleted: model.id,
+                             model.deleted_at: now},
+                            synchronize_session=False)
+        return self.session.query(objects.Instance)\
+                .filter(objects.Instance.uuid.in_(instance_uuids))\
+                .filter(objects.Instance.deleted == 0)\
+                .update({objects.Instance.deleted: objects.Instance.id,
+                         objects.Instance.deleted_at: now,
+                         objects.Instance.terminated_at: now,
+                         objects.Instance.vm_state: 'deleted',
+                         objects.Instance.power_state: 0,
+                         objects.Instance.task_state: None},
+                        synchronize_session=False)
+
+    def compensate(self, instance_uuids):
+        """Undo the database plan of instances whose host side build failed.
+        """
+        self.release_fixed_ips(instance_uuids)
+        count = self.soft_delete(instance_uuids)
+        LOG.info('Compensate instances: %s release fixed ip and soft delete '
+                 '%d rows success.' % (instance_uuids, count))
+        return count
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+import json
+import time
+import random
+import logging
+import threading
+import collections
+
+from oslo_config import cfg
+
+from v2os.disk import fetch
+
+LOG = logging.getLogger(__name__)
+
+CONF = cfg.CONF
+
+default_opts = [
+    cfg.IntOpt('swarm_port', default=7071,
+               help='port the hypervisors serve the chunks to each other.'),
+    cfg.IntOpt('swarm_uploads', default=2,
+               help='chunks a hypervisor serves at the same time.'),
+    cfg.IntOpt('swarm_origin_uploads', default=1,
+               help='chunks pulled from the origin url at the same time.'),
+]
+
+CONF.register_cli_opts(default_opts)
+
+ORIGIN = None
+RETRIES = 3
+
+
+class Swarm(object):
+    """Distribute one image to many hosts, the hosts pulling the chunks
+    from each other.
+
+    Every peer serves the chunks it already holds(fetch.py --serve) and
+    pulls one chunk at a time(fetch.py --chunks). The coordinator only
+    keeps the chunk map of the peers: it gives each idle peer the rarest
+    chunk it misses from a peer holding it with a free upload slot, or
+    from the origin url when its slots(swarm_origin_uploads) are free.
+    So the origin sends each chunk about once, and the holders of a chunk
+    double as it spreads, the time grows with log(peers) not the peers.
+
+    usage:
+
+        peers = [{'host': 'dx-tkvm00.dx', 'ip': '10.12.16.10',
+                  'port': 7071, 'dst': '/data/nova/instances/_base/..'}]
+        result = Swarm(RPC(), url, peers).run()
+
+    With l2.LocalRPC and a port and dst of their own, the peers can be
+    local processes of one machine.
+    """
+
+    def __init__(self, rpc, url, peers, chunk_mb=64, uploads=2,
+                 origin_uploads=1):
+        self.rpc = rpc
+        self.url = url
+        self.peers = peers
+        self.chunk_mb = chunk_mb
+        self.uploads = uploads
+        self.origin_uploads = origin_uploads
+        self.cond = threading.Condition()
+        self.held = {}
+        self.holders = collections.Counter()
+        self.busy = collections.Counter()
+        self.pulling = 0
+        self.origin_chunks = set()
+        self.pulls = collections.Counter()
+        self.errors = collections.Counter()
+        self.failed = {}
+
+    def run(self):
+        start = time.time()
+        probe = self.rpc.run_script(self.peers[0]['host'], fetch,
+                                    [self.url, self.peers[0]['dst'],
+                                     '--probe'] + self.options(),
+                                    self.auth())
+        if probe is None:
+            raise Exception('获取镜像: %s 的大小失败!' % self.url)
+        probe = json.loads(probe)
+        if not probe['ranged']:
+            raise Exception('镜像: %s 不支持range请求, 无法分块分发!'
+                            % self.url)
+        self.size = probe['size']
+        self.validator = probe['validator']
+        chunk = self.chunk_mb * 1024 * 1024
+        self.count = (self.size + chunk - 1) // chunk
+
+        servers = []
+        try:
+            for peer in self.peers:
+                servers.append(self.serve(peer))
+            workers = [threading.Thread(target=self.worker, args=(peer,))
+                       for peer in self.peers
+                       if len(self.held[peer['host']]) < self.count]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        finally:
+            for stdin, _, _ in servers:
+                stdin.channel.shutdown_write()
+
+        elapsed = time.time() - start
+        result = {'url': self.url, 'size': self.size, 'chunks': self.count,
+                  'peers': len(self.peers),
+                  'origin_pulls': self.pulls['origin'],
+                  'peer_pulls': self.pulls['peer'],
+                  'failed': self.failed, 'elapsed': round(elapsed, 3)}
+        LOG.info('** Swarm distribute: %s to %d peers chunks: %d pulled '
+                 'from origin: %d from peers: %d failed: %d elapsed: %.3fs'
+                 % (self.url, len(self.peers), self.count,
+                    result['origin_pulls'], result['peer_pulls'],
+                    len(self.failed), elapsed))
+        return result
+
+    def options(self):
+        args = ['--chunk-mb', self.chunk_mb]
+        if CONF.fetch_insecure:
+            args.append('--insecure')
+        return args
+
+    def auth(self):
+        if not CONF.fetch_user:
+            return {}
+        return {'V2OS_FETCH_AUTH': '%s:%s' % (CONF.fetch_user,
+                                              CONF.fetch_password)}
+
+    def chunk_args(self):
+        args = ['--size', self.size] + self.options()
+        if self.validator is not None:
+            args += ['--validator', self.validator]
+        return args
+
+    def serve(self, peer):
+        """Start the chunk server of the peer, read the chunks it holds.
+        """
+        cmd = self.rpc.script_command(
+            fetch, [self.url, peer['dst'], '--serve', peer['port']] +
+            self.chunk_args(), stdin=True)
+        stdin, stdout, stderr = self.rpc.open(peer['host'], cmd)
+        line = stdout.readline()
+        if not line:
+            raise Exception('启动分发服务: %s 失败: %s'
+                            % (peer['host'], stderr.read()[-512:]))
+        held = set(json.loads(line)['held'])
+        self.held[peer['host']] = held
+        self.holders.update(held)
+        return stdin, stdout, stderr
+
+    def assign(self, peer):
+        """Return the (chunk, source peer) the peer pulls next, the source
+        is ORIGIN for the url, None when nothing can be pulled now.
+        """
+        held = self.held[peer['host']]
+        missing = [i for i in range(self.count) if i not in held]
+        # NOTE(最稀有的块优先, 同样稀有的随机, 各节点持有的块互补.)
+        random.shuffle(missing)
+        missing.sort(key=lambda i: self.holders[i])
+        origin = []
+        for index in missing:
+            holders = [p for p in self.peers
+                       if p is not peer and
+                       self.errors[p['host']] < RETRIES and
+                       index in self.held[p['host']]]
+            sources = [p for p in holders
+                       if self.busy[p['host']] < self.uploads]
+            if sources:
+                return index, min(sources, key=lambda p: self.busy[p['host']])
+            # NOTE(源url只拉取没有可用持有者且不在拉取中的块, 每块只出源
+            #      一次; 持有者都忙时等待它们的上传槽.)
+            if not holders and index not in self.origin_chunks:
+                origin.append(index)
+        if origin and self.busy[ORIGIN] < self.origin_uploads:
+            return origin[0], ORIGIN
+        return None
+
+    def worker(self, peer):
+        host = peer['host']
+        errors = 0
+        while True:
+            with self.cond:
+                while True:
+                    if len(self.held[host]) == self.count:
+                        return
+                    task = self.assign(peer)
+                    if task is not None:
+                        break
+                    if not self.pulling:
+                        self.failed[host] = 'no source holds the chunks'
+                        return
+                    self.cond.wait(1)
+                index, source = task
+                source_key = source['host'] if source else ORIGIN
+                self.busy[source_key] += 1
+                self.pulling += 1
+                if source is None:
+                    self.origin_chunks.add(index)
+
+            error = None
+            try:
+                self.pull(peer, index, source)
+            except Exception as _ex:
+                error = str(_ex)
+                LOG.warning('Peer: %s pull chunk: %d from: %s failed: %s'
+                            % (host, index, source_key or self.url, _ex))
+
+            with self.cond:
+                self.busy[source_key] -= 1
+                self.pulling -= 1
+                self.origin_chunks.discard(index)
+                self.cond.notify_all()
+                if error is None:
+                    self.held[host].add(index)
+                    self.holders[index] += 1
+                    self.pulls['peer' if source else 'origin'] += 1
+                    continue
+                # NOTE(出错多次的来源节点不再分配, 自身出错多次则放弃.)
+                if source_key is not ORIGIN:
+                    self.errors[source_key] += 1
+                errors += 1
+                if errors >= RETRIES:
+                    self.failed[host] = error
+                    return
+
+    def pull(self, peer, index, source):
+        args = [self.url, peer['dst'], '--chunks', index] + self.chunk_args()
+        env = {}
+        if source is None:
+            env = self.auth()
+        else:
+            args += ['--peer', 'http://%s:%s/' % (source['ip'],
+                                                  source['port'])]
+        output = self.rpc.run_script(peer['host'], fetch, args, env)
+        if output is None:
+            raise Exception('拉取分块失败!')
+        return json.loads(output)
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+import time
+import logging
+import contextlib
+import collections
+from concurrent import futures
+
+from oslo_config import cfg
+from sqlalchemy import or_
+
+from v2os import objects
+from v2os.libvirt.driver import LibvirtDriver
+from v2os.migrate.manager import Manager
+from v2os.migrate.l2 import L2Drivier, format_network
+from v2os.migrate.quota import QuotaManager
+from v2os.migrate.compute import ComputeManager
+from v2os.migrate.state import StateManager
+from v2os.migrate.journal import Journal
+
+LOG = logging.getLogger(__name__)
+
+CONF = cfg.CONF
+
+default_opts = [
+    cfg.StrOpt('teardown_wave', default='',
+               help='tear down the instances of a batch migration wave'
+                    '(reservation id), such as: r-1a2b3c4d'),
+    cfg.ListOpt('teardown_uuids', default=[],
+                help='tear down the instances of these uuids.'),
+    cfg.IntOpt('teardown_workers', default=16,
+               help='hypervisors cleaned up at the same time.'),
+]
+
+CONF.register_cli_opts(default_opts)
+
+
+class Teardown(Manager, L2Drivier):
+    """Revert migrated instances, the reverse of a migration wave.
+
+    On each hypervisor the domains are destroyed and undefined, the disks
+    moved back to the migrate source directory and the instance dirs
+    removed; then the dhcp items of every bridge are removed at once and
+    its dnsmasq reloaded once. Hypervisors are cleaned up in parallel.
+    The instances cleaned up are soft deleted and their fixed ips
+    released with set based updates in one transaction.
+
+    usage:
+
+        teardown = Teardown(get_session(), MigrationSpec.from_conf())
+        result = teardown.run(wave='r-1a2b3c4d')
+
+    `spec` gives the mount and source directories of the hypervisors.
+    """
+
+    def __init__(self, session, spec, workers=16, leases=None):
+        self.session = session
+        self.spec = spec
+        self.workers = workers
+        self.leases = leases
+
+    def run(self, wave=None, uuids=None):
+        start = time.time()
+        vms = self.read_vms(wave, uuids)
+
+        hosts = collections.OrderedDict()
+        for vm in vms:
+            hosts.setdefault(vm['host'], []).append(vm)
+        # NOTE(数据库读取都在并行清理之前完成, 各线程只做远程操作.)
+        hypervisor_ips = {host: self.get_hypervisor_ip(host)
+                          for host in hosts}
+
+        cleaned, failed = [], {}
+        if hosts:
+            workers = max(1, min(self.workers, len(hosts)))
+            with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                tasks = [pool.submit(self.clean_host, host,
+                                     hypervisor_ips[host], host_vms)
+                         for host, host_vms in hosts.items()]
+                for task in tasks:
+                    host_cleaned, host_failed = task.result()
+                    cleaned.extend(host_cleaned)
+                    failed.update(host_failed)
+
+        if cleaned:
+            self.delete(cleaned)
+            self.discard_journal(cleaned)
+
+        result = {
+            'wave': wave,
+            'total': len(vms),
+            'success': len(cleaned),
+            'failed': failed,
+            'hypervisors': len(hosts),
+            'elapsed': round(time.time() - start, 3),
+        }
+        LOG.info('Tear down %d instances on %d hypervisors, success: %d '
+                 'failed: %d, elapsed: %.3fs'
+                 % (len(vms), len(hosts), len(cleaned), len(failed),
+                    result['elapsed']))
+        return result
+
+    def read_vms(self, wave, uuids):
+        """Return the instances to tear down with their network info.
+        """
+        conditions = []
+        if wave:
+            conditions.append(objects.Instance.reservation_id == wave)
+        if uuids:
+            conditions.append(objects.Instance.uuid.in_(uuids))
+        if not conditions:
+            raise Exception('需要指定回退的wave或实例uuid!')
+
+        instance_ref_list = self.session.query(objects.Instance)\
+                .filter(objects.Instance.deleted == 0)\
+                .filter(or_(*conditions))\
+                .all()
+        found = [m.uuid for m in instance_ref_list]
+        missing = set(uuids or []) - set(found)
+        if missing:
+            LOG.warning('Instances: %s not found or already deleted, skip.'
+                        % sorted(missing))
+        if not found:
+            return []
+
+        vif_ref_list = self.session.query(objects.VirtualInterface)\
+                .filter(objects.VirtualInterface.instance_uuid.in_(found))\
+                .filter(objects.VirtualInterface.deleted == 0)\
+                .all()
+        fixed_ip_ref_list = self.session.query(objects.FixedIp)\
+                .filter(objects.FixedIp.instance_uuid.in_(found))\
+                .all()
+        network_ids = set(m.network_id for m in vif_ref_list)
+        network_ref_list = self.session.query(objects.Network)\
+                .filter(objects.Network.id.in_(network_ids))\
+                .all() if network_ids else []
+
+        vifs = {m.instance_uuid: m for m in vif_ref_list}
+        ips = {m.instance_uuid: m.address for m in fixed_ip_ref_list}
+        networks = {m.id: m for m in network_ref_list}
+
+        vms = []
+        for instance_ref in instance_ref_list:
+            network = None
+            vif_ref = vifs.get(instance_ref.uuid)
+            if vif_ref is not None and vif_ref.network_id in networks:
+                network = format_network(networks[vif_ref.network_id],
+                                         ips.get(instance_ref.uuid),
+                                         vif_ref.address,
+                                         instance_ref.hostname)
+            vms.append({'uuid': instance_ref.uuid,
+                        'host': instance_ref.host,
+                        'hostname': instance_ref.hostname,
+                        'instance_ref': instance_ref,
+                        'network': network})
+        return vms
+
+    @contextlib.contextmanager
+    def lease(self, name):
+        if self.leases is None:
+            yield
+            return
+        with self.leases.hold(name, '%s/teardown' % self.leases.node):
+            yield
+
+    def clean_host(self, host, hypervisor_ip, vms):
+        """Clean up the vms of one hypervisor, return the vms cleaned up
+        and {uuid: error} of the failed ones.
+        """
+        try:
+            driver = LibvirtDriver()
+            driver.connect(hypervisor_ip)
+        except Exception as _ex:
+            LOG.error('Connect to hypervisor: %s failed: %s' % (host, _ex))
+            return [], {vm['uuid']: str(_ex) for vm in vms}
+
+        cleaned, failed = [], {}
+        for vm in vms:
+            try:
+                self.clean_vm(driver, vm)
+            except Exception as _ex:
+                LOG.error('Tear down instance: %s on hypervisor: %s failed: '
+                          '%s' % (vm['uuid'], host, _ex))
+                failed[vm['uuid']] = str(_ex)
+            else:
+                cleaned.append(vm)
+
+        # NOTE(同一网桥的dhcp条目一次删除, dnsmasq只reload一次.)
+        bridges = collections.OrderedDict()
+        for vm in cleaned:
+            if vm['network'] is not None:
+                bridges.setdefault(vm['network']['bridge'], []).append(vm)
+        for bridge, bridge_vms in bridges.items():
+            try:
+                with self.lease('bridge:%s:%s' % (host, bridge)):
+                    self.remove_dhcp_items(host, bridge_vms)
+                    self.reload_dhcp(host, bridge_vms[0]['network'])
+            except Exception as _ex:
+                LOG.error('Remove dhcp items of bridge: %s on hypervisor: %s '
+                          'failed: %s' % (bridge, host, _ex))
+                for vm in bridge_vms:
+                    cleaned.remove(vm)
+                    failed[vm['uuid']] = str(_ex)
+        return cleaned, failed
+
+    def clean_vm(self, driver, vm):
+        uuid = vm['uuid']
+        host = vm['host']
+        domain = driver.lookup(uuid)
+        if domain is not None:
+            if domain.isActive():
+                driver.destroy(domain)
+            driver.undefine(domain)
+            LOG.info('Destroy and undefine instance: %s on hypervisor: %s '
+                     'success.' % (uuid, host))
+
+        instance_dir = '%s/nova/instances/%s' % (self.spec.mount, uuid)
+        with self.lease('hypervisor:%s' % host):
+            self.return_disk(host, uuid, instance_dir)
+
+        cmd = 'rm -rf %s' % instance_dir
+        if not self.execute(host, cmd):
+            raise Exception('删除实例目录: %s 失败!' % instance_dir)
+        LOG.info('Remove instance: %s dir: %s success.' % (uuid, instance_dir))
+
+    def return_disk(self, host, uuid, instance_dir):
+        """Move the disk back to the migrate source directory.
+        """
+        disk_file = '%s/disk' % instance_dir
+        if not self.file_exists(host, disk_file):
+            return
+        # NOTE(源目录下已有待迁移的disk时, 以实例uuid为后缀放回, 不覆盖.)
+        source_disk = '%s/disk' % self.spec.source
+        if self.file_exists(host, source_disk):
+            source_disk = '%s.%s' % (source_disk, uuid)
+        self.stage_file(host, disk_file, source_disk)
+
+    def remove_dhcp_items(self, host, vms):
+        """Remove the dhcp config items(mac,hostname,ip) of the vms.
+        """
+        hostsfile = self._dhcp_file(vms[0]['network']['bridge'], 'conf')
+        exprs = ' '.join("-e '/^%s,/d'" % vm['network']['mac'] for vm in vms)
+        cmd = 'if [ -f "%s" ]; then sed -i %s %s; fi' % (
+            hostsfile, exprs, hostsfile)
+        if not self.execute(host, cmd):
+            raise Exception('删除dhcp配置条目失败: %s' % cmd)
+        LOG.info('Remove %d dhcp config items from: %s success.'
+                 % (len(vms), hostsfile))
+
+    def reload_dhcp(self, host, network):
+        """Send HUP to the dnsmasq of the network to reread its hostsfile.
+        """
+        dhcp_server = network.get('dhcp_server')
+        cmd = ("ps aux | grep dnsmasq | grep -- '--listen-address=%s ' | "
+               "grep -v grep | awk '{print $2}' | xargs -r kill -HUP"
+               % dhcp_server)
+        if not self.execute(host, cmd):
+            raise Exception('reload dnsmasq失败: %s' % cmd)
+        LOG.info('Reload dnsmasq of: %s on hypervisor: %s success.'
+                 % (dhcp_server, host))
+
+    def delete(self, vms):
+        """Soft delete the instances and release their fixed ips, give
+        their resources back to the quota and hypervisors.
+        """
+        uuids = [vm['uuid'] for vm in vms]
+        quota_manager = QuotaManager(self.session)
+        compute_manager = ComputeManager(self.session)
+        state_manager = StateManager(self.session)
+        with self.session.begin(subtransactions=True):
+            for vm in vms:
+                quota_manager.add(vm['instance_ref'], sign=-1)
+                compute_manager.add(vm['instance_ref'], sign=-1)
+            quota_manager.commit()
+            compute_manager.commit()
+            state_manager.release_fixed_ips(uuids)
+            count = state_manager.soft_delete(uuids)
+        LOG.info('Soft delete %d instances and release fixed ips success.'
+                 % count)
+
+    def discard_journal(self, vms):
+        """Forget the journal of the vms, so they can be migrated again.
+        """
+        if not CONF.journal:
+            return
+        for vm in vms:
+            journal = Journal(CONF.journal,
+                              '%s@%s' % (vm['hostname'], vm['host']))
+            journal.discard()
+            journal.close()
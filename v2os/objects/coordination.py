@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright @ 2020 OPS, YY Inc.
+#
+# Author: Jinlong Yang
+#
+
+"""
+SQLAlchemy models of the tables owned by v2os itself, shared by the
+migrator nodes to coordinate: the job queue and the host leases.
+"""
+
+from osmo.db import BASE
+
+from oslo_db.sqlalchemy import models
+from sqlalchemy import Column, Index, Integer, String, Text, Float
+
+
+class MigrationJob(BASE, models.ModelBase):
+    """One vm to migrate, claimed by a single migrator node."""
+
+    __tablename__ = 'v2os_jobs'
+    __table_args__ = (
+        Index('v2os_jobs_status_idx', 'status'),
+    )
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    spec = Column(Text, nullable=False)
+    status = Column(String(16), nullable=False)
+    owner = Column(String(255))
+    uuid = Column(String(36))
+    error = Column(Text)
+    timings = Column(Text)
+    # NOTE(时间都是epoch秒, 各节点需要ntp同步.)
+    created_at = Column(Float(precision=53), nullable=False)
+    started_at = Column(Float(precision=53))
+    finished_at = Column(Float(precision=53))
+    heartbeat_at = Column(Float(precision=53))
+
+
+class Lease(BASE, models.ModelBase):
+    """Exclusive right of a holder on a hypervisor or bridge until expiry."""
+
+    __tablename__ = 'v2os_leases'
+    name = Column(String(255), primary_key=True)
+    owner = Column(String(255), nullable=False)
+    expires_at = Column(Float(precision=53), nullable=False)
+
+
+def create_tables(engine):
+    BASE.metadata.create_all(engine, tables=[MigrationJob.__table__,
+                                             Lease.__table__])
@@ -17,14 +17,16 @@
 #    under the License.
 """
 SQLAlchemy models for nova data.
+
+Only the tables v2os reads or writes are mapped here, so that importing
+and configuring the mappers stays cheap.
 """
 
 from osmo.db import BASE
 
 from oslo_db.sqlalchemy import models
 from oslo_utils import timeutils
-from sqlalchemy import (Column, Index, Integer, BigInteger, Enum, String,
-                        schema, Unicode)
+from sqlalchemy import Column, Index, Integer, Enum, String, schema
 from sqlalchemy.dialects.mysql import MEDIUMTEXT
 from sqlalchemy import orm
 from sqlalchemy import ForeignKey, DateTime, Boolean, Text, Float
@@ -79,26 +81,6 @@ class NovaBase(models.SoftDeleteMixin,
         super(NovaBase, self).save(session=session)
 
 
-class Service(BASE, NovaBase):
-    """Represents a running service on a host."""
-
-    __tablename__ = 'services'
-    __table_args__ = (
-        schema.UniqueConstraint("host", "topic", "deleted",
-                                name="uniq_services0host0topic0deleted"),
-        schema.UniqueConstraint("host", "binary", "deleted",
-                                name="uniq_services0host0binary0deleted")
-        )
-
-    id = Column(Integer, primary_key=True)
-    host = Column(String(255))  # , ForeignKey('hosts.id'))
-    binary = Column(String(255))
-    topic = Column(String(255))
-    report_count = Column(Integer, nullable=False, default=0)
-    disabled = Column(Boolean, default=False)
-    disabled_reason = Column(String(255))
-
-
 class ComputeNode(BASE, NovaBase):
     """Represents a running compute service on a host."""
 
@@ -167,20 +149,6 @@ class ComputeNode(BASE, NovaBase):
     numa_topology = Column(Text)
 
 
-class Certificate(BASE, NovaBase):
-    """Represents a x509 certificate."""
-    __tablename__ = 'certificates'
-    __table_args__ = (
-        Index('certificates_project_id_deleted_idx', 'project_id', 'deleted'),
-        Index('certificates_user_id_deleted_idx', 'user_id', 'deleted')
-    )
-    id = Column(Integer, primary_key=True)
-
-    user_id = Column(String(255))
-    project_id = Column(String(255))
-    file_name = Column(String(255))
-
-
 class Instance(BASE, NovaBase):
     """Represents a guest VM."""
     __tablename__ = 'instances'
@@ -372,109 +340,6 @@ class InstanceTypes(BASE, NovaBase):
     is_public = Column(Boolean, default=True)
 
 
-class Volume(BASE, NovaBase):
-    """Represents a block storage device that can be attached to a VM."""
-    __tablename__ = 'volumes'
-    __table_args__ = (
-        Index('volumes_instance_uuid_idx', 'instance_uuid'),
-    )
-    id = Column(String(36), primary_key=True, nullable=False)
-    deleted = Column(String(36), default="")
-
-    ec2_id = Column(String(255))
-    user_id = Column(String(255))
-    project_id = Column(String(255))
-
-    snapshot_id = Column(String(36))
-
-    host = Column(String(255))
-    size = Column(Integer)
-    availability_zone = Column(String(255))
-    instance_uuid = Column(String(36))
-    mountpoint = Column(String(255))
-    attach_time = Column(DateTime)
-    status = Column(String(255))  # TODO(vish): enum?
-    attach_status = Column(String(255))  # TODO(vish): enum
-
-    scheduled_at = Column(DateTime)
-    launched_at = Column(DateTime)
-    terminated_at = Column(DateTime)
-
-    display_name = Column(String(255))
-    display_description = Column(String(255))
-
-    provider_location = Column(String(256))
-    provider_auth = Column(String(256))
-
-    volume_type_id = Column(Integer)
-
-
-class Quota(BASE, NovaBase):
-    """Represents a single quota override for a project.
-
-    If there is no row for a given project id and resource, then the
-    default for the quota class is used.  If there is no row for a
-    given quota class and resource, then the default for the
-    deployment is used. If the row is present but the hard limit is
-    Null, then the resource is unlimited.
-    """
-
-    __tablename__ = 'quotas'
-    __table_args__ = (
-        schema.UniqueConstraint("project_id", "resource", "deleted",
-        name="uniq_quotas0project_id0resource0deleted"
-        ),
-    )
-    id = Column(Integer, primary_key=True)
-
-    project_id = Column(String(255))
-
-    resource = Column(String(255), nullable=False)
-    hard_limit = Column(Integer)
-
-
-class ProjectUserQuota(BASE, NovaBase):
-    """Represents a single quota override for a user with in a project."""
-
-    __tablename__ = 'project_user_quotas'
-    uniq_name = "uniq_project_user_quotas0user_id0project_id0resource0deleted"
-    __table_args__ = (
-        schema.UniqueConstraint("user_id", "project_id", "resource", "deleted",
-                                name=uniq_name),
-        Index('project_user_quotas_project_id_deleted_idx',
-              'project_id', 'deleted'),
-        Index('project_user_quotas_user_id_deleted_idx',
-              'user_id', 'deleted')
-    )
-    id = Column(Integer, primary_key=True, nullable=False)
-
-    project_id = Column(String(255), nullable=False)
-    user_id = Column(String(255), nullable=False)
-
-    resource = Column(String(255), nullable=False)
-    hard_limit = Column(Integer)
-
-
-class QuotaClass(BASE, NovaBase):
-    """Represents a single quota override for a quota class.
-
-    If there is no row for a given quota class and resource, then the
-    default for the deployment is used.  If the row is present but the
-    hard limit is Null, then the resource is unlimited.
-    """
-
-    __tablename__ = 'quota_classes'
-    __table_args__ = (
-        Index('ix_quota_classes_class_name', 'class_name'),
-    )
-    id = Column(Integer, primary_key=True)
-
-    class_name = Column(String(255))
-
-    resource = Column(String(255))
-    hard_limit = Column(Integer)
-
-
 class QuotaUsage(BASE, NovaBase):
     """Represents the current usage for a given resource."""
 
@@ -499,55 +364,6 @@ class QuotaUsage(BASE, NovaBase):
     until_refresh = Column(Integer)
 
 
-class Reservation(BASE, NovaBase):
-    """Represents a resource reservation for quotas."""
-
-    __tablename__ = 'reservations'
-    __table_args__ = (
-        Index('ix_reservations_project_id', 'project_id'),
-        Index('reservations_uuid_idx', 'uuid'),
-        Index('reservations_deleted_expire_idx', 'deleted', 'expire'),
-        Index('ix_reservations_user_id_deleted', 'user_id', 'deleted'),
-    )
-    id = Column(Integer, primary_key=True, nullable=False)
-    uuid = Column(String(36), nullable=False)
-
-    usage_id = Column(Integer, ForeignKey('quota_usages.id'), nullable=False)
-
-    project_id = Column(String(255))
-    user_id = Column(String(255))
-    resource = Column(String(255))
-
-    delta = Column(Integer, nullable=False)
-    expire = Column(DateTime)
-
-    usage = orm.relationship(
-        "QuotaUsage",
-        foreign_keys=usage_id,
-        primaryjoin='and_(Reservation.usage_id == QuotaUsage.id,'
-                         'QuotaUsage.deleted == 0)')
-
-
-class Snapshot(BASE, NovaBase):
-    """Represents a block storage device that can be attached to a VM."""
-    __tablename__ = 'snapshots'
-    __table_args__ = ()
-    id = Column(String(36), primary_key=True, nullable=False)
-    deleted = Column(String(36), default="")
-
-    user_id = Column(String(255))
-    project_id = Column(String(255))
-
-    volume_id = Column(String(36), nullable=False)
-    status = Column(String(255))
-    progress = Column(String(255))
-    volume_size = Column(Integer)
-    scheduled_at = Column(DateTime)
-
-    display_name = Column(String(255))
-    display_description = Column(String(255))
-
-
 class BlockDeviceMapping(BASE, NovaBase):
     """Represents block device mapping that is defined by EC2."""
     __tablename__ = "block_device_mapping"
@@ -602,25 +418,6 @@ class BlockDeviceMapping(BASE, NovaBase):
     connection_info = Column(MediumText())
 
 
-class IscsiTarget(BASE, NovaBase):
-    """Represents an iscsi target for a given host."""
-    __tablename__ = 'iscsi_targets'
-    __table_args__ = (
-        Index('iscsi_targets_volume_id_fkey', 'volume_id'),
-        Index('iscsi_targets_host_volume_id_deleted_idx', 'host', 'volume_id',
-              'deleted')
-    )
-    id = Column(Integer, primary_key=True, nullable=False)
-    target_num = Column(Integer)
-    host = Column(String(255))
-    volume_id = Column(String(36), ForeignKey('volumes.id'))
-    volume = orm.relationship(Volume,
-                          backref=orm.backref('iscsi_target', uselist=False),
-                          foreign_keys=volume_id,
-                          primaryjoin='and_(IscsiTarget.volume_id==Volume.id,'
-                                           'IscsiTarget.deleted==0)')
-
-
 class SecurityGroupInstanceAssociation(BASE, NovaBase):
     __tablename__ = 'security_group_instance_association'
     __table_args__ = (
@@ -663,56 +460,6 @@ class SecurityGroup(BASE, NovaBase):
                              backref='security_groups')
 
 
-class SecurityGroupIngressRule(BASE, NovaBase):
-    """Represents a rule in a security group."""
-    __tablename__ = 'security_group_rules'
-    __table_args__ = ()
-    id = Column(Integer, primary_key=True)
-
-    parent_group_id = Column(Integer, ForeignKey('security_groups.id'))
-    parent_group = orm.relationship("SecurityGroup", backref="rules",
-                                foreign_keys=parent_group_id,
-                                primaryjoin='and_('
-        'SecurityGroupIngressRule.parent_group_id == SecurityGroup.id,'
-        'SecurityGroupIngressRule.deleted == 0)')
-
-    protocol = Column(String(255))
-    from_port = Column(Integer)
-    to_port = Column(Integer)
-    cidr = Column(types.CIDR())
-
-    # Note: This is not the parent SecurityGroup. It's SecurityGroup we're
-    # granting access for.
-    group_id = Column(Integer, ForeignKey('security_groups.id'))
-    grantee_group = orm.relationship("SecurityGroup",
-                                 foreign_keys=group_id,
-                                 primaryjoin='and_('
-        'SecurityGroupIngressRule.group_id == SecurityGroup.id,'
-        'SecurityGroupIngressRule.deleted == 0)')
-
-
-class SecurityGroupIngressDefaultRule(BASE, NovaBase):
-    __tablename__ = 'security_group_default_rules'
-    __table_args__ = ()
-    id = Column(Integer, primary_key=True, nullable=False)
-    protocol = Column(String(5))  # "tcp", "udp" or "icmp"
-    from_port = Column(Integer)
-    to_port = Column(Integer)
-    cidr = Column(types.CIDR())
-
-
-class ProviderFirewallRule(BASE, NovaBase):
-    """Represents a rule in a security group."""
-    __tablename__ = 'provider_fw_rules'
-    __table_args__ = ()
-    id = Column(Integer, primary_key=True, nullable=False)
-
-    protocol = Column(String(5))  # "tcp", "udp", or "icmp"
-    from_port = Column(Integer)
-    to_port = Column(Integer)
-    cidr = Column(types.CIDR())
-
-
 class KeyPair(BASE, NovaBase):
     """Represents a public key pair for ssh / WinRM."""
     __tablename__ = 'key_pairs'
@@ -732,37 +479,6 @@ class KeyPair(BASE, NovaBase):
                   nullable=False, server_default='ssh')
 
 
-class Migration(BASE, NovaBase):
-    """Represents a running host-to-host migration."""
-    __tablename__ = 'migrations'
-    __table_args__ = (
-        Index('migrations_instance_uuid_and_status_idx', 'deleted',
-              'instance_uuid', 'status'),
-        Index('migrations_by_host_nodes_and_status_idx', 'deleted',
-              'source_compute', 'dest_compute', 'source_node', 'dest_node',
-              'status'),
-    )
-    id = Column(Integer, primary_key=True, nullable=False)
-    # NOTE(tr3buchet): the ____compute variables are instance['host']
-    source_compute = Column(String(255))
-    dest_compute = Column(String(255))
-    # nodes are equivalent to a compute node's 'hypervisor_hostname'
-    source_node = Column(String(255))
-    dest_node = Column(String(255))
-    # NOTE(tr3buchet): dest_host, btw, is an ip address
-    dest_host = Column(String(255))
-    old_instance_type_id = Column(Integer())
-    new_instance_type_id = Column(Integer())
-    instance_uuid = Column(String(36), ForeignKey('instances.uuid'))
-    # TODO(_cerberus_): enum
-    status = Column(String(255))
-
-    instance = orm.relationship("Instance", foreign_keys=instance_uuid,
-                            primaryjoin='and_(Migration.instance_uuid == '
-                                        'Instance.uuid, Instance.deleted == '
-                                        '0)')
-
-
 class Network(BASE, NovaBase):
     """Represents a network."""
     __tablename__ = 'networks'
@@ -832,6 +548,8 @@ class VirtualInterface(BASE, NovaBase):
 
 
 # TODO(vish): can these both come from the same baseclass?
+
+
 class FixedIp(BASE, NovaBase):
     """Represents a fixed ip for an instance."""
     __tablename__ = 'fixed_ips'
@@ -890,101 +608,6 @@ class FixedIp(BASE, NovaBase):
                                 'VirtualInterface.deleted == 0)')
 
 
-class FloatingIp(BASE, NovaBase):
-    """Represents a floating ip that dynamically forwards to a fixed ip."""
-    __tablename__ = 'floating_ips'
-    __table_args__ = (
-        schema.UniqueConstraint("address", "deleted",
-                                name="uniq_floating_ips0address0deleted"),
-        Index('fixed_ip_id', 'fixed_ip_id'),
-        Index('floating_ips_host_idx', 'host'),
-        Index('floating_ips_project_id_idx', 'project_id'),
-        Index('floating_ips_pool_deleted_fixed_ip_id_project_id_idx',
-              'pool', 'deleted', 'fixed_ip_id', 'project_id')
-    )
-    id = Column(Integer, primary_key=True)
-    address = Column(types.IPAddress())
-    fixed_ip_id = Column(Integer)
-    project_id = Column(String(255))
-    host = Column(String(255))  # , ForeignKey('hosts.id'))
-    auto_assigned = Column(Boolean, default=False)
-    # TODO(sshturm) add default in db
-    pool = Column(String(255))
-    interface = Column(String(255))
-    fixed_ip = orm.relationship(FixedIp,
-                            backref=orm.backref('floating_ips'),
-                            foreign_keys=fixed_ip_id,
-                            primaryjoin='and_('
-                                'FloatingIp.fixed_ip_id == FixedIp.id,'
-                                'FloatingIp.deleted == 0,'
-                                'FixedIp.deleted == 0)')
-
-
-class DNSDomain(BASE, NovaBase):
-    """Represents a DNS domain with availability zone or project info."""
-    __tablename__ = 'dns_domains'
-    __table_args__ = (
-        Index('dns_domains_project_id_idx', 'project_id'),
-        Index('dns_domains_domain_deleted_idx', 'domain', 'deleted'),
-    )
-    deleted = Column(Boolean, default=False)
-    domain = Column(String(255), primary_key=True)
-    scope = Column(String(255))
-    availability_zone = Column(String(255))
-    project_id = Column(String(255))
-
-
-class ConsolePool(BASE, NovaBase):
-    """Represents pool of consoles on the same physical node."""
-    __tablename__ = 'console_pools'
-    __table_args__ = (
-        schema.UniqueConstraint(
-            "host", "console_type", "compute_host", "deleted",
-            name="uniq_console_pools0host0console_type0compute_host0deleted"),
-    )
-    id = Column(Integer, primary_key=True)
-    address = Column(types.IPAddress())
-    username = Column(String(255))
-    password = Column(String(255))
-    console_type = Column(String(255))
-    public_hostname = Column(String(255))
-    host = Column(String(255))
-    compute_host = Column(String(255))
-
-
-class Console(BASE, NovaBase):
-    """Represents a console session for an instance."""
-    __tablename__ = 'consoles'
-    __table_args__ = (
-        Index('consoles_instance_uuid_idx', 'instance_uuid'),
-    )
-    id = Column(Integer, primary_key=True)
-    instance_name = Column(String(255))
-    instance_uuid = Column(String(36), ForeignKey('instances.uuid'))
-    password = Column(String(255))
-    port = Column(Integer)
-    pool_id = Column(Integer, ForeignKey('console_pools.id'))
-    pool = orm.relationship(ConsolePool, backref=orm.backref('consoles'))
-
-
-class InstanceMetadata(BASE, NovaBase):
-    """Represents a user-provided metadata key/value pair for an instance."""
-    __tablename__ = 'instance_metadata'
-    __table_args__ = (
-        Index('instance_metadata_instance_uuid_idx', 'instance_uuid'),
-    )
-    id = Column(Integer, primary_key=True)
-    key = Column(String(255))
-    value = Column(String(255))
-    instance_uuid = Column(String(36), ForeignKey('instances.uuid'))
-    instance = orm.relationship(Instance, backref="metadata",
-                            foreign_keys=instance_uuid,
-                            primaryjoin='and_('
-                                'InstanceMetadata.instance_uuid == '
-                                     'Instance.uuid,'
-                                'InstanceMetadata.deleted == 0)')
-
-
 class InstanceSystemMetadata(BASE, NovaBase):
     """Represents a system-owned metadata key/value pair for an instance."""
     __tablename__ = 'instance_system_metadata'
@@ -1003,72 +626,6 @@ class InstanceSystemMetadata(BASE, NovaBase):
                             primaryjoin=primary_join)
 
 
-class InstanceTypeProjects(BASE, NovaBase):
-    """Represent projects associated instance_types."""
-    __tablename__ = "instance_type_projects"
-    __table_args__ = (schema.UniqueConstraint(
-        "instance_type_id", "project_id", "deleted",
-        name="uniq_instance_type_projects0instance_type_id0project_id0deleted"
-        ),
-    )
-    id = Column(Integer, primary_key=True)
-    instance_type_id = Column(Integer, ForeignKey('instance_types.id'),
-                              nullable=False)
-    project_id = Column(String(255))
-
-    instance_type = orm.relationship(InstanceTypes, backref="projects",
-                 foreign_keys=instance_type_id,
-                 primaryjoin='and_('
-                 'InstanceTypeProjects.instance_type_id == InstanceTypes.id,'
-                 'InstanceTypeProjects.deleted == 0)')
-
-
-class InstanceTypeExtraSpecs(BASE, NovaBase):
-    """Represents additional specs as key/value pairs for an instance_type."""
-    __tablename__ = 'instance_type_extra_specs'
-    __table_args__ = (
-        Index('instance_type_extra_specs_instance_type_id_key_idx',
-              'instance_type_id', 'key'),
-        schema.UniqueConstraint(
-              "instance_type_id", "key", "deleted",
-              name=("uniq_instance_type_extra_specs0"
-                    "instance_type_id0key0deleted")
-        ),
-    )
-    id = Column(Integer, primary_key=True)
-    key = Column(String(255))
-    value = Column(String(255))
-    instance_type_id = Column(Integer, ForeignKey('instance_types.id'),
-                              nullable=False)
-    instance_type = orm.relationship(InstanceTypes, backref="extra_specs",
-                 foreign_keys=instance_type_id,
-                 primaryjoin='and_('
-                 'InstanceTypeExtraSpecs.instance_type_id == InstanceTypes.id,'
-                 'InstanceTypeExtraSpecs.deleted == 0)')
-
-
-class Cell(BASE, NovaBase):
-    """Represents parent and child cells of this cell.  Cells can
-    have multiple parents and children, so there could be any number
-    of entries with is_parent=True or False
-    """
-    __tablename__ = 'cells'
-    __table_args__ = (schema.UniqueConstraint(
-        "name", "deleted", name="uniq_cells0name0deleted"
-        ),
-    )
-    id = Column(Integer, primary_key=True)
-    # Name here is the 'short name' of a cell.  For instance: 'child1'
-    name = Column(String(255))
-    api_url = Column(String(255))
-
-    transport_url = Column(String(255), nullable=False)
-
-    weight_offset = Column(Float(), default=0.0)
-    weight_scale = Column(Float(), default=1.0)
-    is_parent = Column(Boolean())
-
-
 class AggregateHost(BASE, NovaBase):
     """Represents a host that is member of an aggregate."""
     __tablename__ = 'aggregate_hosts'
@@ -1134,105 +691,6 @@ class Aggregate(BASE, NovaBase):
         return self.metadetails['availability_zone']
 
 
-class AgentBuild(BASE, NovaBase):
-    """Represents an agent build."""
-    __tablename__ = 'agent_builds'
-    __table_args__ = (
-        Index('agent_builds_hypervisor_os_arch_idx', 'hypervisor', 'os',
-              'architecture'),
-        schema.UniqueConstraint("hypervisor", "os", "architecture", "deleted",
-                name="uniq_agent_builds0hypervisor0os0architecture0deleted"),
-    )
-    id = Column(Integer, primary_key=True)
-    hypervisor = Column(String(255))
-    os = Column(String(255))
-    architecture = Column(String(255))
-    version = Column(String(255))
-    url = Column(String(255))
-    md5hash = Column(String(255))
-
-
-class BandwidthUsage(BASE, NovaBase):
-    """Cache for instance bandwidth usage data pulled from the hypervisor."""
-    __tablename__ = 'bw_usage_cache'
-    __table_args__ = (
-        Index('bw_usage_cache_uuid_start_period_idx', 'uuid',
-              'start_period'),
-    )
-    id = Column(Integer, primary_key=True, nullable=False)
-    uuid = Column(String(36))
-    mac = Column(String(255))
-    start_period = Column(DateTime, nullable=False)
-    last_refreshed = Column(DateTime)
-    bw_in = Column(BigInteger)
-    bw_out = Column(BigInteger)
-    last_ctr_in = Column(BigInteger)
-    last_ctr_out = Column(BigInteger)
-
-
-class VolumeUsage(BASE, NovaBase):
-    """Cache for volume usage data pulled from the hypervisor."""
-    __tablename__ = 'volume_usage_cache'
-    __table_args__ = ()
-    id = Column(Integer, primary_key=True, nullable=False)
-    volume_id = Column(String(36), nullable=False)
-    instance_uuid = Column(String(36))
-    project_id = Column(String(36))
-    user_id = Column(String(64))
-    availability_zone = Column(String(255))
-    tot_last_refreshed = Column(DateTime)
-    tot_reads = Column(BigInteger, default=0)
-    tot_read_bytes = Column(BigInteger, default=0)
-    tot_writes = Column(BigInteger, default=0)
-    tot_write_bytes = Column(BigInteger, default=0)
-    curr_last_refreshed = Column(DateTime)
-    curr_reads = Column(BigInteger, default=0)
-    curr_read_bytes = Column(BigInteger, default=0)
-    curr_writes = Column(BigInteger, default=0)
-    curr_write_bytes = Column(BigInteger, default=0)
-
-
-class S3Image(BASE, NovaBase):
-    """Compatibility layer for the S3 image service talking to Glance."""
-    __tablename__ = 's3_images'
-    __table_args__ = ()
-    id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
-    uuid = Column(String(36), nullable=False)
-
-
-class VolumeIdMapping(BASE, NovaBase):
-    """Compatibility layer for the EC2 volume service."""
-    __tablename__ = 'volume_id_mappings'
-    __table_args__ = ()
-    id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
-    uuid = Column(String(36), nullable=False)
-
-
-class SnapshotIdMapping(BASE, NovaBase):
-    """Compatibility layer for the EC2 snapshot service."""
-    __tablename__ = 'snapshot_id_mappings'
-    __table_args__ = ()
-    id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
-    uuid = Column(String(36), nullable=False)
-
-
-class InstanceFault(BASE, NovaBase):
-    __tablename__ = 'instance_faults'
-    __table_args__ = (
-        Index('instance_faults_host_idx', 'host'),
-        Index('instance_faults_instance_uuid_deleted_created_at_idx',
-              'instance_uuid', 'deleted', 'created_at')
-    )
-
-    id = Column(Integer, primary_key=True, nullable=False)
-    instance_uuid = Column(String(36),
-                           ForeignKey('instances.uuid'))
-    code = Column(Integer(), nullable=False)
-    message = Column(String(255))
-    details = Column(MediumText())
-    host = Column(String(255))
-
-
 class InstanceAction(BASE, NovaBase):
     """Track client actions on an instance.
 
@@ -1271,165 +729,3 @@ class InstanceActionEvent(BASE, NovaBase):
     traceback = Column(Text)
     host = Column(String(255))
     details = Column(Text)
-
-
-class InstanceIdMapping(BASE, NovaBase):
-    """Compatibility layer for the EC2 instance service."""
-    __tablename__ = 'instance_id_mappings'
-    __table_args__ = (
-        Index('ix_instance_id_mappings_uuid', 'uuid'),
-    )
-    id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
-    uuid = Column(String(36), nullable=False)
-
-
-class TaskLog(BASE, NovaBase):
-    """Audit log for background periodic tasks."""
-    __tablename__ = 'task_log'
-    __table_args__ = (
-        schema.UniqueConstraint(
-            'task_name', 'host', 'period_beginning', 'period_ending',
-            name="uniq_task_log0task_name0host0period_beginning0period_ending"
-        ),
-        Index('ix_task_log_period_beginning', 'period_beginning'),
-        Index('ix_task_log_host', 'host'),
-        Index('ix_task_log_period_ending', 'period_ending'),
-    )
-    id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
-    task_name = Column(String(255), nullable=False)
-    state = Column(String(255), nullable=False)
-    host = Column(String(255), nullable=False)
-    period_beginning = Column(DateTime, default=timeutils.utcnow,
-                              nullable=False)
-    period_ending = Column(DateTime, default=timeutils.utcnow,
-                           nullable=False)
-    message = Column(String(255), nullable=False)
-    task_items = Column(Integer(), default=0)
-    errors = Column(Integer(), default=0)
-
-
-class InstanceGroupMember(BASE, NovaBase):
-    """Represents the members for an instance group."""
-    __tablename__ = 'instance_group_member'
-    __table_args__ = (
-        Index('instance_group_member_instance_idx', 'instance_id'),
-    )
-    id = Column(Integer, primary_key=True, nullable=False)
-    instance_id = Column(String(255))
-    group_id = Column(Integer, ForeignKey('instance_groups.id'),
-                      nullable=False)
-
-
-class InstanceGroupPolicy(BASE, NovaBase):
-    """Represents the policy type for an instance group."""
-    __tablename__ = 'instance_group_policy'
-    __table_args__ = (
-        Index('instance_group_policy_policy_idx', 'policy'),
-    )
-    id = Column(Integer, primary_key=True, nullable=False)
-    policy = Column(String(255))
-    group_id = Column(Integer, ForeignKey('instance_groups.id'),
-                      nullable=False)
-
-
-class InstanceGroup(BASE, NovaBase):
-    """Represents an instance group.
-
-    A group will maintain a collection of instances and the relationship
-    between them.
-    """
-
-    __tablename__ = 'instance_groups'
-    __table_args__ = (
-        schema.UniqueConstraint("uuid", "deleted",
-                                 name="uniq_instance_groups0uuid0deleted"),
-    )
-
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    user_id = Column(String(255))
-    project_id = Column(String(255))
-    uuid = Column(String(36), nullable=False)
-    name = Column(String(255))
-    _policies = orm.relationship(InstanceGroupPolicy, primaryjoin='and_('
-        'InstanceGroup.id == InstanceGroupPolicy.group_id,'
-        'InstanceGroupPolicy.deleted == 0,'
-        'InstanceGroup.deleted == 0)')
-    _members = orm.relationship(InstanceGroupMember, primaryjoin='and_('
-        'InstanceGroup.id == InstanceGroupMember.group_id,'
-        'InstanceGroupMember.deleted == 0,'
-        'InstanceGroup.deleted == 0)')
-
-    @property
-    def policies(self):
-        return [p.policy for p in self._policies]
-
-    @property
-    def members(self):
-        return [m.instance_id for m in self._members]
-
-
-class PciDevice(BASE, NovaBase):
-    """Represents a PCI host device that can be passed through to instances.
-    """
-    __tablename__ = 'pci_devices'
-    __table_args__ = (
-        Index('ix_pci_devices_compute_node_id_deleted',
-              'compute_node_id', 'deleted'),
-        Index('ix_pci_devices_instance_uuid_deleted',
-              'instance_uuid', 'deleted'),
-        schema.UniqueConstraint(
-            "compute_node_id", "address", "deleted",
-            name="uniq_pci_devices0compute_node_id0address0deleted")
-    )
-    id = Column(Integer, primary_key=True)
-
-    compute_node_id = Column(Integer, ForeignKey('compute_nodes.id'),
-                             nullable=False)
-
-    # physical address of device domain:bus:slot.func (0000:09:01.1)
-    address = Column(String(12), nullable=False)
-
-    vendor_id = Column(String(4), nullable=False)
-    product_id = Column(String(4), nullable=False)
-    dev_type = Column(String(8), nullable=False)
-    dev_id = Column(String(255))
-
-    # label is abstract device name, that is used to unify devices with the
-    # same functionality with different addresses or host.
-    label = Column(String(255), nullable=False)
-
-    status = Column(String(36), nullable=False)
-    # the request_id is used to identify a device that is allocated for a
-    # particular request
-    request_id = Column(String(36), nullable=True)
-
-    extra_info = Column(Text)
-
-    instance_uuid = Column(String(36))
-
-    numa_node = Column(Integer, nullable=True)
-
-    instance = orm.relationship(Instance, backref="pci_devices",
-                            foreign_keys=instance_uuid,
-                            primaryjoin='and_('
-                            'PciDevice.instance_uuid == Instance.uuid,'
-                            'PciDevice.deleted == 0)')
-
-
-class Tag(BASE, models.ModelBase):
-    """Represents the tag for a resource."""
-
-    __tablename__ = "tags"
-    __table_args__ = (
-        Index('tags_tag_idx', 'tag'),
-    )
-    resource_id = Column(String(36), primary_key=True, nullable=False)
-    tag = Column(Unicode(80), primary_key=True, nullable=False)
-
-    instance = orm.relationship(
-        "Instance",
-        backref='tags',
-        primaryjoin='and_(Tag.resource_id == Instance.uuid,'
-                    'Instance.deleted == 0)',
-        foreign_keys=resource_id
-    )
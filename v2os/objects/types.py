@@ -15,7 +15,6 @@
 
 """Custom SQLAlchemy types."""
 
-import netaddr
 from sqlalchemy.dialects import postgresql
 from sqlalchemy import types
 
@@ -54,6 +53,8 @@ class CIDR(types.TypeDecorator):
         return value
 
     def process_result_value(self, value, dialect):
+        import netaddr
+
         try:
             return str(netaddr.IPNetwork(value, version=4).cidr)
         except netaddr.AddrFormatError: